@@ -0,0 +1,180 @@
+"""
+Admission control cho API (chạy trên event loop của FastAPI).
+
+- Sức chứa chung tính theo "đơn vị": mỗi loại request có trọng số (phân tích hợp đồng nặng hơn tra cứu)
+  và giới hạn số request đang chạy riêng.
+- Hết chỗ -> chờ trong hàng đợi ngắn, tối đa `queue_timeout_s`; hàng đợi đầy hoặc chờ quá lâu -> 503.
+- Mỗi client (X-Client-Id hoặc IP) có token bucket riêng; vượt -> 429.
+- Mọi từ chối đều kèm Retry-After, trả về ngay thay vì để request treo tới khi timeout.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Deque, Dict, Tuple
+
+from llm_resilience import TokenBucket
+from metrics import ADMISSION_IN_FLIGHT, ADMISSION_QUEUE_DEPTH, ADMISSION_QUEUE_WAIT, ADMISSION_REJECTED
+
+logger = logging.getLogger("LegalAI")
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code: int, reason: str, retry_after: float, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.detail = detail
+
+
+@dataclass
+class RequestClass:
+    name: str
+    weight: int          # Số đơn vị sức chứa chiếm khi chạy
+    max_in_flight: int   # Trần riêng của loại này
+
+
+@dataclass
+class Ticket:
+    cls: RequestClass
+    released: bool = False
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        capacity: int,
+        classes: Dict[str, Tuple[int, int]],
+        queue_size: int = 64,
+        queue_timeout_s: float = 2.0,
+        client_rpm: float = 60.0,
+        client_burst: float = 10.0,
+        max_clients: int = 10000,
+    ):
+        """classes: {tên: (trọng số, số request tối đa đang chạy)}."""
+        self.capacity = capacity
+        self.classes = {name: RequestClass(name, w, m) for name, (w, m) in classes.items()}
+        self.queue_size = queue_size
+        self.queue_timeout_s = queue_timeout_s
+        self.client_rpm = client_rpm
+        self.client_burst = client_burst
+        self.max_clients = max_clients
+        self._used = 0
+        self._in_flight = {name: 0 for name in self.classes}
+        self._waiters: Deque[Tuple[RequestClass, asyncio.Future]] = deque()
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    # ---------- rate limit theo client ----------
+
+    def _bucket(self, client: str) -> TokenBucket:
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = TokenBucket(self.client_rpm / 60.0, self.client_burst)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)  # Bỏ client lâu không gửi request nhất
+        else:
+            self._buckets.move_to_end(client)
+        return bucket
+
+    # ---------- sức chứa ----------
+
+    def _fits(self, cls: RequestClass) -> bool:
+        return self._used + cls.weight <= self.capacity and self._in_flight[cls.name] < cls.max_in_flight
+
+    def _waiting_for_capacity(self) -> bool:
+        """Có request đang chờ sức chứa chung (không phải chờ vì chạm trần riêng của loại nó)?"""
+        return any(
+            not fut.done() and self._in_flight[c.name] < c.max_in_flight
+            for c, fut in self._waiters
+        )
+
+    def _take(self, cls: RequestClass) -> Ticket:
+        self._used += cls.weight
+        self._in_flight[cls.name] += 1
+        ADMISSION_IN_FLIGHT.labels(cls.name).set(self._in_flight[cls.name])
+        return Ticket(cls)
+
+    def _reject(self, cls: RequestClass, status_code: int, reason: str, retry_after: float, detail: str):
+        ADMISSION_REJECTED.labels(cls.name, reason).inc()
+        raise AdmissionRejected(status_code, reason, retry_after, detail)
+
+    def _queue_depth_changed(self, cls: RequestClass):
+        ADMISSION_QUEUE_DEPTH.labels(cls.name).set(sum(1 for c, _ in self._waiters if c is cls))
+
+    async def acquire(self, cls_name: str, client: str) -> Ticket:
+        cls = self.classes[cls_name]
+        wait = self._bucket(client).try_acquire()
+        if wait > 0:
+            self._reject(cls, 429, "rate_limited", wait, "Gửi quá nhiều request, vui lòng thử lại sau.")
+
+        # Vừa chỗ -> vào ngay, trừ khi có request chờ sức chứa chung đến trước (không chen hàng).
+        # Request chỉ chờ vì trần riêng của loại nó (vd. contract thứ 5) không chặn loại khác.
+        if self._fits(cls) and not self._waiting_for_capacity():
+            ADMISSION_QUEUE_WAIT.labels(cls.name).observe(0.0)
+            return self._take(cls)
+        if len(self._waiters) >= self.queue_size:
+            self._reject(cls, 503, "queue_full", self.queue_timeout_s, "Hệ thống đang quá tải, vui lòng thử lại sau.")
+
+        fut = asyncio.get_running_loop().create_future()
+        entry = (cls, fut)
+        self._waiters.append(entry)
+        self._queue_depth_changed(cls)
+        started = time.perf_counter()
+        try:
+            ticket = await asyncio.wait_for(asyncio.shield(fut), timeout=self.queue_timeout_s)
+        except asyncio.TimeoutError:
+            if fut.done() and not fut.cancelled():
+                # Được cấp slot đúng lúc hết giờ -> vẫn nhận
+                ticket = fut.result()
+            else:
+                fut.cancel()
+                self._reject(cls, 503, "queue_timeout", self.queue_timeout_s, "Hệ thống đang quá tải, vui lòng thử lại sau.")
+        except asyncio.CancelledError:
+            # Client ngắt kết nối khi đang chờ: trả lại slot nếu vừa được cấp
+            if fut.done() and not fut.cancelled():
+                self.release(fut.result())
+            fut.cancel()
+            raise
+        finally:
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+            self._queue_depth_changed(cls)
+        ADMISSION_QUEUE_WAIT.labels(cls.name).observe(time.perf_counter() - started)
+        return ticket
+
+    def release(self, ticket: Ticket):
+        if ticket.released:
+            return
+        ticket.released = True
+        self._used -= ticket.cls.weight
+        self._in_flight[ticket.cls.name] -= 1
+        ADMISSION_IN_FLIGHT.labels(ticket.cls.name).set(self._in_flight[ticket.cls.name])
+        # Cấp slot cho các request đang chờ (theo thứ tự đến, bỏ qua request chưa vừa)
+        for cls, fut in list(self._waiters):
+            if not fut.done() and self._fits(cls):
+                self._waiters.remove((cls, fut))
+                fut.set_result(self._take(cls))
+                self._queue_depth_changed(cls)
+
+    @asynccontextmanager
+    async def admit(self, cls_name: str, client: str):
+        ticket = await self.acquire(cls_name, client)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def status(self) -> Dict:
+        return {
+            "capacity": self.capacity,
+            "used": self._used,
+            "in_flight": dict(self._in_flight),
+            "queued": len(self._waiters),
+            "clients": len(self._buckets),
+        }
@@ -1,8 +1,68 @@
+import hashlib
+import json
+
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 
 # Cấu hình API và UI
 API_URL = "http://localhost:8000"  # Backend FastAPI của bạn
+CONNECT_TIMEOUT_S = 5
+UPLOAD_TIMEOUT_S = 60
+READ_TIMEOUT_S = 300  # Phân tích hợp đồng dài có thể mất vài phút (giữa 2 đoạn stream)
+
+
+@st.cache_resource
+def get_http() -> requests.Session:
+    """Một Session dùng chung (giữ kết nối keep-alive) cho mọi lần rerun của Streamlit."""
+    http = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    http.mount("http://", adapter)
+    http.mount("https://", adapter)
+    return http
+
+
+def upload_once(uploaded) -> str:
+    """Upload mỗi file đúng một lần (theo hash nội dung), các lần rerun dùng lại file_path đã có."""
+    data = uploaded.getvalue()
+    digest = hashlib.sha256(data).hexdigest()
+    uploads = st.session_state.setdefault("uploads", {})
+    if digest not in uploads:
+        resp = get_http().post(
+            f"{API_URL}/upload",
+            files={"file": (uploaded.name, data)},
+            timeout=(CONNECT_TIMEOUT_S, UPLOAD_TIMEOUT_S),
+        )
+        resp.raise_for_status()
+        uploads[digest] = resp.json().get("file_path")
+    return uploads[digest]
+
+
+def stream_chat(payload: dict, placeholder) -> str:
+    """Gọi /chat/stream, hiển thị dần câu trả lời vào placeholder, trả về câu trả lời cuối cùng."""
+    payload = {**payload, "session_id": st.session_state.get("session_id")}
+    text = ""
+    with get_http().post(
+        f"{API_URL}/chat/stream", json=payload, stream=True, timeout=(CONNECT_TIMEOUT_S, READ_TIMEOUT_S)
+    ) as resp:
+        resp.raise_for_status()
+        st.session_state["session_id"] = resp.headers.get("X-Session-Id") or st.session_state.get("session_id")
+        for line in resp.iter_lines(decode_unicode=True):
+            if not line:
+                continue
+            event = json.loads(line)
+            if event["type"] == "delta":
+                text += event["text"]
+                placeholder.markdown(text + "▌")
+            elif event["type"] == "reset":
+                text = ""
+                placeholder.markdown("⏳ Đang thử lại...")
+            elif event["type"] == "done":
+                text = event["answer"]
+            elif event["type"] == "error":
+                raise RuntimeError(event["detail"])
+    placeholder.markdown(text)
+    return text
 
 # --- Cấu hình Trang (Page Configuration) ---
 # Sử dụng emoji, layout rộng rãi hơn để hiển thị nội dung tốt hơn
@@ -66,17 +126,18 @@ with col1:
         if not query:
             st.warning("⚠️ Vui lòng nhập câu hỏi pháp lý để bắt đầu!")
         else:
-            with st.spinner("Đang xử lý câu hỏi... AI đang tìm kiếm thông tin..."):
-                try:
-                    res = requests.post(f"{API_URL}/chat", json={"query": query})
-                    if res.status_code == 200:
-                        st.success("✨ Phản hồi của AI:")
-                        # Hiển thị nội dung bằng st.markdown cho định dạng tốt hơn
-                        st.markdown(res.text)
-                    else:
-                        st.error(f"❌ Lỗi API (Mã {res.status_code}): Không thể kết nối hoặc xử lý yêu cầu. Chi tiết: {res.text}")
-                except requests.exceptions.ConnectionError:
-                    st.error(f"❌ Lỗi Kết Nối: Không thể kết nối đến backend FastAPI tại địa chỉ {API_URL}. Vui lòng kiểm tra server!")
+            st.success("✨ Phản hồi của AI:")
+            answer_box = st.empty()
+            answer_box.markdown("⏳ AI đang tìm kiếm thông tin...")
+            try:
+                # Câu trả lời hiện dần theo stream thay vì chờ sau spinner
+                stream_chat({"query": query}, answer_box)
+            except requests.exceptions.ConnectionError:
+                answer_box.error(f"❌ Lỗi Kết Nối: Không thể kết nối đến backend FastAPI tại địa chỉ {API_URL}. Vui lòng kiểm tra server!")
+            except requests.exceptions.Timeout:
+                answer_box.error("❌ Hết thời gian chờ phản hồi từ server. Vui lòng thử lại.")
+            except (requests.exceptions.HTTPError, RuntimeError) as e:
+                answer_box.error(f"❌ Lỗi API: Không thể xử lý yêu cầu. Chi tiết: {e}")
 
     # Thêm một Expander để hiển thị ví dụ
     with st.expander("💡 Gợi ý Chủ đề Pháp lý"):
@@ -99,35 +160,29 @@ with col2:
     uploaded = st.file_uploader("📂 Tải file Hợp đồng/Tài liệu (.docx) lên đây:", type=["docx"])
 
     if uploaded:
-        # --- Quá trình Upload ---
-        with st.spinner("Đang tải file lên server..."):
-            try:
-                files = {"file": (uploaded.name, uploaded.getvalue())}
-                resp = requests.post(f"{API_URL}/upload", files=files)
-
-                if resp.status_code == 200:
-                    file_path = resp.json().get("file_path")
-                    st.success(f"✅ Upload thành công! File đã sẵn sàng để phân tích.")
-
-                    # --- Quá trình Phân tích ---
-                    if st.button("🔍 Bắt Đầu Phân Tích Hợp Đồng"):
-                        with st.spinner("🧠 AI đang đọc và phân tích hợp đồng... Vui lòng đợi trong giây lát."):
-                            data = {
-                                "query": f"Phân tích chuyên sâu hợp đồng: {uploaded.name}", # Cung cấp thêm context cho AI
-                                "file_path": file_path
-                            }
-                            result = requests.post(f"{API_URL}/chat", json=data)
-
-                            if result.status_code == 200:
-                                st.subheader("📊 Kết Quả Phân Tích từ AI")
-                                st.markdown(result.text)
-                            else:
-                                st.error(f"❌ Lỗi Phân Tích API (Mã {result.status_code}): {result.text}")
-                else:
-                    st.error(f"❌ Lỗi Upload API (Mã {resp.status_code}): {resp.text}")
-
-            except requests.exceptions.ConnectionError:
-                st.error(f"❌ Lỗi Kết Nối: Không thể kết nối đến backend FastAPI tại địa chỉ {API_URL}. Vui lòng kiểm tra server!")
+        # --- Quá trình Upload (chỉ một lần cho mỗi file, kể cả khi Streamlit rerun) ---
+        try:
+            with st.spinner("Đang tải file lên server..."):
+                file_path = upload_once(uploaded)
+            st.success(f"✅ Upload thành công! File đã sẵn sàng để phân tích.")
+
+            # --- Quá trình Phân tích ---
+            if st.button("🔍 Bắt Đầu Phân Tích Hợp Đồng"):
+                st.subheader("📊 Kết Quả Phân Tích từ AI")
+                result_box = st.empty()
+                result_box.markdown("🧠 AI đang đọc và phân tích hợp đồng...")
+                data = {
+                    "query": f"Phân tích chuyên sâu hợp đồng: {uploaded.name}", # Cung cấp thêm context cho AI
+                    "file_path": file_path
+                }
+                stream_chat(data, result_box)
+
+        except requests.exceptions.ConnectionError:
+            st.error(f"❌ Lỗi Kết Nối: Không thể kết nối đến backend FastAPI tại địa chỉ {API_URL}. Vui lòng kiểm tra server!")
+        except requests.exceptions.Timeout:
+            st.error("❌ Hết thời gian chờ phản hồi từ server. Vui lòng thử lại.")
+        except (requests.exceptions.HTTPError, RuntimeError) as e:
+            st.error(f"❌ Lỗi API: {e}")
 
 # ================================
 # 3) Footer
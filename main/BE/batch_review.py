@@ -0,0 +1,252 @@
+"""
+Soát xét hàng loạt hợp đồng (data room): nhiều DOCX hoặc file .zip trong một request.
+
+- Mỗi hợp đồng chạy pipeline riêng (đọc -> phân loại TEMPLATE/FINAL -> luật tham chiếu -> LLM)
+  trên thread pool; số lời gọi LLM đồng thời của batch bị giới hạn để không chiếm hết quota
+  của người dùng tương tác.
+- Hợp đồng cùng loại (cùng tiêu đề "HỢP ĐỒNG ...") dùng chung một lần retrieve luật.
+- Kết quả trả về dạng sự kiện theo thứ tự hoàn thành, cuối cùng là bảng tổng hợp điểm + mức rủi ro.
+"""
+from __future__ import annotations
+
+import logging
+import pathlib
+import re
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+from contract_index import contract_title
+from law_structure import normalize_vi
+from metrics import stage_timer
+
+logger = logging.getLogger("LegalAI")
+
+SCORE_PATTERN = re.compile(r"Contract Score\)?\**\s*\|\s*\**\s*(\d{1,3}(?:[.,]\d+)?)", re.IGNORECASE)
+RISK_PATTERN = re.compile(r"Mức độ rủi ro tổng thể:?\**\s*\**\s*(THẤP|TRUNG BÌNH|CAO)", re.IGNORECASE)
+
+
+COPY_CHUNK = 1 << 20
+
+
+def _copy_capped(src: BinaryIO, path: pathlib.Path, limit: int, label: str) -> int:
+    """Chép stream src ra path theo từng khối; vượt `limit` byte -> ValueError (không đọc hết vào RAM)."""
+    written = 0
+    with open(path, "wb") as out:
+        while True:
+            chunk = src.read(COPY_CHUNK)
+            if not chunk:
+                return written
+            written += len(chunk)
+            if written > limit:
+                raise ValueError(f"{label} vượt quá {limit / (1 << 20):.1f} MB.")
+            out.write(chunk)
+
+
+def _zip_docs(zf: zipfile.ZipFile, name: str, max_file_bytes: int, max_ratio: float) -> List[zipfile.ZipInfo]:
+    """Các entry DOCX trong zip; kiểm tra kích thước giải nén + tỷ lệ nén TRƯỚC khi đọc (chống zip bomb)."""
+    infos = []
+    for info in zf.infolist():
+        inner = pathlib.PurePosixPath(info.filename).name
+        if info.is_dir() or not inner.lower().endswith(".docx") or inner.startswith(("~$", ".")):
+            continue
+        if info.file_size > max_file_bytes:
+            raise ValueError(f"{name}/{inner}: giải nén {info.file_size} byte, tối đa {max_file_bytes}.")
+        if info.file_size / max(info.compress_size, 1) > max_ratio:
+            raise ValueError(f"{name}/{inner}: tỷ lệ nén bất thường (> {max_ratio:g}x).")
+        infos.append(info)
+    return infos
+
+
+def save_batch_files(
+    files: List[Tuple[str, BinaryIO]],
+    dest_dir: pathlib.Path,
+    max_files: int,
+    max_file_bytes: int,
+    max_total_bytes: int,
+    max_ratio: float,
+) -> List[pathlib.Path]:
+    """
+    Ghi các file upload (DOCX, hoặc .zip chứa DOCX) vào dest_dir; chỉ giữ tên file (chống zip-slip).
+    files: (tên, file object seek được) - đọc/ghi theo khối, không nạp cả file vào RAM.
+    Mỗi DOCX <= max_file_bytes, tổng <= max_total_bytes (tính theo header zip trước khi giải nén,
+    và theo số byte thực ghi ra đĩa); lỗi -> ValueError, xoá phần đã ghi.
+    """
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    used = set()
+    paths: List[pathlib.Path] = []
+    total = 0
+
+    def target(name: str) -> pathlib.Path:
+        stem, suffix, n = pathlib.Path(name).stem, pathlib.Path(name).suffix, 1
+        while name in used:  # Trùng tên giữa các thư mục trong zip
+            n += 1
+            name = f"{stem}-{n}{suffix}"
+        used.add(name)
+        return dest_dir / name
+
+    def admit(count: int, size: int):
+        nonlocal total
+        if len(paths) + count > max_files:
+            raise ValueError(f"Batch có hơn {max_files} hợp đồng.")
+        total += size
+        if total > max_total_bytes:
+            raise ValueError(f"Tổng dung lượng hợp đồng vượt quá {max_total_bytes / (1 << 20):.1f} MB.")
+
+    try:
+        for name, src in files:
+            if name.lower().endswith(".zip"):
+                with zipfile.ZipFile(src) as zf:
+                    infos = _zip_docs(zf, name, max_file_bytes, max_ratio)
+                    admit(len(infos), sum(i.file_size for i in infos))
+                    for info in infos:
+                        path = target(pathlib.PurePosixPath(info.filename).name)
+                        with zf.open(info) as inner:
+                            # Header zip có thể khai sai: giới hạn cả số byte thực giải nén
+                            _copy_capped(inner, path, info.file_size, path.name)
+                        paths.append(path)
+            elif name.lower().endswith(".docx"):
+                path = target(pathlib.Path(name).name)
+                written = _copy_capped(src, path, max_file_bytes, path.name)
+                admit(1, written)
+                paths.append(path)
+    except (zipfile.BadZipFile, zipfile.LargeZipFile) as e:
+        shutil.rmtree(dest_dir, ignore_errors=True)
+        raise ValueError(f"File zip không hợp lệ: {e}") from e
+    except Exception:
+        shutil.rmtree(dest_dir, ignore_errors=True)
+        raise
+    return paths
+
+
+def contract_kind(text: str) -> Optional[str]:
+    """Khoá nhóm hợp đồng cùng loại: tiêu đề "HỢP ĐỒNG ..." bỏ dấu, bỏ số hiệu. Không có tiêu đề -> None."""
+    title = contract_title(text, "")
+    if not title:
+        return None
+    title = re.split(r"\bsố\b|:|\(", title, maxsplit=1, flags=re.IGNORECASE)[0]
+    kind = re.sub(r"[\d/]+", " ", normalize_vi(title))
+    return " ".join(kind.split()) or None
+
+
+def parse_scores(analysis: str) -> Dict:
+    score = SCORE_PATTERN.search(analysis)
+    risk = RISK_PATTERN.search(analysis)
+    return {
+        "score": float(score.group(1).replace(",", ".")) if score else None,
+        "risk": risk.group(1).upper() if risk else None,
+    }
+
+
+def rollup_table(rows: List[Dict]) -> str:
+    """Bảng markdown tổng hợp, điểm thấp (rủi ro cao) lên trước."""
+    ordered = sorted(rows, key=lambda r: (r.get("score") is None, r.get("score") or 0))
+    lines = [
+        "| Hợp đồng | Loại | Điểm | Mức rủi ro | Ghi chú |",
+        "|----------|------|------|------------|---------|",
+    ]
+    for r in ordered:
+        score = "-" if r.get("score") is None else f"{r['score']:g}"
+        lines.append(
+            f"| {r['file']} | {r.get('status') or '-'} | {score} | {r.get('risk') or '-'} | {r.get('error') or ''} |"
+        )
+    return "\n".join(lines)
+
+
+class BatchReviewer:
+    def __init__(
+        self,
+        read_text: Callable[[pathlib.Path], str],
+        detect_status: Callable[[str], Dict],
+        retrieve_laws: Callable[[str], str],
+        generate: Callable[[str, Dict, str], str],
+        workers: int = 8,
+        llm_concurrency: int = 4,
+    ):
+        self.read_text = read_text
+        self.detect_status = detect_status
+        self.retrieve_laws = retrieve_laws
+        self.generate = generate
+        self.workers = workers
+        # Dùng chung cho mọi batch đang chạy
+        self._llm = threading.BoundedSemaphore(llm_concurrency)
+
+    def _shared_laws(self, cache: Dict[str, Future], lock: threading.Lock, kind: Optional[str], text: str) -> str:
+        """Hợp đồng đầu tiên của mỗi loại retrieve luật; các hợp đồng cùng loại chờ và dùng lại."""
+        if kind is None:
+            return self.retrieve_laws(text)
+        with lock:
+            fut = cache.get(kind)
+            owner = fut is None
+            if owner:
+                fut = cache[kind] = Future()
+        if not owner:
+            return fut.result()
+        try:
+            law_block = self.retrieve_laws(text)
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        fut.set_result(law_block)
+        return law_block
+
+    def _review_one(self, path: pathlib.Path, cache: Dict[str, Future], lock: threading.Lock) -> Dict:
+        started = time.perf_counter()
+        row: Dict = {"file": path.name}
+        try:
+            with stage_timer("batch_contract"):
+                text = self.read_text(path)
+                if not text:
+                    raise ValueError("File rỗng hoặc không đọc được nội dung.")
+                kind = contract_kind(text)
+                with self._llm:  # Rule-based không chắc chắn thì gọi LLM
+                    status_info = self.detect_status(text)
+                law_block = self._shared_laws(cache, lock, kind, text)
+                with self._llm:
+                    analysis = self.generate(text, status_info, law_block)
+            row.update(status=status_info.get("status"), kind=kind, analysis=analysis, **parse_scores(analysis))
+        except Exception as e:
+            logger.warning(f"⚠️ Batch review lỗi ở {path.name}: {e}")
+            row.update(status=None, kind=None, analysis="", score=None, risk=None, error=str(e))
+        row["seconds"] = round(time.perf_counter() - started, 2)
+        return row
+
+    def review(self, paths: List[pathlib.Path], batch_id: Optional[str] = None) -> Iterator[Dict]:
+        """Sinh sự kiện: start -> result (theo thứ tự xong) -> summary."""
+        batch_id = batch_id or uuid.uuid4().hex[:12]
+        started = time.perf_counter()
+        cache: Dict[str, Future] = {}
+        lock = threading.Lock()
+        rows: List[Dict] = []
+        logger.info(f"📦 Batch review {batch_id}: {len(paths)} hợp đồng")
+        yield {"type": "start", "batch_id": batch_id, "contracts": [p.name for p in paths]}
+
+        pool = ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(paths))), thread_name_prefix="batch")
+        try:
+            futures = [pool.submit(self._review_one, p, cache, lock) for p in paths]
+            for fut in as_completed(futures):
+                row = fut.result()
+                rows.append(row)
+                yield {"type": "result", "batch_id": batch_id, **row}
+        finally:
+            # Client ngắt kết nối -> huỷ các hợp đồng chưa bắt đầu, đợi hợp đồng đang chạy
+            # (caller giữ slot admission tới lúc này nên không còn việc LLM chạy ngoài sức chứa)
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        summary_rows = [{k: v for k, v in r.items() if k != "analysis"} for r in rows]
+        elapsed = time.perf_counter() - started
+        logger.info(
+            f"📦 Batch review {batch_id} xong: {len(rows)} hợp đồng, {len(cache)} loại hợp đồng, {elapsed:.1f}s"
+        )
+        yield {
+            "type": "summary",
+            "batch_id": batch_id,
+            "rows": summary_rows,
+            "table": rollup_table(summary_rows),
+            "contract_kinds": len(cache),  # = số lần retrieve luật dùng chung
+            "seconds": round(elapsed, 2),
+        }
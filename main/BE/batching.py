@@ -0,0 +1,146 @@
+"""
+Micro-batching cho embedding và rerank.
+Gom các lời gọi nhỏ từ nhiều request đồng thời thành batch chung,
+chạy model một lần rồi trả kết quả về đúng người gọi.
+"""
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, List, Optional, Sequence
+
+from metrics import BATCH_QUEUE_WAIT, BATCH_SIZE
+from profiling import Profile, current_profile, serve_scope
+
+logger = logging.getLogger("LegalAI")
+
+
+@dataclass
+class _Job:
+    items: List[Any]
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=time.perf_counter)
+    profile: Optional[Profile] = field(default_factory=current_profile)  # Request gửi job đang được profile
+
+
+class MicroBatcher:
+    """
+    Một worker thread duy nhất cho mỗi model:
+    - Lấy job đầu tiên trong hàng đợi, gom thêm job cho tới khi đủ `max_batch_size`
+      hoặc hết `max_wait_ms`.
+    - Khi tải thấp (batch trước chỉ có 1 job) thì chạy ngay, không chờ,
+      để p50 không bị cộng thêm `max_wait_ms`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        batch_fn: Callable[[List[Any]], Sequence[Any]],
+        max_batch_size: int = 64,
+        max_wait_ms: float = 5.0,
+    ):
+        self.name = name
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue: "queue.Queue[_Job]" = queue.Queue()
+        self._worker: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._last_batch_jobs = 0
+
+    def submit(self, items: Sequence[Any]) -> List[Any]:
+        """Gửi một nhóm item và chờ kết quả (cùng thứ tự)."""
+        items = list(items)
+        if not items:
+            return []
+        self._ensure_worker()
+        job = _Job(items=items)
+        self._queue.put(job)
+        return job.future.result()
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name=f"batcher-{self.name}", daemon=True
+                )
+                self._worker.start()
+
+    def _collect(self) -> List[_Job]:
+        jobs = [self._queue.get()]
+        size = len(jobs[0].items)
+
+        # Tải thấp -> không chờ thêm; tải cao -> chờ tối đa max_wait để lấp đầy batch
+        wait = self.max_wait if self._last_batch_jobs > 1 else 0.0
+        deadline = time.perf_counter() + wait
+
+        while size < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                job = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            jobs.append(job)
+            size += len(job.items)
+        return jobs
+
+    def _run(self):
+        while True:
+            jobs = self._collect()
+            self._last_batch_jobs = len(jobs)
+
+            started = time.perf_counter()
+            batch: List[Any] = []
+            for job in jobs:
+                BATCH_QUEUE_WAIT.labels(self.name).observe(started - job.enqueued_at)
+                batch.extend(job.items)
+            BATCH_SIZE.labels(self.name).observe(len(batch))
+
+            try:
+                # Batch có job của request đang profile -> worker hiện trong flamegraph của request đó
+                with serve_scope((job.profile for job in jobs), f"batch_{self.name}"):
+                    results = self.batch_fn(batch)
+            except Exception as e:
+                logger.error(f"[{self.name}] Batch Error: {e}")
+                for job in jobs:
+                    job.future.set_exception(e)
+                continue
+
+            offset = 0
+            for job in jobs:
+                n = len(job.items)
+                job.future.set_result(results[offset:offset + n])
+                offset += n
+
+
+class InferenceScheduler:
+    """
+    Điểm vào chung cho embedding query và cross-encoder rerank.
+    Mọi request đồng thời dùng chung 2 batcher này.
+    """
+
+    def __init__(self, embedder, cross_encoder, max_batch_size: int = 64, max_wait_ms: float = 5.0):
+        self.embed_batcher = MicroBatcher(
+            "embed",
+            lambda texts: embedder.encode(texts, convert_to_numpy=True, batch_size=max_batch_size),
+            max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms,
+        )
+        self.rerank_batcher = MicroBatcher(
+            "rerank",
+            lambda pairs: cross_encoder.predict(pairs, batch_size=max_batch_size),
+            max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms,
+        )
+
+    def encode(self, texts: Sequence[str]):
+        return self.embed_batcher.submit(texts)
+
+    def rerank(self, pairs: Sequence[Sequence[str]]):
+        return self.rerank_batcher.submit(pairs)
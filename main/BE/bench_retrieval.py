@@ -0,0 +1,194 @@
+"""
+Benchmark retrieval offline trên bộ luật trong data_laws (không gọi Gemini).
+
+Mỗi câu hỏi trong benchmarks/retrieval_questions.json có sẵn sub-queries cố định
+(thay cho bước CoT) và danh sách Điều luật kỳ vọng. Kết quả ghi ra JSON để so sánh
+giữa các lần thay đổi index / reranker.
+
+Chạy:
+    python bench_retrieval.py                 # build index mới vào thư mục tạm
+    python bench_retrieval.py --no-build      # dùng index_laws có sẵn
+    python bench_retrieval.py --out result.json
+"""
+from __future__ import annotations
+
+import argparse
+import datetime as dt
+import json
+import pathlib
+import re
+import sys
+import tempfile
+import time
+import unicodedata
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import test as engine
+from metrics import collect_spans
+
+QUESTIONS_PATH = engine.BASE_DIR / "benchmarks" / "retrieval_questions.json"
+RESULTS_DIR = engine.BASE_DIR / "benchmarks" / "results"
+RECALL_KS = (1, 3, 5, 10)
+
+ARTICLE_RE = re.compile(r"Điều\s+(\d+)[.:]")
+
+
+def _nfc(s: str) -> str:
+    return unicodedata.normalize("NFC", s)
+
+
+def _rss_mb() -> Optional[float]:
+    """RSS hiện tại (MB). psutil nếu có, nếu không thì đọc /proc (Linux)."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 / 1024
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        import resource
+        return pages * resource.getpagesize() / 1024 / 1024
+    except (OSError, ImportError):
+        return None
+
+
+def _peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        return None
+
+
+def _chunk_key(chunk) -> tuple:
+    m = ARTICLE_RE.search(chunk.text)
+    article = int(m.group(1)) if m else None
+    return _nfc(pathlib.Path(chunk.source_file).stem), article
+
+
+def _is_match(key: tuple, expected: Dict) -> bool:
+    source, article = key
+    return source.startswith(_nfc(expected["source"])) and article == expected["article"]
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    arr = np.asarray(values) * 1000.0
+    return {
+        "count": len(values),
+        "p50_ms": round(float(np.percentile(arr, 50)), 3),
+        "p90_ms": round(float(np.percentile(arr, 90)), 3),
+        "p99_ms": round(float(np.percentile(arr, 99)), 3),
+        "mean_ms": round(float(arr.mean()), 3),
+    }
+
+
+def run_question(store: engine.LawVectorStore, item: Dict, stage_times: Dict[str, List[float]]) -> Dict:
+    """Chạy sub-queries giống RAGRetrievalAgent rồi chấm điểm danh sách đã gộp."""
+    ranked = []
+    seen = set()
+    for q in item["sub_queries"]:
+        with collect_spans() as spans:
+            t0 = time.perf_counter()
+            hits = store.hybrid_search(q, top_k=30, final_k=3)
+            stage_times.setdefault("hybrid_search", []).append(time.perf_counter() - t0)
+        for stage, seconds in spans:
+            stage_times.setdefault(stage, []).append(seconds)
+        for h in hits:
+            if h.text not in seen:
+                seen.add(h.text)
+                ranked.append(_chunk_key(h))
+
+    expected = item["expected"]
+    first_rank = None
+    for rank, key in enumerate(ranked, start=1):
+        if any(_is_match(key, e) for e in expected):
+            first_rank = rank
+            break
+
+    recall = {}
+    for k in RECALL_KS:
+        found = sum(1 for e in expected if any(_is_match(key, e) for key in ranked[:k]))
+        recall[f"recall@{k}"] = found / len(expected)
+
+    return {
+        "id": item["id"],
+        "first_relevant_rank": first_rank,
+        "reciprocal_rank": 1.0 / first_rank if first_rank else 0.0,
+        **recall,
+        "retrieved": [f"{s} | Điều {a}" for s, a in ranked],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline retrieval benchmark (không dùng Gemini)")
+    parser.add_argument("--questions", type=pathlib.Path, default=QUESTIONS_PATH)
+    parser.add_argument("--no-build", action="store_true", help="Load index_laws có sẵn thay vì build lại")
+    parser.add_argument("--out", type=pathlib.Path, default=None)
+    args = parser.parse_args()
+
+    questions = json.loads(args.questions.read_text(encoding="utf-8"))
+    rss_start = _rss_mb()
+
+    build_info: Dict = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        store = engine.LawVectorStore(index_dir=engine.INDEX_DIR if args.no_build else pathlib.Path(tmp))
+        rss_models = _rss_mb()
+
+        t0 = time.perf_counter()
+        if args.no_build:
+            if not store.load():  # Không có bundle -> benchmark index rỗng, recall/MRR = 0 vô nghĩa
+                sys.exit(f"Không có index bundle trong {store.index_dir} để benchmark (chạy không kèm --no-build).")
+            build_info["mode"] = "load"
+        else:
+            store.build()
+            build_info["mode"] = "build"
+        build_info["seconds"] = round(time.perf_counter() - t0, 3)
+        build_info["chunks"] = len(store.chunks)
+        if store.build_stats:
+            build_info["embed"] = store.build_stats
+        rss_index = _rss_mb()
+
+        stage_times: Dict[str, List[float]] = {}
+        per_question = [run_question(store, q, stage_times) for q in questions]
+
+    quality = {"mrr": round(float(np.mean([r["reciprocal_rank"] for r in per_question])), 4)}
+    for k in RECALL_KS:
+        quality[f"recall@{k}"] = round(float(np.mean([r[f"recall@{k}"] for r in per_question])), 4)
+
+    result = {
+        "timestamp": dt.datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "embed_model": engine.EMBED_MODEL_NAME,
+            "rerank_model": engine.RERANK_MODEL_NAME,
+            "fusion_method": engine.FUSION_METHOD,
+            "rerank_top_n": engine.RERANK_TOP_N,
+            "rerank_skip_margin": engine.RERANK_SKIP_MARGIN,
+            "questions": len(questions),
+        },
+        "index": build_info,
+        "memory_mb": {
+            "rss_start": rss_start,
+            "rss_after_models": rss_models,
+            "rss_after_index": rss_index,
+            "peak_rss": _peak_rss_mb(),
+        },
+        "quality": quality,
+        "latency": {stage: _percentiles(v) for stage, v in sorted(stage_times.items())},
+        "per_question": per_question,
+    }
+
+    out = args.out
+    if out is None:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        out = RESULTS_DIR / f"retrieval-{dt.datetime.now():%Y%m%d-%H%M%S}.json"
+    out.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    print(json.dumps({"index": build_info, "quality": quality}, ensure_ascii=False, indent=2))
+    print(f"💾 Kết quả: {out}")
+
+
+if __name__ == "__main__":
+    main()
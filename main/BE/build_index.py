@@ -0,0 +1,69 @@
+"""
+Build index bundle offline, không cần start API.
+
+    python build_index.py                       # build toàn bộ data_laws -> index_laws/bundles/<version>
+    python build_index.py --sync --incremental  # đồng bộ GCS, chỉ encode lại file đổi so với bundle hiện tại
+    python build_index.py --no-activate         # build nhưng chưa trỏ CURRENT (để kiểm tra trước khi deploy)
+    python build_index.py --sync --publish      # build rồi đẩy bundle lên bucket (GCS_BUNDLES_PREFIX) cho các node
+
+Server (sever.py) chỉ load bundle CURRENT; lệch model/tham số chunking -> từ chối start.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import pathlib
+import sys
+import time
+
+import test as engine
+from index_bundle import IndexBundleError, current_bundle
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build index bundle cho AI Legal Assistant")
+    parser.add_argument("--index-dir", type=pathlib.Path, default=engine.INDEX_DIR)
+    parser.add_argument("--data-dir", type=pathlib.Path, default=engine.DATA_LAWS_DIR)
+    parser.add_argument("--sync", action="store_true", help="Đồng bộ data_laws từ GCS trước khi build")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Dùng lại chunk + vector của bundle hiện tại cho file có hash không đổi")
+    parser.add_argument("--no-activate", action="store_true", help="Không cập nhật CURRENT")
+    parser.add_argument("--publish", action="store_true",
+                        help="Upload bundle lên bucket và trỏ LATEST vào (node phục vụ kéo về khi start)")
+    args = parser.parse_args()
+
+    if args.sync:
+        engine.download_law_docs_from_gcs()
+
+    started = time.perf_counter()
+    store = engine.LawVectorStore(index_dir=args.index_dir, data_dir=args.data_dir)
+    changed = None
+    if args.incremental:
+        try:
+            # Chỉ bundle (có hash file nguồn) mới dùng lại được; index kiểu cũ -> build toàn bộ
+            if current_bundle(args.index_dir) is not None and store.load():
+                changed = set()
+        except IndexBundleError as e:
+            engine.logger.warning(f"⚠️ Không dùng lại được bundle hiện tại -> build toàn bộ.\n{e}")
+
+    store.build(changed, activate=not args.no_activate)
+    if not len(store.chunks):
+        print("❌ Không build được index (data_laws rỗng?)", file=sys.stderr)
+        sys.exit(1)
+
+    published = engine.publish_index_bundle(args.index_dir / "bundles" / store.version) if args.publish else None
+
+    current = current_bundle(args.index_dir)
+    print(json.dumps({
+        "version": store.version,
+        "bundle": str(args.index_dir / "bundles" / store.version),
+        "active": current is not None and current.name == store.version,
+        "chunks": len(store.chunks),
+        "embed": store.build_stats,
+        "published": published,
+        "seconds": round(time.perf_counter() - started, 3),
+    }, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
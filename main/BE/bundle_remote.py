@@ -0,0 +1,206 @@
+"""
+Phân phối index bundle qua bucket (cùng bucket với file luật, prefix riêng).
+
+    <GCS_BUNDLES_PREFIX>/
+        LATEST                      # version mới nhất (ghi sau cùng khi publish)
+        <version>/
+            manifest.json laws.faiss keyword.npz chunks.npz articles.json ...
+            CHECKSUMS.json          # {file: {sha256, size}}; có file này = bundle đã upload đủ
+
+- Một máy build (build_index.py --publish) đẩy bundle lên bucket.
+- Node phục vụ kéo bundle mới nhất khớp cấu hình (model, số chiều, chunking), kiểm sha256 từng
+  file, rồi load thẳng - không cần tải DOCX và encode lại. Không có bundle khớp -> build local.
+- Bundle cũ trên bucket không bị xoá tự động (node khác có thể đang tải); dọn bằng lifecycle rule.
+
+Test không cần GCS thật: GCS_BUCKET_NAME=file:///duong/dan/thu_muc như law_sync.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import pathlib
+import shutil
+import time
+from typing import Dict, List, Optional
+
+from index_bundle import (
+    MANIFEST_NAME, IndexBundleError, activate_bundle, bundles_root, check_manifest, file_sha256,
+)
+from law_sync import GCSSource, LocalDirSource
+
+logger = logging.getLogger("LegalAI")
+
+LATEST_NAME = "LATEST"
+CHECKSUMS_NAME = "CHECKSUMS.json"
+
+
+class LocalBundleStore(LocalDirSource):
+    """Thư mục local đóng vai bucket chứa bundle."""
+
+    def put(self, key: str, src: pathlib.Path):
+        dest = self.root / key
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(f".{dest.name}.part")
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
+
+    def put_text(self, key: str, text: str):
+        dest = self.root / key
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(f".{dest.name}.part")
+        tmp.write_text(text, encoding="utf-8")
+        os.replace(tmp, dest)
+
+    def get(self, key: str, dest: pathlib.Path):
+        shutil.copyfile(self.root / key, dest)
+
+    def read_text(self, key: str) -> Optional[str]:
+        path = self.root / key
+        return path.read_text(encoding="utf-8") if path.exists() else None
+
+    def versions(self) -> List[str]:
+        if not self.root.exists():
+            return []
+        return [p.name for p in self.root.iterdir() if p.is_dir() and not p.name.startswith(".")]
+
+
+class GCSBundleStore(GCSSource):
+    def _key(self, key: str) -> str:
+        return f"{self.prefix.rstrip('/')}/{key}" if self.prefix else key
+
+    def put(self, key: str, src: pathlib.Path):
+        self.bucket.blob(self._key(key)).upload_from_filename(str(src))
+
+    def put_text(self, key: str, text: str):
+        self.bucket.blob(self._key(key)).upload_from_string(text.encode("utf-8"))
+
+    def get(self, key: str, dest: pathlib.Path):
+        self.bucket.blob(self._key(key)).download_to_filename(str(dest))
+
+    def read_text(self, key: str) -> Optional[str]:
+        blob = self.bucket.blob(self._key(key))
+        return blob.download_as_bytes().decode("utf-8") if blob.exists() else None
+
+    def versions(self) -> List[str]:
+        base = self._key("")
+        it = self.bucket.list_blobs(prefix=base, delimiter="/")
+        list(it)  # prefixes chỉ có sau khi duyệt hết trang
+        return [p[len(base):].strip("/") for p in it.prefixes]
+
+
+def make_bundle_store(bucket: str, prefix: str = "", key_path: Optional[pathlib.Path] = None):
+    if bucket.startswith("file://"):
+        return LocalBundleStore(pathlib.Path(bucket[len("file://"):]) / prefix)
+    return GCSBundleStore(bucket, prefix, key_path)
+
+
+def _bundle_files(bundle_dir: pathlib.Path) -> List[pathlib.Path]:
+    return sorted(p for p in bundle_dir.rglob("*") if p.is_file() and p.name != CHECKSUMS_NAME)
+
+
+def publish_bundle(store, bundle_dir: pathlib.Path, set_latest: bool = True) -> Dict:
+    """Upload bundle (CHECKSUMS.json sau cùng, rồi LATEST). Bundle đã có trên bucket -> chỉ cập nhật LATEST."""
+    bundle_dir = pathlib.Path(bundle_dir)
+    version = bundle_dir.name
+    started = time.perf_counter()
+    uploaded = 0
+    size = 0
+    if store.read_text(f"{version}/{CHECKSUMS_NAME}") is None:
+        checksums = {}
+        for path in _bundle_files(bundle_dir):
+            rel = path.relative_to(bundle_dir).as_posix()
+            checksums[rel] = {"sha256": file_sha256(path), "size": path.stat().st_size}
+            store.put(f"{version}/{rel}", path)
+            uploaded += 1
+            size += checksums[rel]["size"]
+        store.put_text(f"{version}/{CHECKSUMS_NAME}", json.dumps(checksums, indent=1, sort_keys=True))
+    else:
+        logger.info(f"ℹ️ Bundle {version} đã có trên bucket -> bỏ qua upload.")
+    if set_latest:
+        store.put_text(LATEST_NAME, version)
+    seconds = time.perf_counter() - started
+    logger.info(f"☁️ Publish bundle {version}: {uploaded} file, {size / 1e6:.1f} MB ({seconds:.1f}s)")
+    return {"version": version, "files": uploaded, "bytes": size, "seconds": round(seconds, 3)}
+
+
+def _remote_manifest(store, version: str) -> Optional[Dict]:
+    # Chỉ tính bundle đã upload đủ (có CHECKSUMS.json)
+    if store.read_text(f"{version}/{CHECKSUMS_NAME}") is None:
+        return None
+    text = store.read_text(f"{version}/{MANIFEST_NAME}")
+    try:
+        return json.loads(text) if text else None
+    except ValueError:
+        return None
+
+
+def _compatible(manifest: Dict, expected: Dict) -> bool:
+    try:
+        check_manifest(manifest, expected)
+        return True
+    except IndexBundleError as e:
+        logger.info(f"↪️ Bỏ qua bundle {manifest.get('version')} trên bucket: {e}")
+        return False
+
+
+def find_remote_bundle(store, expected: Dict) -> Optional[str]:
+    """LATEST nếu khớp cấu hình; không thì bundle mới nhất (created_at) khớp cấu hình."""
+    latest = (store.read_text(LATEST_NAME) or "").strip()
+    if latest:
+        manifest = _remote_manifest(store, latest)
+        if manifest is not None and _compatible(manifest, expected):
+            return latest
+    candidates = []
+    for version in store.versions():
+        if version == latest:
+            continue
+        manifest = _remote_manifest(store, version)
+        if manifest is not None and _compatible(manifest, expected):
+            candidates.append((manifest.get("created_at", 0), version))
+    return max(candidates)[1] if candidates else None
+
+
+def pull_bundle(store, index_dir: pathlib.Path, expected: Dict) -> Optional[str]:
+    """
+    Tải bundle mới nhất khớp cấu hình về index_dir/bundles/<version>, kiểm sha256, trỏ CURRENT vào.
+    Trả về version, hoặc None nếu bucket không có bundle khớp.
+    """
+    started = time.perf_counter()
+    version = find_remote_bundle(store, expected)
+    if version is None:
+        return None
+    root = bundles_root(index_dir)
+    final = root / version
+    if (final / MANIFEST_NAME).exists():
+        activate_bundle(index_dir, version)
+        logger.info(f"⚡ Bundle {version} đã có sẵn local.")
+        return version
+
+    checksums = json.loads(store.read_text(f"{version}/{CHECKSUMS_NAME}"))
+    root.mkdir(parents=True, exist_ok=True)
+    tmp = root / f".pull-{version}-{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir()
+    try:
+        for rel, meta in checksums.items():
+            dest = tmp / rel
+            if tmp.resolve() not in dest.resolve().parents:
+                raise IndexBundleError(f"Đường dẫn file lạ trong CHECKSUMS của {version}: {rel}")
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            store.get(f"{version}/{rel}", dest)
+            if dest.stat().st_size != meta["size"] or file_sha256(dest) != meta["sha256"]:
+                raise IndexBundleError(f"Bundle {version}: {rel} không khớp checksum")
+        manifest = json.loads((tmp / MANIFEST_NAME).read_text(encoding="utf-8"))
+        check_manifest(manifest, expected)
+        os.replace(tmp, final)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    activate_bundle(index_dir, version)
+    size = sum(meta["size"] for meta in checksums.values())
+    logger.info(
+        f"☁️ Đã kéo bundle {version} ({len(checksums)} file, {size / 1e6:.1f} MB, "
+        f"{time.perf_counter() - started:.1f}s)"
+    )
+    return version
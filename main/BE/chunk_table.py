@@ -0,0 +1,223 @@
+"""
+Bảng chunk dạng cột (columnar) thay cho list[LawChunk]:
+- source_file được intern thành id (int32), số Điều và vị trí text là cột int32,
+- text nằm chung một buffer liên tục, chia block (có thể nén zstd từng block),
+- tiền tố "[NGUỒN: ...]" không lưu lặp lại mà ghép lại khi đọc,
+- LawChunk (__slots__) chỉ được tạo cho các kết quả trả về.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import pathlib
+import re
+from array import array
+from functools import lru_cache
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("LegalAI")
+
+ARTICLE_NO = re.compile(r"^Điều\s+(\d+)")
+
+
+class LawChunk:
+    """View gọn của một chunk (chỉ tạo cho hit được trả về)."""
+    __slots__ = ("text", "source_file", "article")
+
+    def __init__(self, text: str, source_file: str, article: int = -1):
+        self.text = text
+        self.source_file = source_file
+        self.article = article
+
+    def __repr__(self) -> str:
+        return f"LawChunk(source_file={self.source_file!r}, article={self.article}, text={self.text[:40]!r}...)"
+
+    def __eq__(self, other) -> bool:
+        return (
+            isinstance(other, LawChunk)
+            and self.text == other.text
+            and self.source_file == other.source_file
+        )
+
+    def __hash__(self) -> int:
+        return hash((self.source_file, self.text))
+
+
+def _prefix(source_file: str) -> str:
+    return f"[NGUỒN: {source_file}]\n"
+
+
+def _load_zstd():
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        logger.warning("⚠️ Chưa cài zstandard -> lưu chunk không nén.")
+        return None
+
+
+class ChunkTableBuilder:
+    def __init__(self, compression: str = "none", block_bytes: int = 64 * 1024, level: int = 3):
+        self._zstd = _load_zstd() if compression == "zstd" else None
+        self.compression = "zstd" if self._zstd else "none"
+        self._compressor = self._zstd.ZstdCompressor(level=level) if self._zstd else None
+        self.block_bytes = block_bytes
+        self._sources: List[str] = []
+        self._source_ids = {}
+        self._cols = {name: array("i") for name in ("source", "article", "block", "offset", "length")}
+        self._prefixed = bytearray()
+        self._blocks: List[bytes] = []
+        self._current = bytearray()
+
+    def __len__(self) -> int:
+        return len(self._cols["source"])
+
+    def _seal(self):
+        if not self._current:
+            return
+        data = bytes(self._current)
+        self._blocks.append(self._compressor.compress(data) if self._compressor else data)
+        self._current = bytearray()
+
+    def append(self, text: str, source_file: str):
+        sid = self._source_ids.get(source_file)
+        if sid is None:
+            sid = self._source_ids[source_file] = len(self._sources)
+            self._sources.append(source_file)
+
+        prefix = _prefix(source_file)
+        prefixed = text.startswith(prefix)
+        body = text[len(prefix):] if prefixed else text
+        m = ARTICLE_NO.match(body)
+
+        data = body.encode("utf-8")
+        if self._current and len(self._current) + len(data) > self.block_bytes:
+            self._seal()
+        cols = self._cols
+        cols["source"].append(sid)
+        cols["article"].append(int(m.group(1)) if m else -1)
+        cols["block"].append(len(self._blocks))
+        cols["offset"].append(len(self._current))
+        cols["length"].append(len(data))
+        self._prefixed.append(prefixed)
+        self._current.extend(data)
+
+    def build(self) -> "ChunkTable":
+        self._seal()
+        block_offsets = np.zeros(len(self._blocks) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in self._blocks], out=block_offsets[1:])
+        cols = {k: np.frombuffer(v, dtype=np.int32).copy() if len(v) else np.zeros(0, np.int32)
+                for k, v in self._cols.items()}
+        return ChunkTable(
+            sources=self._sources,
+            source_ids=cols["source"],
+            articles=cols["article"],
+            blocks=cols["block"],
+            offsets=cols["offset"],
+            lengths=cols["length"],
+            prefixed=np.frombuffer(bytes(self._prefixed), dtype=np.bool_).copy(),
+            buf=b"".join(self._blocks),
+            block_offsets=block_offsets,
+            compression=self.compression,
+        )
+
+
+class ChunkTable:
+    def __init__(
+        self,
+        sources: Optional[List[str]] = None,
+        source_ids: Optional[np.ndarray] = None,
+        articles: Optional[np.ndarray] = None,
+        blocks: Optional[np.ndarray] = None,
+        offsets: Optional[np.ndarray] = None,
+        lengths: Optional[np.ndarray] = None,
+        prefixed: Optional[np.ndarray] = None,
+        buf: bytes = b"",
+        block_offsets: Optional[np.ndarray] = None,
+        compression: str = "none",
+        cache_blocks: int = 64,
+    ):
+        empty = np.zeros(0, dtype=np.int32)
+        self.sources = sources or []
+        self.source_ids = source_ids if source_ids is not None else empty
+        self.articles = articles if articles is not None else empty
+        self.blocks = blocks if blocks is not None else empty
+        self.offsets = offsets if offsets is not None else empty
+        self.lengths = lengths if lengths is not None else empty
+        self.prefixed = prefixed if prefixed is not None else np.zeros(0, dtype=np.bool_)
+        self.buf = buf
+        self.block_offsets = block_offsets if block_offsets is not None else np.zeros(1, dtype=np.int64)
+        self.compression = compression
+        if compression == "zstd":
+            dctx = _load_zstd().ZstdDecompressor()
+            # Giải nén block nóng một lần; lru_cache thread-safe
+            self._block = lru_cache(maxsize=cache_blocks)(
+                lambda b: dctx.decompress(self._raw_block(b))
+            )
+        else:
+            self._block = self._raw_block
+
+    def _raw_block(self, b: int) -> memoryview:
+        return memoryview(self.buf)[self.block_offsets[b]:self.block_offsets[b + 1]]
+
+    def __len__(self) -> int:
+        return len(self.source_ids)
+
+    def source(self, i: int) -> str:
+        return self.sources[self.source_ids[i]]
+
+    def text(self, i: int) -> str:
+        off = int(self.offsets[i])
+        body = bytes(self._block(int(self.blocks[i]))[off:off + int(self.lengths[i])]).decode("utf-8")
+        return _prefix(self.source(i)) + body if self.prefixed[i] else body
+
+    def __getitem__(self, i: int) -> LawChunk:
+        return LawChunk(self.text(i), self.source(i), int(self.articles[i]))
+
+    def __iter__(self) -> Iterator[LawChunk]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def rows(self) -> Iterator[Tuple[str, str]]:
+        """(text, source_file) cho từng chunk, không tạo object LawChunk."""
+        for i in range(len(self)):
+            yield self.text(i), self.source(i)
+
+    def ids_by_source(self) -> dict:
+        """{source_file: np.ndarray id chunk}."""
+        order = np.argsort(self.source_ids, kind="stable")
+        sids = self.source_ids[order]
+        bounds = np.flatnonzero(np.diff(sids)) + 1
+        return {
+            self.sources[int(group_sids[0])]: group.astype(np.int64)
+            for group, group_sids in zip(np.split(order, bounds), np.split(sids, bounds))
+            if len(group)
+        }
+
+    @property
+    def nbytes(self) -> int:
+        cols = (self.source_ids, self.articles, self.blocks, self.offsets, self.lengths, self.prefixed)
+        return len(self.buf) + sum(c.nbytes for c in cols) + self.block_offsets.nbytes
+
+    def save(self, path: pathlib.Path):
+        np.savez(
+            str(path),
+            sources=np.array([json.dumps(self.sources, ensure_ascii=False)]),
+            source_ids=self.source_ids, articles=self.articles, blocks=self.blocks,
+            offsets=self.offsets, lengths=self.lengths, prefixed=self.prefixed,
+            buf=np.frombuffer(self.buf, dtype=np.uint8), block_offsets=self.block_offsets,
+            compression=np.array([self.compression]),
+        )
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> "ChunkTable":
+        with np.load(str(path), allow_pickle=False) as data:
+            return cls(
+                sources=json.loads(str(data["sources"][0])),
+                source_ids=data["source_ids"], articles=data["articles"], blocks=data["blocks"],
+                offsets=data["offsets"], lengths=data["lengths"], prefixed=data["prefixed"],
+                buf=data["buf"].tobytes(), block_offsets=data["block_offsets"],
+                compression=str(data["compression"][0]),
+            )
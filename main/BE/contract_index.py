@@ -0,0 +1,309 @@
+"""
+Index toàn bộ kho hợp đồng đã upload (contracts/) để hỏi xuyên hợp đồng:
+"hợp đồng nào không giới hạn mức phạt", "tìm mọi điều khoản bảo mật"...
+
+- Mỗi hợp đồng tách thành điều khoản ("Điều N" / "ĐIỀU N:" / "Article N"), điều dài chia nhỏ.
+- SQLite là nguồn dữ liệu gốc: metadata hợp đồng, điều khoản + vector, FTS5 cho keyword.
+- Vector nằm trong FAISS IndexIDMap2 (id = id điều khoản) dựng lại từ SQLite khi start.
+- Cập nhật incremental theo từng file: hash nội dung file không đổi -> bỏ qua,
+  đổi -> xoá điều khoản cũ của file đó rồi thêm lại.
+"""
+from __future__ import annotations
+
+import logging
+import pathlib
+import re
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+
+from index_bundle import file_sha256
+from metrics import stage_timer
+
+logger = logging.getLogger("LegalAI")
+
+CLAUSE_HEADING = re.compile(r"^(?:điều|article)\s+(\d+)\s*[.:\-–]?\s*(.*)$", re.IGNORECASE)
+FTS_TOKEN = re.compile(r"\w+", re.UNICODE)
+CONTRACT_COLUMNS = ("filename", "path", "file_hash", "title", "clauses", "chars", "indexed_at")
+
+
+def split_clauses(text: str, max_chars: int = 1500) -> List[Tuple[int, str, str]]:
+    """
+    [(số điều, tiêu đề, nội dung)]. Phần trước điều đầu tiên (thông tin các bên...) là điều 0.
+    Điều dài hơn max_chars được chia theo dòng, mỗi phần giữ nguyên tiêu đề.
+    """
+    groups: List[Tuple[int, str, List[str]]] = [(0, "Phần mở đầu", [])]
+    for line in text.split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        m = CLAUSE_HEADING.match(line)
+        if m:
+            groups.append((int(m.group(1)), line, []))
+        else:
+            groups[-1][2].append(line)
+
+    clauses = []
+    for no, heading, lines in groups:
+        part: List[str] = []
+        size = 0
+        for line in lines:
+            if part and size + len(line) > max_chars:
+                clauses.append((no, heading, "\n".join(part)))
+                part, size = [], 0
+            part.append(line)
+            size += len(line) + 1
+        if part:
+            clauses.append((no, heading, "\n".join(part)))
+        elif no:
+            clauses.append((no, heading, ""))  # Điều chỉ có tiêu đề vẫn tìm được theo tên
+    return clauses
+
+
+def contract_title(text: str, default: str) -> str:
+    """Dòng "HỢP ĐỒNG ..." đầu tiên (bỏ qua quốc hiệu / tiêu ngữ), không có thì lấy tên file."""
+    lines = [line.strip() for line in text.split("\n") if line.strip()]
+    title = next((line for line in lines[:30] if line.upper().startswith("HỢP ĐỒNG")), default)
+    return title[:200]
+
+
+def _fts_query(query: str) -> str:
+    tokens = list(dict.fromkeys(t.lower() for t in FTS_TOKEN.findall(query)))
+    return " OR ".join(f'"{t}"' for t in tokens)
+
+
+class ContractIndex:
+    def __init__(
+        self,
+        db_path: pathlib.Path,
+        encode: Callable[[List[str]], np.ndarray],
+        dim: int,
+        read_text: Callable[[pathlib.Path], str],
+        fuse: Callable[[List[Tuple[int, float]], List[Tuple[int, float]]], List[Tuple[int, float]]],
+        encode_query: Optional[Callable[[List[str]], np.ndarray]] = None,
+        max_clause_chars: int = 1500,
+    ):
+        """
+        encode: embed điều khoản lúc index; encode_query: embed câu hỏi (mặc định = encode).
+        fuse: gộp [(id, score)] vector + keyword (dùng chung fuse_rankings với index luật).
+        """
+        self.db_path = pathlib.Path(db_path)
+        self.encode = encode
+        self.encode_query = encode_query or encode
+        self.dim = dim
+        self.read_text = read_text
+        self.fuse = fuse
+        self.max_clause_chars = max_clause_chars
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS contracts (
+                filename TEXT PRIMARY KEY, path TEXT, file_hash TEXT, title TEXT,
+                clauses INTEGER, chars INTEGER, indexed_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS clauses (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, filename TEXT NOT NULL,
+                clause_no INTEGER, heading TEXT, text TEXT, vector BLOB
+            );
+            CREATE INDEX IF NOT EXISTS clauses_by_file ON clauses (filename);
+            CREATE VIRTUAL TABLE IF NOT EXISTS clauses_fts USING fts5(
+                heading, text, tokenize = "unicode61 remove_diacritics 2"
+            );
+            """
+        )
+        self._conn.commit()
+        self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+        self._clause_file: Dict[int, str] = {}
+        self._load_vectors()
+
+    def _load_vectors(self):
+        ids, vecs = [], []
+        for cid, filename, blob in self._conn.execute("SELECT id, filename, vector FROM clauses"):
+            ids.append(cid)
+            vecs.append(np.frombuffer(blob, dtype=np.float32))
+            self._clause_file[cid] = filename
+        if ids:
+            self._index.add_with_ids(np.vstack(vecs), np.asarray(ids, dtype=np.int64))
+        logger.info(f"📚 Contract index: {len(self)} hợp đồng, {len(ids)} điều khoản.")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM contracts").fetchone()[0]
+
+    # ---------- cập nhật ----------
+
+    def add_file(self, path: pathlib.Path) -> Dict:
+        """Index (hoặc index lại) một hợp đồng; file không đổi thì chỉ trả metadata."""
+        path = pathlib.Path(path)
+        file_hash = file_sha256(path)
+        existing = self.get(path.name)
+        if existing and existing["file_hash"] == file_hash:
+            return existing
+
+        started = time.perf_counter()
+        text = self.read_text(path)
+        clauses = split_clauses(text, self.max_clause_chars)
+        vecs = (
+            np.asarray(self.encode([f"{h}\n{body}" for _, h, body in clauses]), dtype=np.float32).reshape(-1, self.dim)
+            if clauses else np.zeros((0, self.dim), dtype=np.float32)
+        )
+        title = contract_title(text, path.stem)
+
+        with self._lock:
+            self._remove_locked(path.name)
+            cur = self._conn.cursor()
+            ids = []
+            for (no, heading, body), vec in zip(clauses, vecs):
+                cur.execute(
+                    "INSERT INTO clauses (filename, clause_no, heading, text, vector) VALUES (?, ?, ?, ?, ?)",
+                    (path.name, no, heading, body, vec.tobytes()),
+                )
+                ids.append(cur.lastrowid)
+                cur.execute("INSERT INTO clauses_fts (rowid, heading, text) VALUES (?, ?, ?)", (cur.lastrowid, heading, body))
+            cur.execute(
+                "INSERT INTO contracts (filename, path, file_hash, title, clauses, chars, indexed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path.name, str(path), file_hash, title, len(clauses), len(text), time.time()),
+            )
+            self._conn.commit()
+            if ids:
+                self._index.add_with_ids(vecs, np.asarray(ids, dtype=np.int64))
+                self._clause_file.update((cid, path.name) for cid in ids)
+        logger.info(f"📥 Index hợp đồng {path.name}: {len(clauses)} điều khoản ({time.perf_counter() - started:.2f}s)")
+        return self.get(path.name)
+
+    def _remove_locked(self, filename: str):
+        ids = [r[0] for r in self._conn.execute("SELECT id FROM clauses WHERE filename = ?", (filename,))]
+        if ids:
+            self._index.remove_ids(np.asarray(ids, dtype=np.int64))
+            for cid in ids:
+                self._clause_file.pop(cid, None)
+            self._conn.executemany("DELETE FROM clauses_fts WHERE rowid = ?", [(cid,) for cid in ids])
+        self._conn.execute("DELETE FROM clauses WHERE filename = ?", (filename,))
+        self._conn.execute("DELETE FROM contracts WHERE filename = ?", (filename,))
+
+    def remove(self, filename: str):
+        with self._lock:
+            self._remove_locked(filename)
+            self._conn.commit()
+
+    def sync_dir(self, contract_dir: pathlib.Path) -> Dict[str, int]:
+        """Đồng bộ index với thư mục hợp đồng: thêm/cập nhật file mới, bỏ file đã bị xoá."""
+        files = {p.name: p for p in pathlib.Path(contract_dir).glob("*.docx")}
+        before = {d["filename"]: d["file_hash"] for d in self.list()}
+        added = updated = 0
+        for name, path in sorted(files.items()):
+            try:
+                meta = self.add_file(path)
+            except Exception as e:
+                logger.warning(f"⚠️ Không index được hợp đồng {name}: {e}")
+                continue
+            if name not in before:
+                added += 1
+            elif before[name] != meta["file_hash"]:
+                updated += 1
+        removed = [name for name in before if name not in files]
+        for name in removed:
+            self.remove(name)
+        if added or updated or removed:
+            logger.info(f"📚 Đồng bộ kho hợp đồng: +{added} ~{updated} -{len(removed)}")
+        return {"added": added, "updated": updated, "removed": len(removed), "total": len(files)}
+
+    # ---------- truy vấn ----------
+
+    def get(self, filename: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(CONTRACT_COLUMNS)} FROM contracts WHERE filename = ?", (filename,)
+            ).fetchone()
+        return dict(zip(CONTRACT_COLUMNS, row)) if row else None
+
+    def list(self) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(CONTRACT_COLUMNS)} FROM contracts ORDER BY indexed_at DESC"
+            ).fetchall()
+        return [dict(zip(CONTRACT_COLUMNS, r)) for r in rows]
+
+    def _keyword_hits(self, query: str, top_k: int) -> List[Tuple[int, float]]:
+        match = _fts_query(query)
+        if not match:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT rowid, bm25(clauses_fts) FROM clauses_fts WHERE clauses_fts MATCH ? "
+                "ORDER BY bm25(clauses_fts) LIMIT ?",
+                (match, top_k),
+            ).fetchall()
+        return [(int(cid), -float(score)) for cid, score in rows]  # bm25() của FTS5: càng âm càng khớp
+
+    def _vector_hits(self, q_vec: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+        with self._lock:
+            if not self._index.ntotal:
+                return []
+            scores, ids = self._index.search(q_vec, min(top_k, self._index.ntotal))
+        return [(int(cid), float(s)) for cid, s in zip(ids[0], scores[0]) if cid >= 0]
+
+    def search(self, query: str, k: int = 10, filenames: Optional[Sequence[str]] = None) -> List[Dict]:
+        """Điều khoản khớp nhất trên toàn kho (hoặc trong các hợp đồng `filenames`)."""
+        with stage_timer("contract_search"):
+            q_vec = np.asarray(self.encode_query([query]), dtype=np.float32).reshape(1, -1)
+            # Có lọc theo file -> lấy rộng hơn rồi lọc
+            fetch = k * (20 if filenames else 4)
+            allowed = set(filenames) if filenames else None
+            vector_hits = self._vector_hits(q_vec, fetch)
+            keyword_hits = self._keyword_hits(query, fetch)
+            if allowed is not None:
+                vector_hits = [h for h in vector_hits if self._clause_file.get(h[0]) in allowed]
+                keyword_hits = [h for h in keyword_hits if self._clause_file.get(h[0]) in allowed]
+            vec_score = dict(vector_hits)
+            fused = self.fuse(vector_hits, keyword_hits)[:k]
+            if not fused:
+                return []
+            ids = [cid for cid, _ in fused]
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT id, filename, clause_no, heading, text FROM clauses WHERE id IN ({','.join('?' * len(ids))})",
+                    ids,
+                ).fetchall()
+        by_id = {r[0]: r for r in rows}
+        return [
+            {
+                "filename": by_id[cid][1],
+                "clause_no": by_id[cid][2],
+                "heading": by_id[cid][3],
+                "text": by_id[cid][4],
+                "score": round(score, 4),
+                "vector_score": round(vec_score[cid], 4) if cid in vec_score else None,
+            }
+            for cid, score in fused
+            if cid in by_id
+        ]
+
+    def contracts_without(self, query: str, min_score: float) -> List[Dict]:
+        """
+        Hợp đồng KHÔNG có điều khoản nào gần `query` (cosine >= min_score) và không khớp keyword
+        toàn bộ các từ của query. Ví dụ: "giới hạn mức phạt vi phạm" -> hợp đồng không giới hạn phạt.
+        """
+        with stage_timer("contract_search"):
+            q_vec = np.asarray(self.encode_query([query]), dtype=np.float32).reshape(1, -1)
+            covered = set()
+            with self._lock:
+                if self._index.ntotal:
+                    _, _, ids = self._index.range_search(q_vec, min_score)
+                    covered.update(self._clause_file.get(int(cid)) for cid in ids)
+                tokens = list(dict.fromkeys(t.lower() for t in FTS_TOKEN.findall(query)))
+                if tokens:
+                    match = " AND ".join(f'"{t}"' for t in tokens)
+                    covered.update(
+                        r[0] for r in self._conn.execute(
+                            "SELECT c.filename FROM clauses_fts f JOIN clauses c ON c.id = f.rowid "
+                            "WHERE clauses_fts MATCH ?", (match,)
+                        )
+                    )
+        return [d for d in self.list() if d["filename"] not in covered]
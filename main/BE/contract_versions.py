@@ -0,0 +1,204 @@
+"""
+Phân tích lại hợp đồng theo phiên bản (bản nháp đối tác gửi lại nhiều lần).
+
+- Lưu kết quả phân tích của mỗi bản (điều khoản, phân loại, luật tham chiếu, báo cáo) vào SQLite.
+- Bản mới cùng "họ" (cùng tên file, hoặc tên chỉ khác hậu tố số: luu-ban-nhap-tu-dong-2, -3...)
+  được căn điều khoản với bản trước; chỉ điều khoản thêm/sửa/xoá được gửi cho LLM cùng báo cáo cũ.
+  Tên khác nhau thì phần mở đầu (tên hợp đồng + các dòng "Bên A/B ...") phải giống hệt: hop-dong-01 và
+  hop-dong-02 cùng họ theo tên nhưng là hai hợp đồng khác nhau.
+- Thay đổi quá nhiều (hoặc thực ra là hợp đồng khác) -> phân tích lại toàn bộ.
+"""
+from __future__ import annotations
+
+import difflib
+import json
+import pathlib
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+Clause = Tuple[int, str, str]  # (số điều, tiêu đề, nội dung) như contract_index.split_clauses
+
+VERSION_SUFFIX = re.compile(r"(?:[-_ ](?:v|ver|ban)?\d+|\s*\(\d+\))$", re.IGNORECASE)
+PARTY_LINE = re.compile(r"^bên\s+(?:[a-zđ]\b|[^:]{1,30}:)", re.IGNORECASE)  # "Bên A ...", "BÊN CHO THUÊ: ..."
+MODIFIED_MIN_SIMILARITY = 0.5
+CHANGE_LABELS = {"added": "THÊM", "removed": "XOÁ", "modified": "SỬA"}
+
+
+def contract_family(filename: str) -> str:
+    """Tên file bỏ hậu tố phiên bản: "luu-ban-nhap-tu-dong-2.docx" -> "luu-ban-nhap-tu-dong"."""
+    stem = pathlib.Path(filename).stem.strip().lower()
+    return VERSION_SUFFIX.sub("", stem) or stem
+
+
+def _norm(text: str) -> str:
+    return " ".join(text.split()).lower()
+
+
+def contract_identity(clauses: List[Clause]) -> str:
+    """
+    Tên hợp đồng + các dòng giới thiệu các bên trong phần mở đầu (điều 0), đã chuẩn hoá.
+    Rỗng nếu không thấy dòng nào về các bên (không đủ căn cứ để coi là cùng hợp đồng).
+    """
+    preamble = [_norm(line) for no, _, body in clauses if no == 0 for line in body.split("\n") if line.strip()]
+    parties = [line for line in preamble if PARTY_LINE.match(line)]
+    if not parties:
+        return ""
+    title = next((line for line in preamble if line.startswith("hợp đồng")), "")
+    return "\n".join([title, *parties])
+
+
+def same_contract(previous: "AnalysisRecord", filename: str, file_hash: str, clauses: List[Clause]) -> bool:
+    """Bản đã phân tích là bản trước của đúng hợp đồng này (không chỉ trùng họ tên file)."""
+    if previous.file_hash == file_hash or previous.filename == filename:
+        return True
+    identity = contract_identity(clauses)
+    return bool(identity) and identity == contract_identity(previous.clauses)
+
+
+@dataclass
+class ClauseChange:
+    kind: str                        # "unchanged" | "modified" | "added" | "removed"
+    old: Optional[Clause] = None
+    new: Optional[Clause] = None
+    similarity: float = 1.0
+
+
+def _similarity(a: Clause, b: Clause) -> float:
+    matcher = difflib.SequenceMatcher(None, _norm(f"{a[1]}\n{a[2]}"), _norm(f"{b[1]}\n{b[2]}"), autojunk=False)
+    return matcher.ratio() if matcher.quick_ratio() >= MODIFIED_MIN_SIMILARITY else 0.0
+
+
+def align_clauses(old: List[Clause], new: List[Clause]) -> List[ClauseChange]:
+    """Căn điều khoản hai bản theo thứ tự; khối khác nhau được ghép cặp theo độ giống (sửa) hoặc thêm/xoá."""
+    old_keys = [_norm(f"{h}\n{b}") for _, h, b in old]
+    new_keys = [_norm(f"{h}\n{b}") for _, h, b in new]
+    changes: List[ClauseChange] = []
+    matcher = difflib.SequenceMatcher(None, old_keys, new_keys, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            changes.extend(ClauseChange("unchanged", old[i], new[j]) for i, j in zip(range(i1, i2), range(j1, j2)))
+            continue
+        remaining = list(range(i1, i2))
+        for j in range(j1, j2):
+            best, best_sim = None, MODIFIED_MIN_SIMILARITY
+            for i in remaining:
+                sim = _similarity(old[i], new[j])
+                if sim >= best_sim:
+                    best, best_sim = i, sim
+            if best is None:
+                changes.append(ClauseChange("added", None, new[j], 0.0))
+            else:
+                remaining.remove(best)
+                changes.append(ClauseChange("modified", old[best], new[j], round(best_sim, 3)))
+        changes.extend(ClauseChange("removed", old[i], None, 0.0) for i in remaining)
+    return changes
+
+
+def change_counts(changes: List[ClauseChange]) -> Dict[str, int]:
+    counts = {"unchanged": 0, "modified": 0, "added": 0, "removed": 0}
+    for c in changes:
+        counts[c.kind] += 1
+    return counts
+
+
+def changed_ratio(changes: List[ClauseChange]) -> float:
+    """Tỉ lệ điều khoản không còn nguyên vẹn (so với số điều khoản của bản lớn hơn)."""
+    counts = change_counts(changes)
+    total = counts["unchanged"] + counts["modified"] + max(counts["added"], counts["removed"])
+    return 1.0 - counts["unchanged"] / total if total else 0.0
+
+
+def render_changes(changes: List[ClauseChange], max_chars: int = 20000) -> str:
+    """Các điều khoản thay đổi (bản trước / bản mới) để đưa vào prompt."""
+    parts = []
+    for c in changes:
+        if c.kind == "unchanged":
+            continue
+        heading = (c.new or c.old)[1]
+        block = [f"### [{CHANGE_LABELS[c.kind]}] {heading}"]
+        if c.kind == "removed":
+            block.append(f"- Bản trước:\n{c.old[2]}")
+        else:
+            block.append(f"- Bản mới:\n{c.new[2]}")
+        if c.kind == "modified":
+            # Chỉ gửi các dòng của bản trước không còn trong bản mới (không lặp lại cả điều khoản)
+            kept = {_norm(line) for line in c.new[2].split("\n")}
+            dropped = [line for line in c.old[2].split("\n") if _norm(line) not in kept]
+            if dropped:
+                block.append("- Câu chữ bản trước đã bị sửa/bỏ:\n" + "\n".join(dropped))
+        parts.append("\n".join(block))
+    return "\n\n".join(parts)[:max_chars]
+
+
+def changes_table(changes: List[ClauseChange]) -> str:
+    """Bảng markdown các điều khoản thay đổi, đặt đầu báo cáo cập nhật."""
+    rows = [
+        f"| {CHANGE_LABELS[c.kind]} | {(c.new or c.old)[1][:80]} | "
+        f"{'-' if c.kind != 'modified' else f'{c.similarity:.0%}'} |"
+        for c in changes if c.kind != "unchanged"
+    ]
+    if not rows:
+        return "_Không có điều khoản nào thay đổi so với bản trước._"
+    return "\n".join(["| Thay đổi | Điều khoản | Giống bản trước |", "|----------|------------|-----------------|", *rows])
+
+
+@dataclass
+class AnalysisRecord:
+    filename: str
+    family: str
+    file_hash: str
+    status: Dict
+    law_block: str
+    report: str
+    clauses: List[Clause]
+    index_version: str = ""
+    analyzed_at: float = 0.0
+
+
+class ContractAnalysisStore:
+    """Kết quả phân tích của từng bản hợp đồng (SQLite, thread-safe)."""
+
+    def __init__(self, db_path: pathlib.Path, keep_per_family: int = 10):
+        self.keep_per_family = keep_per_family
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS contract_analyses ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, filename TEXT, family TEXT, file_hash TEXT, "
+            "data TEXT NOT NULL, analyzed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS analyses_by_family ON contract_analyses (family, analyzed_at)")
+        self._conn.commit()
+
+    def save(self, record: AnalysisRecord):
+        record.analyzed_at = time.time()
+        data = json.dumps(record.__dict__, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO contract_analyses (filename, family, file_hash, data, analyzed_at) VALUES (?, ?, ?, ?, ?)",
+                (record.filename, record.family, record.file_hash, data, record.analyzed_at),
+            )
+            # Chỉ giữ vài bản gần nhất của mỗi họ hợp đồng
+            self._conn.execute(
+                "DELETE FROM contract_analyses WHERE family = ? AND id NOT IN ("
+                "SELECT id FROM contract_analyses WHERE family = ? ORDER BY analyzed_at DESC LIMIT ?)",
+                (record.family, record.family, self.keep_per_family),
+            )
+            self._conn.commit()
+
+    def latest(self, filename: str) -> Optional[AnalysisRecord]:
+        """Bản đã phân tích gần nhất cùng họ với `filename` (kể cả chính file đó ở nội dung cũ)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM contract_analyses WHERE family = ? OR filename = ? ORDER BY analyzed_at DESC LIMIT 1",
+                (contract_family(filename), filename),
+            ).fetchone()
+        if not row:
+            return None
+        data = json.loads(row[0])
+        data["clauses"] = [tuple(c) for c in data["clauses"]]
+        return AnalysisRecord(**data)
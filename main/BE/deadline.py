@@ -0,0 +1,106 @@
+"""
+Ngân sách thời gian (deadline) cho từng request.
+
+Deadline đi theo request qua ContextVar (StageGraph copy context sang thread stage), mỗi stage
+tự hỏi `degrade(step)` trước phần việc tốn thời gian. Khi thời gian còn lại xuống dưới ngưỡng
+của một bước, bước đó được áp dụng (và ghi lại để trả về cho client). Ngưỡng giảm dần theo
+thứ tự cố định nên các bước luôn được áp dụng lần lượt:
+  1. skip_cot        - không tách câu hỏi bằng LLM, search thẳng câu hỏi đã chuẩn hoá
+  2. skip_rerank     - bỏ cross-encoder, lấy thứ hạng fusion
+  3. shrink_context  - không mở rộng thành cả Điều, cắt context gửi LLM
+  4. cap_generation  - giới hạn số token sinh ra
+Mọi lời gọi LLM còn bị chặn timeout bằng thời gian còn lại.
+Bước không theo thời gian (vd. partial_shards - thiếu kết quả của một shard) ghi lại bằng `mark(step)`.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from metrics import DEGRADATIONS
+
+logger = logging.getLogger("LegalAI")
+
+DEGRADATION_STEPS = ("skip_cot", "skip_rerank", "shrink_context", "cap_generation")
+
+
+class Deadline:
+    def __init__(self, budget_s: float, thresholds: Dict[str, float]):
+        """thresholds: {bước: số giây còn lại mà dưới mức đó thì áp dụng bước}."""
+        self.budget_s = budget_s
+        self.thresholds = thresholds
+        self.expires_at = time.monotonic() + budget_s
+        self.degraded: List[str] = []
+        self._lock = threading.Lock()
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def degrade(self, step: str) -> bool:
+        """True nếu phải áp dụng `step` (đã áp dụng trước đó, hoặc thời gian còn lại < ngưỡng)."""
+        with self._lock:
+            if step in self.degraded:
+                return True
+            remaining = self.remaining()
+            if remaining >= self.thresholds.get(step, 0.0):
+                return False
+            self.degraded.append(step)
+            # Báo cáo theo thứ tự của thang degrade (stage song song có thể chạm ngưỡng trước)
+            self.degraded.sort(key=lambda s: DEGRADATION_STEPS.index(s) if s in DEGRADATION_STEPS else len(DEGRADATION_STEPS))
+        DEGRADATIONS.labels(step).inc()
+        logger.info(f"⏳ Còn {remaining:.1f}s/{self.budget_s:.0f}s -> degrade: {step}")
+        return True
+
+    def mark(self, step: str):
+        """Ghi lại `step` đã xảy ra bất kể thời gian còn lại."""
+        with self._lock:
+            if step in self.degraded:
+                return
+            self.degraded.append(step)
+            self.degraded.sort(key=lambda s: DEGRADATION_STEPS.index(s) if s in DEGRADATION_STEPS else len(DEGRADATION_STEPS))
+        DEGRADATIONS.labels(step).inc()
+
+
+_current: ContextVar[Optional[Deadline]] = ContextVar("legal_ai_deadline", default=None)
+
+
+def current() -> Optional[Deadline]:
+    return _current.get()
+
+
+def remaining(default: float) -> float:
+    """Thời gian còn lại của request hiện tại (không có deadline -> default)."""
+    d = _current.get()
+    return default if d is None else min(default, d.remaining())
+
+
+def time_left() -> Optional[float]:
+    """Timeout cho lời gọi ra ngoài (LLM): thời gian còn lại, hoặc None nếu request không có deadline."""
+    d = _current.get()
+    return None if d is None else max(d.remaining(), 0.0)
+
+
+def degrade(step: str) -> bool:
+    d = _current.get()
+    return d is not None and d.degrade(step)
+
+
+def mark(step: str):
+    """Báo cho client request hiện tại đã bị degrade theo `step` (không có deadline -> bỏ qua)."""
+    d = _current.get()
+    if d is not None:
+        d.mark(step)
+
+
+@contextmanager
+def with_deadline(deadline: Optional[Deadline]):
+    """Gắn deadline cho khối `with` (và các stage tạo bên trong). None -> không giới hạn."""
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
@@ -0,0 +1,143 @@
+"""
+Index bundle có version, tự mô tả:
+
+    index_laws/
+        CURRENT                 # tên bundle đang dùng (ghi atomic)
+        bundles/<version>/
+            manifest.json       # model, số chiều, tham số chunking, hash file nguồn...
+            laws.faiss          # vector index
+            keyword.npz         # BM25 postings (mảng numpy, không pickle)
+            chunks.npz          # ChunkTable
+            articles.json       # Luật -> Điều -> Khoản -> Điểm
+
+Bundle được build offline (build_index.py) hoặc khi reload; server chỉ load
+và từ chối bundle build bằng model / tham số khác cấu hình hiện tại.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger("LegalAI")
+
+BUNDLE_FORMAT = 2  # 2: keyword.npz thay cho keyword.pkl
+MANIFEST_NAME = "manifest.json"
+CURRENT_NAME = "CURRENT"
+
+
+class IndexBundleError(RuntimeError):
+    """Không có bundle, bundle hỏng, hoặc bundle không khớp cấu hình server."""
+
+
+def bundles_root(index_dir: pathlib.Path) -> pathlib.Path:
+    return pathlib.Path(index_dir) / "bundles"
+
+
+def file_sha256(path: pathlib.Path) -> str:
+    h = hashlib.sha256()
+    with pathlib.Path(path).open("rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def source_hashes(files: Iterable[pathlib.Path]) -> Dict[str, str]:
+    return {f.name: file_sha256(f) for f in sorted(files, key=lambda p: p.name)}
+
+
+def current_bundle(index_dir: pathlib.Path) -> Optional[pathlib.Path]:
+    pointer = pathlib.Path(index_dir) / CURRENT_NAME
+    if not pointer.exists():
+        return None
+    path = bundles_root(index_dir) / pointer.read_text(encoding="utf-8").strip()
+    if not (path / MANIFEST_NAME).exists():
+        raise IndexBundleError(f"CURRENT trỏ tới bundle không tồn tại hoặc thiếu manifest: {path}")
+    return path
+
+
+def read_manifest(bundle_dir: pathlib.Path) -> Dict:
+    try:
+        return json.loads((pathlib.Path(bundle_dir) / MANIFEST_NAME).read_text(encoding="utf-8"))
+    except (OSError, ValueError) as e:
+        raise IndexBundleError(f"Không đọc được manifest của {bundle_dir}: {e}") from e
+
+
+def check_manifest(manifest: Dict, expected: Dict):
+    """So các trường cấu hình (model, số chiều, chunking...) với server; lệch -> IndexBundleError."""
+    if manifest.get("format") != BUNDLE_FORMAT:
+        raise IndexBundleError(
+            f"Bundle format {manifest.get('format')} không được hỗ trợ (cần {BUNDLE_FORMAT}). "
+            "Hãy build lại bằng build_index.py."
+        )
+    mismatches = [
+        f"{key}: bundle={manifest.get(key)!r}, server={value!r}"
+        for key, value in expected.items()
+        if manifest.get(key) != value
+    ]
+    if mismatches:
+        raise IndexBundleError(
+            f"Bundle {manifest.get('version')} không khớp cấu hình server:\n  - "
+            + "\n  - ".join(mismatches)
+            + "\nHãy build lại bằng `python build_index.py` với cấu hình hiện tại."
+        )
+
+
+def write_bundle(
+    index_dir: pathlib.Path,
+    version: str,
+    manifest: Dict,
+    write_files: Callable[[pathlib.Path], None],
+    activate: bool = True,
+) -> pathlib.Path:
+    """Ghi bundle vào thư mục tạm rồi rename (bundle không bao giờ ở trạng thái dở)."""
+    root = bundles_root(index_dir)
+    root.mkdir(parents=True, exist_ok=True)
+    final = root / version
+    if not final.exists():
+        tmp = root / f".tmp-{version}-{os.getpid()}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir()
+        try:
+            write_files(tmp)
+            manifest = {**manifest, "format": BUNDLE_FORMAT, "version": version, "created_at": time.time()}
+            (tmp / MANIFEST_NAME).write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+            os.replace(tmp, final)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+    if activate:
+        activate_bundle(index_dir, version)
+    return final
+
+
+def activate_bundle(index_dir: pathlib.Path, version: str):
+    pointer = pathlib.Path(index_dir) / CURRENT_NAME
+    tmp = pointer.with_suffix(".tmp")
+    tmp.write_text(version, encoding="utf-8")
+    os.replace(tmp, pointer)
+
+
+def list_bundles(index_dir: pathlib.Path) -> List[pathlib.Path]:
+    root = bundles_root(index_dir)
+    if not root.exists():
+        return []
+    bundles = [p for p in root.iterdir() if p.is_dir() and (p / MANIFEST_NAME).exists()]
+    return sorted(bundles, key=lambda p: read_manifest(p).get("created_at", 0), reverse=True)
+
+
+def prune_bundles(index_dir: pathlib.Path, keep: int) -> List[str]:
+    """Giữ `keep` bundle mới nhất (luôn giữ bundle CURRENT)."""
+    current = current_bundle(index_dir)
+    removed = []
+    for path in list_bundles(index_dir)[keep:]:
+        if current is not None and path.resolve() == current.resolve():
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        removed.append(path.name)
+    return removed
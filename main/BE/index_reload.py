@@ -0,0 +1,152 @@
+"""
+Reload index không downtime.
+
+- Trigger thủ công (POST /admin/reload) hoặc tự động khi thư mục luật thay đổi (poll).
+- Build chạy trên thread nền, mỗi lúc chỉ một lần; thế hệ cũ vẫn phục vụ tới khi swap.
+- Chỉ các file đổi (so signature trước/sau khi sync) được build lại.
+- Kéo bundle (/admin/index/pull) chạy qua cùng khoá single-flight (`exclusive`) nên không đua với build
+  trên CURRENT / swap thế hệ.
+- Build lỗi với cùng bộ file -> watcher chờ lùi dần (interval * 2^n, tối đa max_backoff_s) mới thử lại.
+"""
+from __future__ import annotations
+
+import logging
+import pathlib
+import threading
+import time
+from typing import Callable, Dict, Optional, Set, Tuple, TypeVar
+
+logger = logging.getLogger("LegalAI")
+
+T = TypeVar("T")
+
+
+def dir_signature(path: pathlib.Path, pattern: str = "*.docx") -> Tuple[Tuple[str, int, int], ...]:
+    """(tên, size, mtime) của các file luật — đổi là biết cần build lại."""
+    out = []
+    for f in sorted(pathlib.Path(path).glob(pattern)):
+        try:
+            st = f.stat()
+        except OSError:
+            continue
+        out.append((f.name, st.st_size, st.st_mtime_ns))
+    return tuple(out)
+
+
+def changed_files(old: Tuple, new: Tuple) -> Set[str]:
+    """Tên các file thêm/xoá/sửa giữa hai signature."""
+    before = {name: rest for name, *rest in old}
+    after = {name: rest for name, *rest in new}
+    return {n for n in before.keys() | after.keys() if before.get(n) != after.get(n)}
+
+
+class IndexReloader:
+    def __init__(
+        self,
+        rebuild: Callable[[Optional[Set[str]]], str],
+        watch_dir: pathlib.Path,
+        interval_s: float = 0.0,
+        sync: Optional[Callable[[], object]] = None,
+        max_backoff_s: float = 3600.0,
+    ):
+        """
+        rebuild(changed): build + swap index, trả về version mới (changed=None -> build toàn bộ).
+        sync: chạy trước mỗi lần build (vd: đồng bộ GCS -> data_laws).
+        interval_s > 0: bật watcher poll `watch_dir` mỗi interval_s giây.
+        """
+        self._rebuild = rebuild
+        self._sync = sync
+        self.watch_dir = pathlib.Path(watch_dir)
+        self.interval_s = interval_s
+        self._running = threading.Lock()
+        self._signature = dir_signature(self.watch_dir)
+        self._stop = threading.Event()
+        self.last_reload: Dict = {}
+        self.max_backoff_s = max_backoff_s
+        self._failed_signature: Optional[Tuple] = None  # Bộ file của lần build lỗi gần nhất
+        self._failures = 0
+        self._retry_at = 0.0
+
+    def trigger(self, reason: str = "manual", full: bool = False) -> bool:
+        """Chạy reload trên thread nền. False nếu đang có một lần reload khác."""
+        if not self._running.acquire(blocking=False):
+            return False
+        threading.Thread(target=self._run, args=(reason, full), name="index-reload", daemon=True).start()
+        return True
+
+    def exclusive(self, fn: Callable[[], T]) -> Tuple[bool, Optional[T]]:
+        """Chạy fn (vd. kéo bundle + load) khi không có reload nào chạy. (False, None) nếu đang bận."""
+        if not self._running.acquire(blocking=False):
+            return False, None
+        try:
+            return True, fn()
+        finally:
+            self._running.release()
+
+    @property
+    def in_progress(self) -> bool:
+        return self._running.locked()
+
+    def _run(self, reason: str, full: bool):
+        started = time.time()
+        logger.info(f"🔄 Bắt đầu reload index ({reason})...")
+        signature = None
+        try:
+            if self._sync is not None:
+                self._sync()
+            # Chụp signature trước khi build: file đổi trong lúc build sẽ trigger lần sau.
+            # Chỉ ghi nhận sau khi build xong: build lỗi -> lần sau vẫn thấy các file này là đã đổi
+            signature = dir_signature(self.watch_dir)
+            changed = None if full else changed_files(self._signature, signature)
+            if changed is not None and not changed:
+                self._signature = signature
+                self._failures = 0
+                self.last_reload = {"reason": reason, "ok": True, "changed": [], "started_at": started}
+                logger.info("⚡ Không có file luật nào thay đổi -> giữ nguyên index.")
+                return
+            version = self._rebuild(changed)
+            self._signature = signature
+            self._failures = 0
+            self.last_reload = {
+                "reason": reason, "version": version, "ok": True,
+                "changed": sorted(changed) if changed is not None else "all",
+                "started_at": started, "seconds": round(time.time() - started, 3),
+            }
+            logger.info(f"✅ Reload index xong: version {version} ({self.last_reload['seconds']}s)")
+        except Exception as e:
+            signature = signature if signature is not None else dir_signature(self.watch_dir)
+            self._failures = self._failures + 1 if signature == self._failed_signature else 1
+            self._failed_signature = signature
+            backoff = min(self.interval_s * 2 ** self._failures, self.max_backoff_s)
+            self._retry_at = time.monotonic() + backoff
+            self.last_reload = {
+                "reason": reason, "ok": False, "error": str(e), "started_at": started, "failures": self._failures,
+            }
+            logger.error(
+                f"❌ Reload index lỗi, giữ nguyên index cũ: {e} (lần {self._failures}, watcher chờ {backoff:.0f}s)"
+            )
+        finally:
+            self._running.release()
+
+    def start_watcher(self):
+        if self.interval_s <= 0:
+            return
+        threading.Thread(target=self._watch, name="index-watcher", daemon=True).start()
+        logger.info(f"👀 Theo dõi {self.watch_dir} mỗi {self.interval_s:.0f}s để reload index.")
+
+    def stop(self):
+        self._stop.set()
+
+    def _watch(self):
+        while not self._stop.wait(self.interval_s):
+            if self.in_progress:
+                continue
+            signature = dir_signature(self.watch_dir)
+            if signature == self._signature:
+                continue
+            if self._failures and signature == self._failed_signature and time.monotonic() < self._retry_at:
+                continue  # Cùng bộ file vừa build lỗi: chờ hết backoff (file đổi tiếp thì thử ngay)
+            self.trigger("data_laws changed")
+
+    def status(self) -> Dict:
+        return {"in_progress": self.in_progress, "last_reload": self.last_reload or None}
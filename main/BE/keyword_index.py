@@ -0,0 +1,274 @@
+"""
+BM25 lưu dạng mảng numpy (inverted index CSR theo term) thay cho pickle của rank_bm25.
+
+- File bundle `keyword.npz` chỉ có mảng số + danh sách term (JSON), load bằng allow_pickle=False:
+  bundle kéo từ bucket không thể chứa code chạy khi load.
+- Score giống hệt BM25Okapi (k1=1.5, b=0.75, epsilon=0.25, IDF âm -> epsilon * IDF trung bình).
+- KeywordView: BM25 trên một tập chunk với IDF/avgdl của đúng tập đó, như một BM25Okapi riêng -
+  nhưng dùng chung postings, không nhân bản index.
+- Search có filter (một số văn bản nguồn): dùng view cả corpus, chỉ tính score trên vị trí chunk của
+  các văn bản đó. Cùng một IDF nên score so sánh được giữa các văn bản (IDF riêng từng văn bản thì
+  không: văn bản nhỏ có IDF cao hơn và lấn át hit của bộ luật lớn).
+- Shard: `subset()` tách postings của phần chunk trên shard, view dựng từ thống kê (df/avgdl) toàn cục
+  ghi sẵn lúc build nên score khớp search trong một process.
+- Chỉ duyệt postings của term trong query (không tính score cho cả corpus như rank_bm25).
+"""
+from __future__ import annotations
+
+import json
+import math
+import pathlib
+from array import array
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+K1, B, EPSILON = 1.5, 0.75, 0.25  # = mặc định của BM25Okapi
+
+Hits = List[Tuple[int, float]]
+
+
+def tokenize(text: str) -> List[str]:
+    return text.lower().split()
+
+
+def raw_idf(df: np.ndarray, n_docs: int) -> np.ndarray:
+    return np.log(n_docs - df + 0.5) - np.log(df + 0.5)
+
+
+def idf_floor(df: np.ndarray, n_docs: int) -> float:
+    """Giá trị thay cho IDF âm (term có trong quá nửa số văn bản): epsilon * IDF trung bình của vocab."""
+    return EPSILON * float(raw_idf(df, n_docs).mean()) if len(df) else 0.0
+
+
+def term_idf(df: int, n_docs: int, floor: float) -> float:
+    idf = math.log(n_docs - df + 0.5) - math.log(df + 0.5)
+    return floor if idf < 0 else idf
+
+
+def top_hits(ids: np.ndarray, scores: np.ndarray, top_k: int) -> Hits:
+    n = min(top_k, len(scores))
+    if n <= 0:
+        return []
+    top = np.argpartition(-scores, n - 1)[:n]
+    top = top[np.argsort(-scores[top])]
+    return [(int(ids[i]), float(scores[i])) for i in top if scores[i] > 0]
+
+
+class KeywordIndex:
+    """
+    Postings của một tập chunk. `ids`: id chunk toàn cục của từng vị trí (None = 0..n-1);
+    term t có postings doc_pos[indptr[t]:indptr[t+1]] (vị trí, tăng dần) và tần suất tfs.
+    """
+
+    def __init__(
+        self,
+        terms: List[str],
+        indptr: np.ndarray,
+        doc_pos: np.ndarray,
+        tfs: np.ndarray,
+        doc_len: np.ndarray,
+        ids: Optional[np.ndarray] = None,
+    ):
+        self.terms = terms
+        self.term_ids: Dict[str, int] = {t: i for i, t in enumerate(terms)}
+        self.indptr = indptr
+        self.doc_pos = doc_pos
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.ids = ids if ids is not None else np.arange(len(doc_len), dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.doc_len)
+
+    @property
+    def df(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in (self.indptr, self.doc_pos, self.tfs, self.doc_len, self.ids))
+
+    @classmethod
+    def build(cls, docs: Iterable[List[str]], ids: Optional[np.ndarray] = None) -> "KeywordIndex":
+        term_ids: Dict[str, int] = {}
+        rows, cols, vals, doc_len = array("i"), array("i"), array("i"), array("i")
+        for pos, tokens in enumerate(docs):
+            doc_len.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                rows.append(term_ids.setdefault(term, len(term_ids)))
+                cols.append(pos)
+                vals.append(tf)
+        rows_np = np.frombuffer(rows, dtype=np.int32)
+        order = np.argsort(rows_np, kind="stable")  # stable: postings của một term giữ thứ tự vị trí
+        indptr = np.zeros(len(term_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows_np, minlength=len(term_ids)), out=indptr[1:])
+        return cls(
+            terms=list(term_ids),
+            indptr=indptr,
+            doc_pos=np.frombuffer(cols, dtype=np.int32)[order],
+            tfs=np.frombuffer(vals, dtype=np.int32)[order],
+            doc_len=np.frombuffer(doc_len, dtype=np.int32).copy(),
+            ids=ids,
+        )
+
+    def save(self, path: pathlib.Path):
+        np.savez(
+            str(path),
+            terms=np.array([json.dumps(self.terms, ensure_ascii=False)]),
+            indptr=self.indptr, doc_pos=self.doc_pos, tfs=self.tfs, doc_len=self.doc_len, ids=self.ids,
+        )
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> "KeywordIndex":
+        with np.load(str(path), allow_pickle=False) as data:
+            return cls(
+                terms=json.loads(str(data["terms"][0])),
+                indptr=data["indptr"], doc_pos=data["doc_pos"], tfs=data["tfs"],
+                doc_len=data["doc_len"], ids=data["ids"],
+            )
+
+    def positions(self, ids: np.ndarray) -> np.ndarray:
+        """id chunk toàn cục -> vị trí trong index (id không có trong index bị bỏ)."""
+        pos = np.searchsorted(self.ids, ids)
+        ok = pos < len(self.ids)
+        ok[ok] = self.ids[pos[ok]] == ids[ok]
+        return pos[ok]
+
+    def term_df(self, positions: Optional[np.ndarray] = None) -> np.ndarray:
+        """Doc frequency từng term trong tập vị trí `positions` (None = cả index)."""
+        if positions is None or not len(self.terms):
+            return self.df
+        mask = np.zeros(len(self), dtype=bool)
+        mask[positions] = True
+        # Term nào cũng có ít nhất một posting -> không có đoạn rỗng trong reduceat
+        return np.add.reduceat(mask[self.doc_pos].astype(np.int64), self.indptr[:-1])
+
+    def top_k(
+        self,
+        tokens: List[str],
+        top_k: int,
+        idf: Callable[[int], float],
+        avgdl: float,
+        positions: Optional[np.ndarray] = None,
+    ) -> Hits:
+        """
+        BM25 với IDF/avgdl cho trước (idf(term_id) -> trọng số), chỉ trên `positions` nếu có.
+        Cộng theo thứ tự token như BM25Okapi.get_scores (token lặp lại được cộng lại).
+        """
+        mask = None
+        if positions is not None:
+            mask = np.zeros(len(self), dtype=bool)
+            mask[positions] = True
+        docs, weights = [], []
+        for token in tokens:
+            t = self.term_ids.get(token)
+            if t is None:
+                continue
+            w = idf(t)
+            if not w:
+                continue
+            lo, hi = self.indptr[t], self.indptr[t + 1]
+            pos, tf = self.doc_pos[lo:hi], self.tfs[lo:hi].astype(np.float64)
+            if mask is not None:
+                keep = mask[pos]
+                pos, tf = pos[keep], tf[keep]
+            dl = self.doc_len[pos]
+            docs.append(pos)
+            weights.append(w * (tf * (K1 + 1) / (tf + K1 * (1 - B + B * dl / avgdl))))
+        if not docs:
+            return []
+        uniq, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(weights))
+        return top_hits(self.ids[uniq], scores, top_k)
+
+    def subset(self, positions: np.ndarray) -> "KeywordIndex":
+        """Index chỉ gồm các vị trí `positions` (tăng dần); term không còn posting nào bị bỏ."""
+        mask = np.zeros(len(self), dtype=bool)
+        mask[positions] = True
+        keep = mask[self.doc_pos]
+        new_pos = np.full(len(self), -1, dtype=np.int32)
+        new_pos[positions] = np.arange(len(positions), dtype=np.int32)
+        counts = np.bincount(np.repeat(np.arange(len(self.terms)), self.df)[keep], minlength=len(self.terms))
+        used = np.flatnonzero(counts)
+        indptr = np.zeros(len(used) + 1, dtype=np.int64)
+        np.cumsum(counts[used], out=indptr[1:])
+        return KeywordIndex(
+            terms=[self.terms[t] for t in used],
+            indptr=indptr,
+            doc_pos=new_pos[self.doc_pos[keep]],
+            tfs=self.tfs[keep],
+            doc_len=self.doc_len[positions],
+            ids=self.ids[positions],
+        )
+
+    def view(self, ids: Optional[np.ndarray] = None) -> "KeywordView":
+        return KeywordView.of(self, ids)
+
+
+class KeywordView:
+    """
+    BM25 trên các vị trí `positions` của KeywordIndex (None = cả index) với IDF/avgdl cho trước:
+    n_docs/avgdl/floor của tập chunk, df (thưa) theo term id của index.
+    """
+
+    def __init__(
+        self,
+        index: KeywordIndex,
+        positions: Optional[np.ndarray],
+        n_docs: int,
+        avgdl: float,
+        df_terms: np.ndarray,
+        df: np.ndarray,
+        floor: float,
+    ):
+        self.index = index
+        self.positions = positions
+        self.n_docs = n_docs
+        self.avgdl = avgdl
+        self._df_terms = df_terms
+        self._df = df
+        self.floor = floor
+
+    @classmethod
+    def of(cls, index: KeywordIndex, ids: Optional[np.ndarray] = None) -> "KeywordView":
+        """View có IDF/avgdl tính trên đúng tập chunk `ids` (None = cả index)."""
+        positions = None if ids is None else index.positions(np.asarray(ids, dtype=np.int64))
+        n_docs = len(index) if positions is None else len(positions)
+        lengths = index.doc_len if positions is None else index.doc_len[positions]
+        df = index.term_df(positions)
+        # Chỉ giữ df của term có trong tập (thưa) - nhiều view không nhân vocab lên
+        df_terms = np.flatnonzero(df)
+        return cls(
+            index, positions, n_docs,
+            avgdl=int(lengths.sum()) / n_docs if n_docs else 0.0,
+            df_terms=df_terms,
+            df=df[df_terms],
+            floor=idf_floor(df[df_terms], n_docs),
+        )
+
+    def __len__(self) -> int:
+        return self.n_docs
+
+    def df_of(self, term_ids: np.ndarray) -> np.ndarray:
+        """df trong tập của từng term id (0 nếu không có)."""
+        i = np.searchsorted(self._df_terms, term_ids)
+        found = i < len(self._df_terms)
+        found[found] = self._df_terms[i[found]] == term_ids[found]
+        out = np.zeros(len(term_ids), dtype=np.int64)
+        out[found] = self._df[i[found]]
+        return out
+
+    def idf(self, term_id: int) -> float:
+        i = np.searchsorted(self._df_terms, term_id)
+        if i >= len(self._df_terms) or self._df_terms[i] != term_id:
+            return 0.0
+        return term_idf(int(self._df[i]), self.n_docs, self.floor)
+
+    def top_k(self, tokens: List[str], top_k: int, positions: Optional[np.ndarray] = None) -> Hits:
+        """positions: chỉ tính score trên các vị trí này (nằm trong tập của view), IDF/avgdl vẫn của cả tập."""
+        if not self.n_docs:
+            return []
+        positions = self.positions if positions is None else positions
+        return self.index.top_k(tokens, top_k, self.idf, self.avgdl, positions)
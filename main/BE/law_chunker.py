@@ -0,0 +1,148 @@
+"""
+Chunker theo ngân sách token của model embedding.
+
+all-MiniLM-L6-v2 chỉ nhận 256 word-piece; chunk dài hơn bị cắt đuôi -> phần cuối
+của Điều dài không bao giờ tìm được bằng vector. Chunker này:
+- đo bằng token của chính tokenizer model,
+- cắt Điều theo ranh giới khoản -> điểm -> câu (không cắt ngang nếu không buộc phải),
+- lặp tiêu đề "Điều N. ..." ở mỗi chunk con, chồng lấn một ít với chunk trước,
+- giữ số Điều ở đầu chunk để hit có thể mở rộng lại thành cả Điều (ArticleIndex).
+"""
+from __future__ import annotations
+
+import re
+from typing import Callable, List, Optional, Tuple
+
+from law_structure import ARTICLE_HEADING, CLAUSE_HEADING, POINT_HEADING
+
+SENTENCE_END = re.compile(r"(?<=[.;:!?])\s+")
+
+
+class TokenChunker:
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        max_tokens: int,
+        overlap_tokens: int = 32,
+        min_len: int = 20,
+    ):
+        """max_tokens: số token tối đa của cả chunk (kể cả nguồn + tiêu đề), không tính [CLS]/[SEP]."""
+        self.count_tokens = count_tokens
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.min_len = min_len
+
+    def params(self) -> dict:
+        return {
+            "strategy": "tokens",
+            "max_tokens": self.max_tokens,
+            "overlap_tokens": self.overlap_tokens,
+            "min_len": self.min_len,
+        }
+
+    # ---------- tách cấu trúc ----------
+
+    @staticmethod
+    def _split_articles(text: str) -> List[Tuple[Optional[str], List[str]]]:
+        """[(tiêu đề Điều hoặc None cho phần mở đầu, các dòng nội dung)]."""
+        groups: List[Tuple[Optional[str], List[str]]] = [(None, [])]
+        for line in text.split("\n"):
+            line = line.strip()
+            if not line:
+                continue
+            if ARTICLE_HEADING.match(line):
+                groups.append((line, []))
+            else:
+                groups[-1][1].append(line)
+        return [g for g in groups if g[0] is not None or g[1]]
+
+    @staticmethod
+    def _group(lines: List[str], heading: re.Pattern) -> List[str]:
+        """Gộp dòng thành block bắt đầu bằng `heading` (khoản "1." hoặc điểm "a)")."""
+        blocks: List[List[str]] = []
+        for line in lines:
+            if heading.match(line) or not blocks:
+                blocks.append([line])
+            else:
+                blocks[-1].append(line)
+        return ["\n".join(b) for b in blocks]
+
+    def _split_long(self, unit: str, budget: int) -> List[str]:
+        """Unit vượt ngân sách: tách theo câu, câu vẫn dài thì cắt theo cửa sổ từ."""
+        pieces: List[str] = []
+        for sentence in SENTENCE_END.split(unit):
+            n = self.count_tokens(sentence)
+            if n <= budget:
+                pieces.append(sentence)
+                continue
+            words = sentence.split()
+            per_word = n / max(len(words), 1)
+            step = max(1, int(budget / per_word * 0.9))
+            pieces.extend(" ".join(words[i:i + step]) for i in range(0, len(words), step))
+        return pieces
+
+    def _units(self, lines: List[str], budget: int) -> List[Tuple[str, int]]:
+        """Đơn vị nhỏ nhất để đóng gói: khoản, khoản quá dài -> điểm, điểm quá dài -> câu."""
+        units: List[Tuple[str, int]] = []
+        for clause in self._group(lines, CLAUSE_HEADING):
+            n = self.count_tokens(clause)
+            if n <= budget:
+                units.append((clause, n))
+                continue
+            for point in self._group(clause.split("\n"), POINT_HEADING):
+                for line in point.split("\n"):
+                    m = self.count_tokens(line)
+                    if m <= budget:
+                        units.append((line, m))
+                    else:
+                        units.extend((p, self.count_tokens(p)) for p in self._split_long(line, budget))
+        return units
+
+    # ---------- đóng gói ----------
+
+    def _pack(self, units: List[Tuple[str, int]], budget: int) -> List[str]:
+        bodies: List[str] = []
+        current: List[Tuple[str, int]] = []
+        used = 0
+        for text, n in units:
+            if current and used + n > budget:
+                bodies.append("\n".join(t for t, _ in current))
+                # Overlap: mang theo các unit cuối (tổng <= overlap_tokens) sang chunk sau
+                carry: List[Tuple[str, int]] = []
+                carried = 0
+                for t, m in reversed(current):
+                    if carried + m > self.overlap_tokens or carried + m + n > budget:
+                        break
+                    carry.insert(0, (t, m))
+                    carried += m
+                current, used = carry, carried
+            current.append((text, n))
+            used += n
+        if current:
+            bodies.append("\n".join(t for t, _ in current))
+        return bodies
+
+    def chunk(self, text: str, source_name: str) -> List[str]:
+        prefix = f"[NGUỒN: {source_name}]\n"
+        prefix_tokens = self.count_tokens(prefix)
+        chunks: List[str] = []
+        for header, lines in self._split_articles(text):
+            if header is None:
+                # Phần mở đầu / văn bản không chia Điều: chỉ đóng gói theo dòng
+                budget = self.max_tokens - prefix_tokens
+                for body in self._pack(self._units(lines, budget), budget):
+                    if len(body) >= self.min_len:
+                        chunks.append(prefix + body)
+                continue
+
+            whole = "\n".join([header] + lines)
+            if prefix_tokens + self.count_tokens(whole) <= self.max_tokens:
+                if len(whole) >= self.min_len:
+                    chunks.append(prefix + whole)
+                continue
+
+            cont_header = f"{header} (tiếp)"
+            budget = self.max_tokens - prefix_tokens - self.count_tokens(cont_header)
+            for i, body in enumerate(self._pack(self._units(lines, budget), budget)):
+                chunks.append(f"{prefix}{header if i == 0 else cont_header}\n{body}")
+        return chunks
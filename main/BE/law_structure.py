@@ -0,0 +1,250 @@
+"""
+Chỉ mục cấu trúc văn bản luật: Luật -> Điều -> Khoản -> Điểm.
+
+Câu hỏi trích dẫn trực tiếp (vd: "điểm a khoản 1 Điều 17 Luật Doanh nghiệp")
+được trả lời bằng tra dict O(1), không cần CoT, embedding, BM25 hay rerank.
+
+Kèm metadata văn bản (loại văn bản, lĩnh vực) để route câu hỏi vào đúng partition.
+"""
+from __future__ import annotations
+
+import json
+import os
+import pathlib
+import re
+import unicodedata
+from typing import Dict, List, Optional, Set, Tuple
+
+ARTICLE_HEADING = re.compile(r"^Điều\s+(\d+)[.:]\s*(.*)$")
+CLAUSE_HEADING = re.compile(r"^(\d+)\.\s")
+POINT_HEADING = re.compile(r"^([a-zđ])\)\s")
+
+# Trích dẫn trong câu hỏi (chạy trên text lowercase, còn dấu)
+ARTICLE_REF = re.compile(r"\bđiều\s+(\d+)\b")
+CLAUSE_REF = re.compile(r"\bkhoản\s+(\d+)\b")
+POINT_REF = re.compile(r"\bđiểm\s+([a-zđ])\b")
+# Số hiệu văn bản trong tên file: "...-59-2020-QH14" -> "59/2020"
+LAW_NUMBER = re.compile(r"(\d+)\s*-\s*(\d{4})")
+
+DOC_LAW, DOC_DECREE, DOC_AMENDMENT = "law", "decree", "amendment"
+
+# Lĩnh vực -> đoạn tên file (normalize, bỏ khoảng trắng). Câu hỏi nhắc từ khoá nào
+# thì chỉ search trong các văn bản có tên chứa pattern tương ứng.
+DOMAIN_KEYWORDS: Dict[str, Tuple[str, ...]] = {
+    "hoadon": ("hoa don", "chung tu", "hddt"),
+    "giatrigiatang": ("gia tri gia tang", "gtgt", "vat"),
+    "thunhapdoanhnghiep": ("thu nhap doanh nghiep", "tndn"),
+    "quanlithue": ("quan li thue", "khai thue", "nop thue", "hoan thue", "cham nop", "cuong che thue"),
+    "laodong": ("lao dong", "thu viec", "tien luong", "sa thai", "nghi viec"),
+    "dautu": ("dau tu", "nha dau tu", "du an"),
+    "luatdoanhnghiep": (
+        "luat doanh nghiep", "thanh lap cong ti", "cong ti co phan", "tnhh", "trach nhiem huu han",
+        "giai the", "dang ki doanh nghiep", "von dieu le", "hoi dong thanh vien",
+    ),
+}
+
+
+def normalize_vi(text: str) -> str:
+    """Bỏ dấu, lowercase, thống nhất i/y (lý/lí, kỳ/kì) để so khớp tên luật."""
+    text = unicodedata.normalize("NFD", text)
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+    text = text.replace("đ", "d").replace("Đ", "D").lower()
+    text = re.sub(r"(?<=\d)\s*-\s*(?=\d)", "/", text)
+    text = re.sub(r"\b([klmst])y\b", r"\1i", text)
+    text = re.sub(r"[^a-z0-9/]+", " ", text)
+    return f" {text.strip()} "
+
+
+def law_aliases(source_file: str) -> List[str]:
+    """Các cách gọi tên một văn bản, suy ra từ tên file (đã normalize)."""
+    stem = pathlib.Path(source_file).stem
+    aliases = []
+    number = LAW_NUMBER.search(stem)
+    if number:
+        aliases.append(f"{int(number.group(1))}/{number.group(2)}")
+    words = normalize_vi(re.split(r"\d", stem, maxsplit=1)[0]).strip()
+    if len(words.split()) >= 2:
+        aliases.append(words)
+    return aliases
+
+
+def doc_type(source_file: str) -> str:
+    """Luật / Nghị định / Luật sửa đổi, bổ sung — suy ra từ tên file."""
+    name = normalize_vi(pathlib.Path(source_file).stem).replace(" ", "")
+    if "suadoi" in name:
+        return DOC_AMENDMENT
+    if "nghidinh" in name or "ndcp" in name.replace("/", ""):
+        return DOC_DECREE
+    return DOC_LAW
+
+
+def route_domains(query: str, source_files: List[str]) -> Set[str]:
+    """Các văn bản thuộc lĩnh vực được nhắc trong câu hỏi (rỗng = không route được)."""
+    norm = normalize_vi(query)
+    patterns = [p for p, keys in DOMAIN_KEYWORDS.items() if any(f" {k} " in norm for k in keys)]
+    if not patterns:
+        return set()
+    return {
+        f for f in source_files
+        if any(p in normalize_vi(pathlib.Path(f).stem).replace(" ", "") for p in patterns)
+    }
+
+
+class ArticleIndex:
+    """
+    {source_file: {"17": {"title", "text", "clauses": {"1": {"text", "points": {"a": text}}}}}}
+    Khoá là số hiệu dạng chuỗi để dump thẳng ra JSON.
+    """
+
+    FILE_NAME = "articles.json"
+
+    def __init__(self):
+        self.laws: Dict[str, Dict[str, dict]] = {}
+        self._aliases: Dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return sum(len(a) for a in self.laws.values())
+
+    def add_law(self, source_file: str, text: str):
+        articles: Dict[str, dict] = {}
+        article = clause = None
+        for line in text.split("\n"):
+            line = line.strip()
+            if not line:
+                continue
+            m = ARTICLE_HEADING.match(line)
+            if m:
+                # Luật sửa đổi có thể trích lại "Điều N." của luật gốc -> giữ lần xuất hiện đầu
+                if m.group(1) in articles:
+                    article = clause = None
+                    continue
+                article = {"title": m.group(2).strip(), "lines": [line], "clauses": {}}
+                articles[m.group(1)] = article
+                clause = None
+                continue
+            if article is None:
+                continue
+            article["lines"].append(line)
+            m = CLAUSE_HEADING.match(line)
+            if m and m.group(1) not in article["clauses"]:
+                clause = {"lines": [line], "points": {}}
+                article["clauses"][m.group(1)] = clause
+                continue
+            if clause is None:
+                continue
+            clause["lines"].append(line)
+            m = POINT_HEADING.match(line)
+            if m and m.group(1) not in clause["points"]:
+                clause["points"][m.group(1)] = line
+
+        for art in articles.values():
+            art["text"] = "\n".join(art.pop("lines"))
+            for cl in art["clauses"].values():
+                cl["text"] = "\n".join(cl.pop("lines"))
+
+        self.laws[source_file] = articles
+        self._index_aliases(source_file)
+
+    def add_law_parsed(self, source_file: str, articles: Dict[str, dict]):
+        """Gắn cấu trúc đã parse sẵn (dùng lại từ index cũ khi build incremental)."""
+        self.laws[source_file] = articles
+        self._index_aliases(source_file)
+
+    @classmethod
+    def from_chunks(cls, chunks: List[Tuple[str, str]]) -> "ArticleIndex":
+        """Dựng lại từ chunk [(text, source_file)] khi index cũ chưa có articles.json."""
+        texts: Dict[str, List[str]] = {}
+        for text, source_file in chunks:
+            lines = text.split("\n")
+            if lines and lines[0].startswith("[NGUỒN:"):
+                lines = lines[1:]
+            # Chunk tách từ Điều quá dài lặp lại tiêu đề "Điều N. ... (tiếp)..."
+            if lines and "(tiếp)..." in lines[0]:
+                lines = lines[1:]
+            texts.setdefault(source_file, []).extend(lines)
+        index = cls()
+        for source_file, lines in texts.items():
+            index.add_law(source_file, "\n".join(lines))
+        return index
+
+    def _index_aliases(self, source_file: str):
+        for alias in law_aliases(source_file):
+            self._aliases[alias] = source_file
+
+    def resolve_law(self, query: str) -> Optional[str]:
+        """Tìm văn bản được nhắc tới trong câu hỏi: ưu tiên số hiệu, sau đó tên dài nhất."""
+        # Alias số hiệu không có số 0 đầu (int() lúc tạo): "03/2022" trong câu hỏi -> "3/2022"
+        norm = re.sub(r"(?<![\d/])0+(?=\d+/)", "", normalize_vi(query))
+        best, best_score = None, (-1, -1)
+        for alias, source_file in self._aliases.items():
+            if "/" in alias:
+                found = re.search(rf"(?<![\d/]){re.escape(alias)}(?![\d])", norm) is not None
+            else:
+                found = f" {alias} " in norm
+            score = ("/" in alias, len(alias))
+            if found and score > best_score:
+                best, best_score = source_file, score
+        return best
+
+    def get(self, source_file: str, article: str, clause: str = None, point: str = None) -> Optional[str]:
+        art = self.laws.get(source_file, {}).get(article)
+        if art is None:
+            return None
+        if clause is None:
+            return art["text"]
+        header = f"Điều {article}. {art['title']}".strip()
+        cl = art["clauses"].get(clause)
+        if cl is None:
+            return None
+        if point is None:
+            return f"{header}\n{cl['text']}"
+        pt = cl["points"].get(point)
+        if pt is None:
+            return None
+        return f"{header}\n{cl['text'].split(chr(10), 1)[0]}\n{pt}"
+
+    def lookup(self, query: str) -> List[Tuple[str, str]]:
+        """
+        Trả [(source_file, text)] cho các Điều/Khoản/Điểm được trích dẫn rõ trong câu hỏi.
+        Không xác định được văn bản hoặc không có trích dẫn -> [] (đi đường search thường).
+        """
+        q = unicodedata.normalize("NFC", query).lower()
+        articles = list(dict.fromkeys(ARTICLE_REF.findall(q)))
+        if not articles:
+            return []
+        source_file = self.resolve_law(query)
+        if source_file is None:
+            return []
+
+        clause = point = None
+        if len(articles) == 1:
+            m = CLAUSE_REF.search(q)
+            clause = m.group(1) if m else None
+            m = POINT_REF.search(q) if clause else None
+            point = m.group(1) if m else None
+
+        results = []
+        for article in articles:
+            text = self.get(source_file, article, clause, point)
+            if text is None and clause is not None:
+                text = self.get(source_file, article)  # khoản/điểm không khớp -> trả cả Điều
+            if text is not None:
+                results.append((source_file, text))
+        return results
+
+    def save(self, index_dir: pathlib.Path):
+        path = pathlib.Path(index_dir) / self.FILE_NAME
+        tmp = path.with_suffix(".json.tmp")
+        tmp.write_text(json.dumps(self.laws, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, index_dir: pathlib.Path) -> Optional["ArticleIndex"]:
+        path = pathlib.Path(index_dir) / cls.FILE_NAME
+        if not path.exists():
+            return None
+        index = cls()
+        index.laws = json.loads(path.read_text(encoding="utf-8"))
+        for source_file in index.laws:
+            index._index_aliases(source_file)
+        return index
@@ -0,0 +1,244 @@
+"""
+Đồng bộ file luật từ GCS về data_laws.
+
+- Tải song song (giới hạn số worker).
+- So generation/MD5 của blob với manifest local -> chỉ tải file mới hoặc đã đổi.
+- Tải vào file tạm, kiểm MD5 rồi os.replace (không bao giờ để lại file dở).
+- Xoá file local đã bị xoá trên bucket (chỉ những file do sync tải về, ghi trong manifest); bỏ qua
+  nếu listing rỗng hoặc số file sẽ xoá vượt ngưỡng (listing lỗi/nhầm prefix không xoá sạch data_laws).
+- File định danh theo đường dẫn tương đối so với prefix: cùng tên ở hai thư mục con không đè nhau.
+- Trả về SyncReport để rebuild index chỉ xử lý các file thay đổi.
+
+Test không cần GCS thật:
+- GCS_BUCKET_NAME=file:///duong/dan/thu_muc -> LocalDirSource đóng vai bucket.
+- Hoặc fake-gcs-server + STORAGE_EMULATOR_HOST (google-cloud-storage tự nhận).
+"""
+from __future__ import annotations
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set
+
+logger = logging.getLogger("LegalAI")
+
+MANIFEST_NAME = ".gcs_manifest.json"
+PATH_SEP = "__"  # "/" trong đường dẫn tương đối -> tên file local (data_laws là thư mục phẳng)
+
+
+@dataclass
+class RemoteObject:
+    name: str                   # tên file local = đường dẫn tương đối so với prefix, "/" -> PATH_SEP
+    key: str                    # đường dẫn đầy đủ trên bucket
+    generation: str
+    md5: Optional[str] = None   # base64, như blob.md5_hash của GCS (composite object không có)
+    size: int = 0
+
+
+@dataclass
+class SyncReport:
+    added: List[str] = field(default_factory=list)
+    updated: List[str] = field(default_factory=list)
+    deleted: List[str] = field(default_factory=list)
+    unchanged: List[str] = field(default_factory=list)
+    failed: Dict[str, str] = field(default_factory=dict)
+    seconds: float = 0.0
+
+    @property
+    def changed(self) -> Set[str]:
+        return set(self.added) | set(self.updated) | set(self.deleted)
+
+    def summary(self) -> str:
+        return (
+            f"+{len(self.added)} ~{len(self.updated)} -{len(self.deleted)} "
+            f"={len(self.unchanged)} lỗi:{len(self.failed)} ({self.seconds:.2f}s)"
+        )
+
+
+def local_name(relative: str) -> str:
+    return relative.strip("/").replace("/", PATH_SEP)
+
+
+def file_md5_b64(path: pathlib.Path) -> str:
+    h = hashlib.md5()
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return base64.b64encode(h.digest()).decode("ascii")
+
+
+class GCSSource:
+    def __init__(self, bucket_name: str, prefix: str = "", key_path: Optional[pathlib.Path] = None):
+        from google.cloud import storage
+
+        if key_path is not None and key_path.exists():
+            from google.oauth2 import service_account
+
+            logger.info(f"🔑 Tìm thấy key GCS tại: {key_path}")
+            credentials = service_account.Credentials.from_service_account_file(str(key_path))
+            client = storage.Client(credentials=credentials)
+        else:
+            logger.warning("⚠️ Không thấy file gcs_key.json. Thử dùng credentials mặc định...")
+            client = storage.Client()
+        self.bucket = client.bucket(bucket_name)
+        self.prefix = prefix or ""
+
+    def list(self, suffix: str) -> List[RemoteObject]:
+        out = []
+        for blob in self.bucket.list_blobs(prefix=self.prefix):
+            relative = blob.name[len(self.prefix):].strip("/")
+            if relative and relative.lower().endswith(suffix):
+                out.append(RemoteObject(
+                    local_name(relative), blob.name, str(blob.generation), blob.md5_hash, blob.size or 0
+                ))
+        return out
+
+    def download(self, obj: RemoteObject, dest: pathlib.Path):
+        # Ghim generation: object bị ghi đè giữa lúc list và tải -> lỗi thay vì tải nhầm bản mới
+        self.bucket.blob(obj.key, generation=int(obj.generation)).download_to_filename(str(dest))
+
+
+class LocalDirSource:
+    """Thư mục local đóng vai bucket (test/dev). generation = mtime_ns."""
+
+    def __init__(self, root: pathlib.Path):
+        self.root = pathlib.Path(root)
+
+    def list(self, suffix: str) -> List[RemoteObject]:
+        out = []
+        for f in sorted(self.root.rglob("*")):
+            if f.is_file() and f.name.lower().endswith(suffix):
+                st = f.stat()
+                out.append(RemoteObject(
+                    local_name(f.relative_to(self.root).as_posix()), str(f), str(st.st_mtime_ns),
+                    file_md5_b64(f), st.st_size,
+                ))
+        return out
+
+    def download(self, obj: RemoteObject, dest: pathlib.Path):
+        with open(obj.key, "rb") as src, dest.open("wb") as out:
+            while True:
+                block = src.read(1 << 20)
+                if not block:
+                    break
+                out.write(block)
+
+
+class LawSync:
+    def __init__(self, source, dest_dir: pathlib.Path, max_workers: int = 8, prune: bool = True,
+                 suffix: str = ".docx", prune_max_fraction: float = 0.5):
+        self.source = source
+        self.dest_dir = pathlib.Path(dest_dir)
+        self.manifest_path = self.dest_dir / MANIFEST_NAME
+        self.max_workers = max_workers
+        self.prune = prune
+        self.prune_max_fraction = prune_max_fraction  # Tỷ lệ file (trong manifest) tối đa được xoá một lần
+        self.suffix = suffix
+
+    def _load_manifest(self) -> Dict[str, dict]:
+        if not self.manifest_path.exists():
+            return {}
+        try:
+            return json.loads(self.manifest_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Manifest hỏng ({e}) -> kiểm tra lại toàn bộ file.")
+            return {}
+
+    def _save_manifest(self, manifest: Dict[str, dict]):
+        tmp = self.manifest_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=1, sort_keys=True), encoding="utf-8")
+        os.replace(tmp, self.manifest_path)
+
+    def _is_current(self, obj: RemoteObject, entry: Optional[dict]) -> bool:
+        if not entry:
+            return False
+        local = self.dest_dir / obj.name
+        if not local.exists() or local.stat().st_size != obj.size:
+            return False
+        if entry.get("generation") == obj.generation:
+            return True
+        # Generation đổi nhưng nội dung như cũ (upload lại cùng file) -> không cần tải
+        return bool(obj.md5) and entry.get("md5") == obj.md5
+
+    def _download(self, obj: RemoteObject) -> dict:
+        dest = self.dest_dir / obj.name
+        tmp = self.dest_dir / f".{obj.name}.{obj.generation}.part"
+        try:
+            self.source.download(obj, tmp)
+            md5 = file_md5_b64(tmp)
+            if obj.md5 and md5 != obj.md5:
+                raise IOError(f"MD5 không khớp (remote {obj.md5}, local {md5})")
+            os.replace(tmp, dest)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+        return {"generation": obj.generation, "md5": md5, "size": obj.size, "synced_at": time.time()}
+
+    def run(self) -> SyncReport:
+        started = time.perf_counter()
+        report = SyncReport()
+        self.dest_dir.mkdir(parents=True, exist_ok=True)
+        manifest = self._load_manifest()
+        remote = {o.name: o for o in self.source.list(self.suffix)}
+
+        todo = []
+        for name, obj in remote.items():
+            if self._is_current(obj, manifest.get(name)):
+                manifest[name]["generation"] = obj.generation
+                report.unchanged.append(name)
+            else:
+                todo.append(obj)
+
+        if todo:
+            logger.info(f"⬇️ Tải {len(todo)} file từ bucket ({self.max_workers} luồng)...")
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="gcs-sync") as pool:
+                futures = {pool.submit(self._download, obj): obj for obj in todo}
+                for fut in as_completed(futures):
+                    obj = futures[fut]
+                    try:
+                        entry = fut.result()
+                    except Exception as e:
+                        report.failed[obj.name] = str(e)
+                        logger.error(f"❌ Tải lỗi {obj.name}: {e}")
+                        continue
+                    (report.updated if obj.name in manifest else report.added).append(obj.name)
+                    manifest[obj.name] = entry
+
+        if self.prune:
+            self._prune(manifest, remote, report)
+
+        self._save_manifest(manifest)
+        report.seconds = time.perf_counter() - started
+        return report
+
+    def _prune(self, manifest: Dict[str, dict], remote: Dict[str, RemoteObject], report: SyncReport):
+        gone = sorted(set(manifest) - set(remote))
+        if not gone:
+            return
+        # Listing rỗng / xoá quá nhiều gần như luôn là lỗi (sai prefix, quyền, bucket đang upload lại)
+        if not remote or len(gone) > self.prune_max_fraction * len(manifest):
+            logger.warning(
+                f"⚠️ Bỏ qua xoá file: {len(gone)}/{len(manifest)} file không còn trong listing "
+                f"({len(remote)} file trên bucket, ngưỡng {self.prune_max_fraction:.0%})."
+            )
+            return
+        for name in gone:
+            local = self.dest_dir / name
+            if local.exists():
+                local.unlink()
+            del manifest[name]
+            report.deleted.append(name)
+            logger.info(f"🗑️ Xoá {name} (không còn trên bucket)")
+
+
+def make_source(bucket: str, prefix: str = "", key_path: Optional[pathlib.Path] = None):
+    if bucket.startswith("file://"):
+        return LocalDirSource(pathlib.Path(bucket[len("file://"):]) / prefix)
+    return GCSSource(bucket, prefix, key_path)
+
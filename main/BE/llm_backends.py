@@ -0,0 +1,230 @@
+"""
+Backend LLM có thể thay thế cho GeminiClient.
+
+- GeminiBackend: gọi Gemini thật (mặc định).
+- FakeLLMBackend: chạy hoàn toàn offline, trả JSON/text theo mẫu,
+  có độ trễ và tỉ lệ lỗi cấu hình được -> dùng cho load-test, không tốn quota.
+
+Chọn backend qua biến môi trường LLM_BACKEND=gemini|fake.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from typing import Iterator, Optional
+
+logger = logging.getLogger("LegalAI")
+
+GEMINI_MODEL_NAME = "gemini-2.5-flash"
+
+
+class LLMBackendError(Exception):
+    """Lỗi từ backend LLM (upstream lỗi, hết quota, timeout...)."""
+
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class LLMBackend:
+    """
+    Interface tối thiểu: nhận prompt, trả text thô (JSON string nếu json_mode).
+    max_tokens: giới hạn số token sinh ra; timeout: số giây tối đa cho lời gọi (None = mặc định backend).
+    """
+
+    name = "base"
+
+    def generate(
+        self, prompt: str, json_mode: bool = False, max_tokens: Optional[int] = None, timeout: Optional[float] = None
+    ) -> str:
+        raise NotImplementedError
+
+    def stream(self, prompt: str, max_tokens: Optional[int] = None, timeout: Optional[float] = None) -> Iterator[str]:
+        """Sinh text theo từng đoạn khi có; backend không hỗ trợ thì trả cả câu một lần."""
+        yield self.generate(prompt, max_tokens=max_tokens, timeout=timeout)
+
+
+class GeminiBackend(LLMBackend):
+    name = "gemini"
+
+    def __init__(self, api_key: Optional[str] = None, model_name: str = GEMINI_MODEL_NAME):
+        self.api_key = api_key or os.getenv("GEMINI_API_KEY")
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _get_model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    import google.generativeai as genai
+
+                    if not self.api_key:
+                        raise RuntimeError("Thiếu GEMINI_API_KEY")
+                    genai.configure(api_key=self.api_key)
+                    self._model = genai.GenerativeModel(self.model_name)
+        return self._model
+
+    @staticmethod
+    def _options(json_mode: bool, max_tokens: Optional[int], timeout: Optional[float]) -> dict:
+        import google.generativeai as genai
+
+        config = {}
+        if json_mode:
+            config["response_mime_type"] = "application/json"
+        if max_tokens:
+            config["max_output_tokens"] = max_tokens
+        options = {}
+        if config:
+            options["generation_config"] = genai.GenerationConfig(**config)
+        if timeout is not None:
+            options["request_options"] = {"timeout": max(timeout, 0.1)}
+        return options
+
+    def generate(
+        self, prompt: str, json_mode: bool = False, max_tokens: Optional[int] = None, timeout: Optional[float] = None
+    ) -> str:
+        resp = self._get_model().generate_content(prompt, **self._options(json_mode, max_tokens, timeout))
+        return resp.text
+
+    def stream(self, prompt: str, max_tokens: Optional[int] = None, timeout: Optional[float] = None) -> Iterator[str]:
+        options = self._options(False, max_tokens, timeout)
+        for chunk in self._get_model().generate_content(prompt, stream=True, **options):
+            # Chunk cuối (finish_reason, safety...) có thể không có text
+            if chunk.parts:
+                yield chunk.text
+
+
+class FakeLLMBackend(LLMBackend):
+    """
+    Stand-in offline cho Gemini.
+    Độ trễ lấy theo phân phối lognormal quanh `latency_ms` (median), `latency_sigma`=0 -> cố định.
+    Với xác suất `error_rate` sẽ raise LLMBackendError (giả lập 429/503).
+    """
+
+    name = "fake"
+
+    def __init__(
+        self,
+        latency_ms: float = 800.0,
+        latency_sigma: float = 0.5,
+        error_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "FakeLLMBackend":
+        seed = os.getenv("FAKE_LLM_SEED")
+        return cls(
+            latency_ms=float(os.getenv("FAKE_LLM_LATENCY_MS", "800")),
+            latency_sigma=float(os.getenv("FAKE_LLM_LATENCY_SIGMA", "0.5")),
+            error_rate=float(os.getenv("FAKE_LLM_ERROR_RATE", "0")),
+            seed=int(seed) if seed else None,
+        )
+
+    def _sample(self):
+        with self._lock:
+            if self.latency_sigma > 0:
+                delay = self.latency_ms * self._rng.lognormvariate(0.0, self.latency_sigma)
+            else:
+                delay = self.latency_ms
+            failed = self._rng.random() < self.error_rate
+        return delay / 1000.0, failed
+
+    @staticmethod
+    def _timed_out(delay: float, timeout: Optional[float]) -> bool:
+        if timeout is not None and delay > timeout:
+            time.sleep(max(timeout, 0.0))
+            return True
+        return False
+
+    def generate(
+        self, prompt: str, json_mode: bool = False, max_tokens: Optional[int] = None, timeout: Optional[float] = None
+    ) -> str:
+        delay, failed = self._sample()
+        if self._timed_out(delay, timeout):
+            raise LLMBackendError("FakeLLM: 504 Deadline exceeded (giả lập timeout)", retryable=True)
+        time.sleep(delay)
+        if failed:
+            raise LLMBackendError("FakeLLM: 429 Resource has been exhausted (giả lập)", retryable=True)
+        if json_mode:
+            return self._json_response(prompt)
+        return self._truncate(self._text_response(prompt), max_tokens)
+
+    def stream(self, prompt: str, max_tokens: Optional[int] = None, timeout: Optional[float] = None) -> Iterator[str]:
+        # Độ trễ chia đều cho các từ, lỗi (nếu có) xảy ra trước token đầu
+        delay, failed = self._sample()
+        if failed:
+            time.sleep(delay / 2)
+            raise LLMBackendError("FakeLLM: 429 Resource has been exhausted (giả lập)", retryable=True)
+        pieces = re.findall(r"\S+\s*", self._truncate(self._text_response(prompt), max_tokens))
+        started = time.monotonic()
+        for piece in pieces:
+            time.sleep(delay / len(pieces))
+            if timeout is not None and time.monotonic() - started > timeout:
+                raise LLMBackendError("FakeLLM: 504 Deadline exceeded (giả lập timeout)", retryable=True)
+            yield piece
+
+    @staticmethod
+    def _truncate(text: str, max_tokens: Optional[int]) -> str:
+        # Xấp xỉ 1 từ ~ 1 token
+        if not max_tokens:
+            return text
+        return " ".join(text.split(" ")[:max_tokens])
+
+    # --- Mẫu trả lời ---
+
+    @staticmethod
+    def _json_response(prompt: str) -> str:
+        if "Phân loại ý định" in prompt:
+            m = re.search(r'Input:\s*"(.*?)"\s*\n\s*Output JSON', prompt, flags=re.DOTALL)
+            text = m.group(1).strip() if m else ""
+            lowered = text.lower()
+            if "phân tích" in lowered or "file" in lowered or "hợp đồng:" in lowered:
+                mode = "phan_tich_hop_dong"
+            elif "soạn" in lowered:
+                mode = "goi_y_dieu_khoan"
+            elif lowered in {"xin chào", "chào", "hello", "hi"}:
+                mode = "chatchit"
+            else:
+                mode = "tra_cuu_luat"
+            return json.dumps({"clean_text": text, "mode": mode}, ensure_ascii=False)
+
+        if "search queries" in prompt:
+            m = re.search(r'Phân tích câu hỏi:\s*"(.*?)"\s*\n', prompt, flags=re.DOTALL)
+            q = m.group(1).strip() if m else "quy định pháp luật doanh nghiệp"
+            return json.dumps([q, f"điều kiện {q}", f"thủ tục {q}"], ensure_ascii=False)
+
+        if "phân loại hợp đồng" in prompt:
+            return json.dumps({"status": "FINAL", "reason": "FakeLLM: mặc định FINAL"}, ensure_ascii=False)
+
+        return json.dumps({"result": "ok"})
+
+    @staticmethod
+    def _text_response(prompt: str) -> str:
+        return (
+            "# Kết luận ngắn gọn\n"
+            "Đây là câu trả lời giả lập từ FakeLLMBackend (không gọi Gemini).\n\n"
+            "# Căn cứ pháp lý\n"
+            f"- Độ dài prompt: {len(prompt)} ký tự.\n\n"
+            "# Cảnh báo\n"
+            "Nội dung chỉ dùng cho kiểm thử tải."
+        )
+
+
+def create_backend(name: Optional[str] = None) -> LLMBackend:
+    name = (name or os.getenv("LLM_BACKEND", "gemini")).lower()
+    if name == "fake":
+        logger.info("🧪 LLM backend: FakeLLMBackend (offline)")
+        return FakeLLMBackend.from_env()
+    return GeminiBackend()
@@ -0,0 +1,234 @@
+"""
+Lớp bảo vệ quanh các lời gọi LLM:
+1. Giới hạn đồng thời: global + theo từng call site (intent, cot, answer...).
+2. Token bucket: không vượt quota RPM của Gemini.
+3. Retry với exponential backoff + jitter cho lỗi tạm thời (429/503/timeout).
+4. Circuit breaker: upstream hỏng liên tục -> fail fast, trả degraded response.
+"""
+from __future__ import annotations
+
+import logging
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional, TypeVar
+
+from deadline import remaining
+from llm_backends import LLMBackendError
+from metrics import LLM_CIRCUIT_STATE, LLM_REJECTED, LLM_RETRIES
+
+logger = logging.getLogger("LegalAI")
+
+T = TypeVar("T")
+
+# Tên class exception (google.api_core / grpc) được coi là lỗi tạm thời
+RETRYABLE_ERROR_NAMES = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable",
+    "DeadlineExceeded", "InternalServerError", "GatewayTimeout", "Aborted",
+}
+RETRYABLE_MARKERS = ("429", "503", "504", "quota", "exhausted", "unavailable", "timeout")
+
+
+class LLMUnavailableError(Exception):
+    """Không gọi được LLM: circuit đang mở, hết slot hoặc hết token trong thời gian chờ."""
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, LLMBackendError):
+        return e.retryable
+    if type(e).__name__ in RETRYABLE_ERROR_NAMES:
+        return True
+    msg = str(e).lower()
+    return any(m in msg for m in RETRYABLE_MARKERS)
+
+
+class TokenBucket:
+    """Token bucket thread-safe: `rate` token/giây, tối đa `capacity` token."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> float:
+        """Lấy 1 token nếu có. Trả 0 nếu thành công, ngược lại số giây cần chờ."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire()
+            if wait == 0.0:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    CLOSED -> OPEN sau `failure_threshold` lỗi liên tiếp.
+    OPEN -> HALF_OPEN sau `recovery_timeout` giây, cho 1 lời gọi thăm dò.
+    Thăm dò thành công -> CLOSED, thất bại -> OPEN lại; kết thúc mà không có kết quả
+    (bị rate limit, hết deadline) -> release_probe() trả lại lượt thăm dò.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_owner: Optional[int] = None  # Thread đang giữ lượt thăm dò (HALF_OPEN)
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.warning(f"🔌 Circuit breaker LLM: {self.state} -> {state}")
+        self.state = state
+        LLM_CIRCUIT_STATE.set({self.CLOSED: 0, self.HALF_OPEN: 1, self.OPEN: 2}[state])
+
+    def rejecting(self) -> bool:
+        """OPEN và chưa tới lúc thăm dò: fail fast, không cần chờ token."""
+        with self._lock:
+            return self.state == self.OPEN and time.monotonic() - self._opened_at < self.recovery_timeout
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and self._probe_owner is None:
+                self._probe_owner = threading.get_ident()
+                return True
+            return False
+
+    def release_probe(self):
+        """Gọi sau mỗi lần thử: thread đang giữ lượt thăm dò mà chưa ghi nhận kết quả thì trả lại."""
+        with self._lock:
+            if self._probe_owner == threading.get_ident():
+                self._probe_owner = None
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probe_owner = None
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_owner = None
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+
+class LLMGuard:
+    """Gộp limiter + rate limit + retry + circuit breaker cho mọi lời gọi LLM."""
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        per_call_concurrency: int = 4,
+        rate_per_minute: float = 60.0,
+        burst: Optional[float] = None,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+        acquire_timeout: float = 30.0,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30.0,
+    ):
+        self._global = threading.BoundedSemaphore(max_concurrency)
+        self.per_call_concurrency = per_call_concurrency
+        self._per_call: Dict[str, threading.BoundedSemaphore] = {}
+        self._per_call_lock = threading.Lock()
+        self.bucket = TokenBucket(rate_per_minute / 60.0, burst or max(1.0, rate_per_minute / 6.0))
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.acquire_timeout = acquire_timeout
+        self.breaker = CircuitBreaker(failure_threshold, recovery_timeout)
+
+    def _call_semaphore(self, call: str) -> threading.BoundedSemaphore:
+        with self._per_call_lock:
+            if call not in self._per_call:
+                self._per_call[call] = threading.BoundedSemaphore(self.per_call_concurrency)
+            return self._per_call[call]
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter: random trong [0, min(max, base * 2^attempt)]
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _reject(self, call: str, reason: str):
+        LLM_REJECTED.labels(call, reason).inc()
+        raise LLMUnavailableError(f"LLM không khả dụng ({reason})")
+
+    def run(self, call: str, fn: Callable[[], T]) -> T:
+        if remaining(self.acquire_timeout) <= 0:
+            self._reject(call, "deadline")
+        call_sem = self._call_semaphore(call)
+        if not call_sem.acquire(timeout=max(0.0, remaining(self.acquire_timeout))):
+            self._reject(call, "call_concurrency")
+        try:
+            if not self._global.acquire(timeout=max(0.0, remaining(self.acquire_timeout))):
+                self._reject(call, "global_concurrency")
+            try:
+                return self._run_with_retry(call, fn)
+            finally:
+                self._global.release()
+        finally:
+            call_sem.release()
+
+    def _run_with_retry(self, call: str, fn: Callable[[], T]) -> T:
+        attempt = 0
+        while True:
+            if self.breaker.rejecting():
+                self._reject(call, "circuit_open")
+            # Lấy token trước rồi mới lấy lượt thăm dò: bị rate limit thì không giữ probe của HALF_OPEN
+            if not self.bucket.acquire(remaining(self.acquire_timeout)):
+                self._reject(call, "rate_limited")
+            if not self.breaker.allow():
+                self._reject(call, "circuit_open")
+            try:
+                result = fn()
+            except Exception as e:
+                retryable = is_retryable(e)
+                out_of_time = remaining(1.0) <= 0
+                # Chỉ lỗi upstream (tạm thời) mới làm hỏng circuit. Lỗi cấu hình/parse/code không chứng
+                # minh upstream hỏng hay khoẻ: không ghi nhận gì, lượt thăm dò được trả ở `finally`.
+                # Timeout do deadline của chính request (client đặt ngắn) không tính là upstream hỏng.
+                if retryable and not out_of_time:
+                    self.breaker.record_failure()
+                if not retryable or out_of_time or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                if delay >= remaining(delay + 1.0):
+                    raise  # Chờ xong retry thì đã quá deadline của request
+                attempt += 1
+                LLM_RETRIES.labels(call).inc()
+                logger.warning(f"🔁 [{call}] Retry {attempt}/{self.max_retries} sau {delay:.2f}s: {e}")
+                time.sleep(delay)
+                continue
+            else:
+                self.breaker.record_success()
+                return result
+            finally:
+                # Thoát mà chưa record (hết deadline, BaseException...) -> không kẹt HALF_OPEN
+                self.breaker.release_probe()
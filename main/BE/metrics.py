@@ -0,0 +1,178 @@
+"""
+Metrics dùng chung cho toàn hệ thống (Prometheus).
+Các module khác chỉ import metric từ đây để tránh đăng ký trùng tên.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# ===========================================================
+# MICRO-BATCHING (EMBEDDING / RERANK)
+# ===========================================================
+
+BATCH_SIZE = Histogram(
+    "legal_ai_batch_size",
+    "Số item trong mỗi batch gửi xuống model",
+    ["batcher"],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+
+BATCH_QUEUE_WAIT = Histogram(
+    "legal_ai_batch_queue_wait_seconds",
+    "Thời gian một lời gọi chờ trong hàng đợi trước khi được đưa vào batch",
+    ["batcher"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+
+# ===========================================================
+# ADMISSION CONTROL (API)
+# ===========================================================
+
+ADMISSION_IN_FLIGHT = Gauge(
+    "legal_ai_admission_in_flight",
+    "Số request đang xử lý theo loại (chat / contract / batch)",
+    ["cls"],
+)
+
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "legal_ai_admission_queue_depth",
+    "Số request đang chờ slot xử lý theo loại",
+    ["cls"],
+)
+
+ADMISSION_QUEUE_WAIT = Histogram(
+    "legal_ai_admission_queue_wait_seconds",
+    "Thời gian request chờ trong hàng đợi trước khi được nhận",
+    ["cls"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0),
+)
+
+ADMISSION_REJECTED = Counter(
+    "legal_ai_admission_rejected_total",
+    "Số request bị từ chối: rate_limited (429), queue_full / queue_timeout (503)",
+    ["cls", "reason"],
+)
+
+# ===========================================================
+# RETRIEVAL CHIA SHARD
+# ===========================================================
+
+SHARD_LATENCY = Histogram(
+    "legal_ai_shard_latency_seconds",
+    "Round-trip một lần search trên từng shard (gửi query -> nhận top_k)",
+    ["shard"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+SHARD_ERRORS = Counter(
+    "legal_ai_shard_errors_total",
+    "Số lần shard bị bỏ qua khi search: timeout hoặc error (process chết, mất kết nối)",
+    ["shard", "reason"],
+)
+
+# ===========================================================
+# PIPELINE (LegalOrchestrator.process)
+# ===========================================================
+
+STAGE_LATENCY = Histogram(
+    "legal_ai_stage_latency_seconds",
+    "Độ trễ từng bước trong pipeline xử lý request",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+
+REQUESTS_TOTAL = Counter(
+    "legal_ai_requests_total",
+    "Số request theo mode sau khi phân loại ý định",
+    ["mode"],
+)
+# Mode lấy từ output LLM: ngoài tập này gộp vào "other" để số label không tăng theo nội dung LLM trả về
+REQUEST_MODES = frozenset({"tra_cuu_luat", "luat_su_online", "phan_tich_hop_dong", "goi_y_dieu_khoan", "chatchit"})
+
+DEGRADATIONS = Counter(
+    "legal_ai_degradations_total",
+    "Số request phải bỏ bớt bước vì sắp hết deadline (skip_cot, skip_rerank, shrink_context, cap_generation)",
+    ["step"],
+)
+
+LLM_ERRORS = Counter(
+    "legal_ai_llm_errors_total",
+    "Số lần gọi Gemini bị lỗi",
+    ["call"],
+)
+
+LLM_FALLBACKS = Counter(
+    "legal_ai_llm_fallbacks_total",
+    "Số lần trả về giá trị fallback thay cho output của Gemini",
+    ["call"],
+)
+
+LLM_RETRIES = Counter(
+    "legal_ai_llm_retries_total",
+    "Số lần retry lời gọi Gemini (lỗi tạm thời: 429/503/timeout)",
+    ["call"],
+)
+
+LLM_REJECTED = Counter(
+    "legal_ai_llm_rejected_total",
+    "Số lời gọi LLM bị từ chối trước khi gửi (circuit mở, hết slot, rate limit)",
+    ["call", "reason"],
+)
+
+LLM_CIRCUIT_STATE = Gauge(
+    "legal_ai_llm_circuit_state",
+    "Trạng thái circuit breaker LLM: 0=closed, 1=half_open, 2=open",
+)
+
+PROMPT_CHARS = Histogram(
+    "legal_ai_prompt_chars",
+    "Độ dài prompt (ký tự) gửi lên Gemini",
+    ["call"],
+    buckets=(500, 1000, 2500, 5000, 10000, 20000, 40000, 80000),
+)
+
+CACHE_LOOKUPS = Counter(
+    "legal_ai_cache_lookups_total",
+    "Số lần tra cache (hit/miss) theo từng loại cache",
+    ["cache", "result"],
+)
+
+
+# Danh sách span (stage, giây) của request hiện tại, chỉ có khi đang collect_spans()
+_active_spans: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("legal_ai_spans", default=None)
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """Context manager đo thời gian một bước: `with stage_timer("faiss_search"): ...`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_LATENCY.labels(stage).observe(elapsed)
+        spans = _active_spans.get()
+        if spans is not None:
+            spans.append((stage, elapsed))
+
+
+@contextmanager
+def collect_spans():
+    """Gom các span của những stage_timer chạy bên trong khối `with`."""
+    spans: List[Tuple[str, float]] = []
+    token = _active_spans.set(spans)
+    try:
+        yield spans
+    finally:
+        _active_spans.reset(token)
+
+
+def record_request(mode) -> None:
+    REQUESTS_TOTAL.labels(mode if isinstance(mode, str) and mode in REQUEST_MODES else "other").inc()
+
+
+def record_cache(cache: str, hit: bool):
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
@@ -0,0 +1,159 @@
+"""
+Đồ thị stage cho một request: các stage độc lập chạy song song trên thread pool,
+stage phụ thuộc chỉ được chạy khi mọi dependency đã xong.
+Hỗ trợ stage "speculative" có thể huỷ, và log critical path khi kết thúc.
+
+Huỷ stage: chưa chạy (chờ dependency / còn trong hàng đợi executor) thì bỏ hẳn; đang chạy thì
+stage tự hỏi `stage_cancelled()` giữa các bước tốn kém để dừng sớm, kết quả bị bỏ qua.
+"""
+from __future__ import annotations
+
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import Executor, Future
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from profiling import stage_scope
+
+logger = logging.getLogger("LegalAI")
+
+_cancel_event: ContextVar[Optional[threading.Event]] = ContextVar("legal_ai_stage_cancel", default=None)
+
+
+def stage_cancelled() -> bool:
+    """True nếu stage đang chạy trên thread này đã bị huỷ (ngoài StageGraph -> luôn False)."""
+    event = _cancel_event.get()
+    return event is not None and event.is_set()
+
+
+class StageGraph:
+    """
+    Dùng:
+        g = StageGraph(executor)
+        g.add("intent", lambda: ...)
+        g.add("cot", lambda intent: ..., deps=("intent",))
+        g.result("cot")
+    Hàm của stage nhận kết quả các dependency theo đúng thứ tự `deps`.
+    """
+
+    def __init__(self, executor: Executor):
+        self._executor = executor
+        self._t0 = time.perf_counter()
+        self._futures: Dict[str, Future] = {}
+        self._tasks: Dict[str, Future] = {}  # future của executor, để huỷ khi còn trong hàng đợi
+        self._cancel_events: Dict[str, threading.Event] = {}
+        self._deps: Dict[str, Tuple[str, ...]] = {}
+        self._timings: Dict[str, Tuple[float, float]] = {}
+        self._cancelled: set = set()
+        self._lock = threading.Lock()
+
+    def add(self, name: str, fn: Callable[..., Any], deps: Sequence[str] = ()) -> Future:
+        if name in self._futures:
+            raise ValueError(f"Stage '{name}' đã tồn tại")
+        deps = tuple(deps)
+        dep_futures = [self._futures[d] for d in deps]
+        out: Future = Future()
+        ctx = contextvars.copy_context()  # giữ span collector / deadline của request cho thread worker
+        cancel_event = self._cancel_events[name] = threading.Event()
+
+        def run(*args):
+            _cancel_event.set(cancel_event)
+            with stage_scope(name):
+                return fn(*args)
+
+        def work():
+            # Bị huỷ khi còn trong hàng đợi -> không chạy
+            if not out.set_running_or_notify_cancel():
+                return
+            start = time.perf_counter()
+            result, error = None, None
+            try:
+                args = [f.result() for f in dep_futures]
+                result = ctx.run(run, *args)
+            except BaseException as e:
+                error = e
+            # Ghi timing trước khi resolve future để critical path luôn thấy stage cuối
+            with self._lock:
+                self._timings[name] = (start - self._t0, time.perf_counter() - self._t0)
+            if error is not None:
+                out.set_exception(error)
+            else:
+                out.set_result(result)
+
+        def launch():
+            if not out.cancelled():
+                self._tasks[name] = self._executor.submit(work)
+
+        remaining = [len(dep_futures)]
+
+        def on_dep_done(_):
+            with self._lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                launch()
+
+        self._futures[name] = out
+        self._deps[name] = deps
+        if not dep_futures:
+            launch()
+        for f in dep_futures:
+            f.add_done_callback(on_dep_done)
+        return out
+
+    def result(self, name: str, timeout: Optional[float] = None) -> Any:
+        return self._futures[name].result(timeout=timeout)
+
+    def has(self, name: str) -> bool:
+        return name in self._futures
+
+    def cancel(self, name: str):
+        """Huỷ stage speculative: chưa chạy thì bỏ hẳn, đang chạy thì báo dừng sớm và bỏ qua kết quả."""
+        fut = self._futures.get(name)
+        if fut is None or name in self._cancelled:
+            return
+        self._cancelled.add(name)
+        self._cancel_events[name].set()
+        if fut.cancel():
+            task = self._tasks.get(name)
+            if task is not None:
+                task.cancel()  # Nhả chỗ trong hàng đợi executor
+            state = "chưa chạy"
+        else:
+            state = "đang chạy, dừng sớm" if not fut.done() else "đã xong, bỏ qua kết quả"
+        logger.info(f"✂️ Huỷ stage speculative '{name}' ({state})")
+
+    def critical_path(self, final: str) -> Tuple[List[str], float]:
+        """Đi ngược từ stage cuối theo dependency kết thúc muộn nhất."""
+        with self._lock:
+            timings = dict(self._timings)
+        if final not in timings:
+            return [], 0.0
+        path = [final]
+        cur = final
+        while True:
+            deps = [d for d in self._deps.get(cur, ()) if d in timings]
+            if not deps:
+                break
+            cur = max(deps, key=lambda d: timings[d][1])
+            path.append(cur)
+        path.reverse()
+        return path, timings[final][1]
+
+    def log_critical_path(self, final: str):
+        path, total = self.critical_path(final)
+        if not path:
+            return
+        with self._lock:
+            timings = dict(self._timings)
+        steps = " -> ".join(f"{n}({(timings[n][1] - timings[n][0]) * 1000:.0f}ms)" for n in path)
+        logger.info(f"⏱️ Critical path {total * 1000:.0f}ms: {steps}")
+
+    def timings(self) -> Dict[str, Tuple[float, float]]:
+        """{stage: (start, end)} tính bằng giây từ lúc tạo graph."""
+        with self._lock:
+            return dict(self._timings)
+
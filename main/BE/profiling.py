@@ -0,0 +1,299 @@
+"""
+Profiling theo yêu cầu cho từng request (bật bằng header admin hoặc lấy mẫu ngẫu nhiên).
+
+- Một thread sampler đọc stack (sys._current_frames) của đúng các thread đang làm việc cho
+  request: thread gọi process(), các thread stage của StageGraph (đăng ký qua stage_scope) và
+  worker micro-batch embedding/rerank trong lúc chạy batch có job của request (serve_scope).
+- Kết quả: folded stacks ("a;b;c <số mẫu>") -> mở bằng speedscope / flamegraph.pl,
+  kèm span từng stage_timer, dòng thời gian stage của StageGraph và kích thước prompt.
+- Khi không profile: stage_scope / note_prompt chỉ tốn một lần ContextVar.get().
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import pathlib
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional, Set
+
+from metrics import collect_spans
+
+logger = logging.getLogger("LegalAI")
+
+PROFILE_ID = re.compile(r"^[0-9a-f]{12}$")
+MAX_STACK_DEPTH = 128
+
+
+class Profile:
+    def __init__(self, profile_id: str, query: str, file_path: Optional[str], interval_s: float):
+        self.id = profile_id
+        self.query = query
+        self.file_path = file_path
+        self.interval_s = interval_s
+        self.started_at = time.time()
+        self.t0 = time.perf_counter()
+        self.samples: Counter = Counter()
+        self.stages: List[Dict] = []
+        self.prompts: List[Dict] = []
+        self.spans: List = []
+        self._threads: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def attach(self, ident: int, name: str):
+        with self._lock:
+            self._threads[ident] = name
+
+    def detach(self, ident: int):
+        with self._lock:
+            self._threads.pop(ident, None)
+
+    def threads(self) -> Dict[int, str]:
+        with self._lock:
+            return dict(self._threads)
+
+    def to_dict(self, duration_s: float, error: Optional[str]) -> Dict:
+        spans: Dict[str, Dict] = {}
+        for stage, seconds in self.spans:
+            s = spans.setdefault(stage, {"count": 0, "seconds": 0.0})
+            s["count"] += 1
+            s["seconds"] = round(s["seconds"] + seconds, 4)
+        return {
+            "id": self.id,
+            "query": self.query[:200],
+            "file": pathlib.Path(self.file_path).name if self.file_path else None,
+            "started_at": self.started_at,
+            "duration_s": round(duration_s, 4),
+            "error": error,
+            "interval_ms": round(self.interval_s * 1000, 2),
+            "samples": sum(self.samples.values()),
+            "spans": spans,
+            "stages": sorted(self.stages, key=lambda s: s["start_s"]),
+            "prompts": self.prompts,
+            "folded": "\n".join(f"{stack} {n}" for stack, n in self.samples.most_common()),
+        }
+
+
+# Profile của request hiện tại (truyền sang thread stage qua contextvars.copy_context)
+_active_profile: ContextVar[Optional[Profile]] = ContextVar("legal_ai_profile", default=None)
+
+
+def _thread_group(name: str) -> str:
+    # "stage_3" / "AnyIO worker thread" -> gộp các thread cùng pool vào một gốc flamegraph
+    return re.sub(r"[_-]?\d+$", "", name) or name
+
+
+def _fold(frame) -> str:
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+def _sample_loop(profile: Profile, stop: threading.Event):
+    while not stop.wait(profile.interval_s):
+        frames = sys._current_frames()
+        for ident, name in profile.threads().items():
+            frame = frames.get(ident)
+            if frame is not None:
+                profile.samples[f"{name};{_fold(frame)}"] += 1
+
+
+@contextmanager
+def stage_scope(name: str):
+    """Bọc phần chạy của một stage: nếu request đang được profile thì sample cả thread này."""
+    profile = _active_profile.get()
+    if profile is None:
+        yield
+        return
+    ident = threading.get_ident()
+    profile.attach(ident, _thread_group(threading.current_thread().name))
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.detach(ident)
+        profile.stages.append({
+            "stage": name,
+            "start_s": round(start - profile.t0, 4),
+            "end_s": round(time.perf_counter() - profile.t0, 4),
+        })
+
+
+def current_profile() -> Optional[Profile]:
+    return _active_profile.get()
+
+
+@contextmanager
+def serve_scope(profiles: Iterable[Optional[Profile]], name: str):
+    """
+    Thread dùng chung (worker micro-batch) đang chạy việc cho các request trong `profiles`
+    (None = request không profile): sample thread này trong profile của từng request đó.
+    """
+    profiles = [p for p in dict.fromkeys(profiles) if p is not None]
+    if not profiles:
+        yield
+        return
+    ident = threading.get_ident()
+    group = _thread_group(threading.current_thread().name)
+    for profile in profiles:
+        profile.attach(ident, group)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        for profile in profiles:
+            profile.detach(ident)
+            profile.stages.append({
+                "stage": name,
+                "start_s": round(start - profile.t0, 4),
+                "end_s": round(end - profile.t0, 4),
+            })
+
+
+def note_prompt(call: str, chars: int):
+    profile = _active_profile.get()
+    if profile is not None:
+        profile.prompts.append({"call": call, "chars": chars, "at_s": round(time.perf_counter() - profile.t0, 4)})
+
+
+class ProfileStore:
+    """Mỗi profile một file JSON; chỉ giữ `keep` profile mới nhất."""
+
+    def __init__(self, root: pathlib.Path, keep: int = 50):
+        self.root = root
+        self.keep = keep
+        self._lock = threading.Lock()
+
+    def _path(self, profile_id: str) -> Optional[pathlib.Path]:
+        return self.root / f"{profile_id}.json" if PROFILE_ID.match(profile_id) else None
+
+    def save(self, data: Dict):
+        with self._lock:
+            self.root.mkdir(parents=True, exist_ok=True)
+            tmp = self.root / f".{data['id']}.tmp"
+            tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, self.root / f"{data['id']}.json")
+            files = sorted(self.root.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True)
+            for old in files[self.keep:]:
+                old.unlink(missing_ok=True)
+
+    def get(self, profile_id: str) -> Optional[Dict]:
+        path = self._path(profile_id)
+        if path is None or not path.exists():
+            return None
+        return json.loads(path.read_text(encoding="utf-8"))
+
+    def list(self) -> List[Dict]:
+        """Tóm tắt các profile, mới nhất trước (không kèm folded stacks)."""
+        if not self.root.exists():
+            return []
+        out = []
+        for path in sorted(self.root.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True):
+            try:
+                data = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                continue  # Đang bị xoá / ghi dở
+            out.append({k: data.get(k) for k in ("id", "query", "file", "started_at", "duration_s", "samples", "error")})
+        return out
+
+
+class Profiler:
+    def __init__(
+        self,
+        store: ProfileStore,
+        sample_rate: float = 0.0,
+        interval_ms: float = 5.0,
+        max_concurrent: int = 2,
+    ):
+        self.store = store
+        self.sample_rate = sample_rate
+        self.interval_s = max(interval_ms, 1.0) / 1000.0
+        self.max_concurrent = max_concurrent
+        self._active = 0
+        self._reserved: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def new_id(self, forced: bool = False) -> Optional[str]:
+        """
+        Id profile cho request này và giữ luôn một chỗ sampler: id trả về chắc chắn được ghi khi
+        truyền vào run() (không dùng tới thì release()). None nếu không profile (không ép, không
+        trúng mẫu, hoặc đã có max_concurrent profile chạy).
+        """
+        if not forced and (self.sample_rate <= 0 or random.random() >= self.sample_rate):
+            return None
+        with self._lock:
+            if self._active >= self.max_concurrent:
+                busy = True
+            else:
+                busy = False
+                self._active += 1
+                profile_id = uuid.uuid4().hex[:12]
+                self._reserved.add(profile_id)
+        if busy:
+            # Giới hạn số sampler chạy cùng lúc: quá thì bỏ qua, request vẫn chạy bình thường
+            logger.info(f"🔬 Bỏ qua profile: đang có {self.max_concurrent} profile chạy")
+            return None
+        return profile_id
+
+    def release(self, profile_id: Optional[str]):
+        """Trả chỗ đã giữ bởi new_id() nếu run() chưa dùng (request lỗi/bị từ chối trước khi chạy)."""
+        with self._lock:
+            if profile_id in self._reserved:
+                self._reserved.discard(profile_id)
+                self._active -= 1
+
+    @contextmanager
+    def run(self, profile_id: Optional[str], query: str, file_path: Optional[str] = None):
+        """Profile khối `with` (thread hiện tại + các stage nó tạo). profile_id None -> không làm gì."""
+        if profile_id is None:
+            yield
+            return
+        with self._lock:
+            reserved = profile_id in self._reserved
+            self._reserved.discard(profile_id)
+        if not reserved:
+            # Id không do new_id() cấp (hoặc đã dùng/trả): không giữ chỗ -> không profile
+            logger.info(f"🔬 Bỏ qua profile {profile_id}: id chưa được cấp chỗ")
+            yield
+            return
+
+        profile = Profile(profile_id, query, file_path, self.interval_s)
+        profile.attach(threading.get_ident(), "request")
+        token = _active_profile.set(profile)
+        stop = threading.Event()
+        sampler = threading.Thread(target=_sample_loop, args=(profile, stop), name="profiler", daemon=True)
+        sampler.start()
+        error = None
+        try:
+            with collect_spans() as spans:
+                profile.spans = spans
+                yield
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            duration = time.perf_counter() - profile.t0
+            stop.set()
+            sampler.join()
+            _active_profile.reset(token)
+            with self._lock:
+                self._active -= 1
+            data = profile.to_dict(duration, error)
+            try:
+                self.store.save(data)
+                logger.info(f"🔬 Profile {profile_id}: {duration * 1000:.0f}ms, {data['samples']} mẫu")
+            except OSError as e:
+                logger.warning(f"⚠️ Không lưu được profile {profile_id}: {e}")
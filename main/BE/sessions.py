@@ -0,0 +1,169 @@
+"""
+Phiên hội thoại phía server (SQLite local).
+
+Mỗi session giữ:
+- các lượt hỏi/đáp gần nhất (nguyên văn),
+- tóm tắt cuốn chiếu (rolling summary) của các lượt cũ hơn,
+- các đoạn luật đã retrieve để câu hỏi tiếp theo dùng lại thay vì chạy lại CoT + search.
+"""
+from __future__ import annotations
+
+import json
+import pathlib
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+
+@dataclass
+class Session:
+    id: str
+    turns: List[Dict[str, str]] = field(default_factory=list)     # [{"role": "user"|"assistant", "content": ...}]
+    summary: str = ""
+    chunks: List[Dict[str, str]] = field(default_factory=list)    # [{"text": ..., "source_file": ...}]
+    index_version: str = ""                                       # version index lúc retrieve các chunk trên
+    topic: str = ""                                               # câu hỏi (đã chuẩn hoá) lúc retrieve các chunk trên
+    updated_at: float = field(default_factory=time.time)
+
+    def add_turn(self, role: str, content: str, max_turns: int, max_chars: int, summary_chars: int):
+        self.turns.append({"role": role, "content": content[:max_chars]})
+        # Lượt cũ bị đẩy ra khỏi cửa sổ -> gộp (rút gọn) vào summary, không gọi LLM
+        while len(self.turns) > max_turns:
+            old = self.turns.pop(0)
+            label = "User" if old["role"] == "user" else "AI"
+            snippet = " ".join(old["content"].split())[:200]
+            self.summary = f"{self.summary}\n- {label}: {snippet}".strip()
+        if len(self.summary) > summary_chars:
+            self.summary = "…" + self.summary[-summary_chars:]
+
+    def chunks_for(self, index_version: str) -> List[Dict[str, str]]:
+        """Chunk đã lưu chỉ còn dùng được nếu index chưa bị reload sang version khác."""
+        return self.chunks if self.index_version == index_version else []
+
+    def add_chunks(self, chunks: List[Dict[str, str]], max_chunks: int, index_version: str = "", topic: str = ""):
+        """Chunk mới lên đầu, bỏ trùng, giữ tối đa max_chunks."""
+        if index_version != self.index_version:
+            self.chunks = []
+            self.index_version = index_version
+        if topic:
+            self.topic = topic
+        seen = set()
+        merged = []
+        for c in chunks + self.chunks:
+            if c["text"] not in seen:
+                seen.add(c["text"])
+                merged.append(c)
+        self.chunks = merged[:max_chunks]
+
+    def history_block(self) -> str:
+        """Lịch sử gọn để đưa vào prompt."""
+        parts = []
+        if self.summary:
+            parts.append(f"Tóm tắt các lượt trước:\n{self.summary}")
+        for t in self.turns:
+            label = "User" if t["role"] == "user" else "AI"
+            parts.append(f"{label}: {t['content']}")
+        return "\n".join(parts)
+
+
+class SessionStore:
+    """Lưu session vào SQLite, thread-safe, tự xoá session quá hạn."""
+
+    def __init__(
+        self,
+        db_path: pathlib.Path,
+        ttl_seconds: float = 86400,
+        max_turns: int = 6,
+        max_turn_chars: int = 1500,
+        summary_chars: int = 2000,
+        max_chunks: int = 12,
+    ):
+        self.db_path = pathlib.Path(db_path)
+        self.ttl_seconds = ttl_seconds
+        self.max_turns = max_turns
+        self.max_turn_chars = max_turn_chars
+        self.summary_chars = summary_chars
+        self.max_chunks = max_chunks
+        self._lock = threading.Lock()
+        # Khoá theo session id: ghi lượt mới là đọc-sửa-ghi, hai request song song cùng session phải lần lượt
+        self._session_locks: "weakref.WeakValueDictionary[str, threading.Lock]" = weakref.WeakValueDictionary()
+        self._session_locks_guard = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def create(self, history: Optional[List[dict]] = None) -> Session:
+        self.purge_expired()
+        session = Session(id=uuid.uuid4().hex)
+        # Lịch sử client gửi kèm (ChatRequest.history) dùng làm điểm khởi đầu
+        for h in history or []:
+            role = h.get("role", "user")
+            content = h.get("content") or h.get("text") or ""
+            if content:
+                self.add_turn(session, "assistant" if role in ("assistant", "ai", "bot") else "user", content)
+        return session
+
+    def add_turn(self, session: Session, role: str, content: str):
+        session.add_turn(role, content, self.max_turns, self.max_turn_chars, self.summary_chars)
+
+    def add_chunks(self, session: Session, chunks: List[Dict[str, str]], index_version: str = "", topic: str = ""):
+        session.add_chunks(chunks, self.max_chunks, index_version, topic)
+
+    def _session_lock(self, session_id: str) -> threading.Lock:
+        with self._session_locks_guard:
+            lock = self._session_locks.get(session_id)
+            if lock is None:
+                lock = self._session_locks[session_id] = threading.Lock()
+            return lock
+
+    def record_turn(self, session: Session, question: str, answer: str) -> Session:
+        """
+        Ghi một lượt hỏi/đáp rồi lưu. Request khác cùng session đã lưu trong lúc request này chạy ->
+        ghi tiếp lên bản mới nhất (gộp chunk của request này vào) thay vì ghi đè mất lượt của nó.
+        """
+        with self._session_lock(session.id):
+            latest = self.get(session.id)
+            if latest is not None and latest.updated_at > session.updated_at:
+                if session.chunks:
+                    self.add_chunks(latest, session.chunks, session.index_version, session.topic)
+                session = latest
+            self.add_turn(session, "user", question)
+            self.add_turn(session, "assistant", answer)
+            self.save(session)
+        return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        with self._lock:
+            row = self._conn.execute("SELECT data, updated_at FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if not row:
+            return None
+        if time.time() - row[1] > self.ttl_seconds:
+            self.delete(session_id)
+            return None
+        return Session(**json.loads(row[0]))
+
+    def save(self, session: Session):
+        session.updated_at = time.time()
+        data = json.dumps(asdict(session), ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, updated_at) VALUES (?, ?, ?)",
+                (session.id, data, session.updated_at),
+            )
+            self._conn.commit()
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self._conn.commit()
+
+    def purge_expired(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.ttl_seconds,))
+            self._conn.commit()
@@ -1,16 +1,32 @@
+import asyncio
 import os
+import json
+import math
+import queue
 import shutil
-from fastapi import FastAPI, HTTPException, UploadFile, File
+import threading
+import time
+import uuid
+from fastapi import FastAPI, Header, HTTPException, Query, Request, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from fastapi.staticfiles import StaticFiles  # <--- Mới thêm
-from fastapi.responses import PlainTextResponse, FileResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, FileResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from fastapi.concurrency import run_in_threadpool
 
 from typing import Optional, List
 
 # Import Class Orchestrator từ file chính của bạn (ví dụ tên file là test.py)
 # Lưu ý: File chứa class LegalOrchestrator nên đổi tên thành 'core_engine.py' để import cho chuẩn
-from test import LegalOrchestrator 
+from test import (
+    ADMIN_TOKEN, ADMISSION_CAPACITY, ADMISSION_CLASSES, ADMISSION_CLIENT_BURST, ADMISSION_CLIENT_RPM,
+    ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT_S, BATCH_REVIEW_DIR, BATCH_REVIEW_MAX_FILES,
+    BATCH_REVIEW_MAX_FILE_MB, BATCH_REVIEW_MAX_TOTAL_MB, BATCH_REVIEW_MAX_ZIP_RATIO,
+    CONTRACT_ABSENT_MIN_SCORE, CONTRACT_DEADLINE_S, REQUEST_DEADLINE_S, LegalOrchestrator, stream_answer,
+)
+from admission import AdmissionController, AdmissionRejected
+from batch_review import save_batch_files
 
 
 # Mount thư mục static để load css/js nếu file html có link tới
@@ -33,16 +49,125 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Session-Id", "X-Degraded", "X-Profile-Id", "Retry-After"],
 )
 
 # Khởi tạo AI Engine 1 lần duy nhất
 ai_engine = LegalOrchestrator()
 
+# Giới hạn số request xử lý đồng thời + hàng đợi ngắn + rate limit theo client
+admission = AdmissionController(
+    capacity=ADMISSION_CAPACITY,
+    classes=ADMISSION_CLASSES,
+    queue_size=ADMISSION_QUEUE_SIZE,
+    queue_timeout_s=ADMISSION_QUEUE_TIMEOUT_S,
+    client_rpm=ADMISSION_CLIENT_RPM,
+    client_burst=ADMISSION_CLIENT_BURST,
+)
+
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    """Quá tải / vượt rate limit: trả 429/503 ngay kèm Retry-After."""
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail, "reason": exc.reason},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+def _client_id(request: Request) -> str:
+    return request.headers.get("X-Client-Id") or (request.client.host if request.client else "unknown")
+
+
+def _chat_class(req: "ChatRequest") -> str:
+    # Có file -> phân tích hợp đồng (prompt dài, nhiều lời gọi LLM) -> nặng hơn tra cứu
+    return "contract" if req.file_path else "chat"
+
+
+def _profile_forced(request: Request) -> bool:
+    """
+    X-Profile: 1 (cần quyền admin) ép profile request này; không có thì theo PROFILE_SAMPLE_RATE.
+    Id (header X-Profile-Id) chỉ cấp khi còn chỗ sampler - có id là profile chắc chắn được ghi.
+    """
+    forced = request.headers.get("X-Profile", "").lower() in ("1", "true", "yes")
+    if forced:
+        _check_admin(request.headers.get("X-Admin-Token"))
+    return forced
+
+
+def _deadline(request: Request, req: "ChatRequest"):
+    """Deadline tính từ lúc nhận request (gồm cả thời gian chờ admission); X-Deadline-Ms chỉ được rút ngắn."""
+    budget = CONTRACT_DEADLINE_S if req.file_path else REQUEST_DEADLINE_S
+    header = request.headers.get("X-Deadline-Ms")
+    if header:
+        try:
+            requested = float(header) / 1000.0
+        except ValueError:
+            raise HTTPException(status_code=400, detail="X-Deadline-Ms không hợp lệ")
+        # <= 0 / NaN / inf sẽ thành "không có deadline" -> từ chối thay vì bỏ giới hạn
+        if not math.isfinite(requested) or requested <= 0:
+            raise HTTPException(status_code=400, detail="X-Deadline-Ms phải là số mili giây dương")
+        budget = min(budget, requested) if budget > 0 else requested
+    return ai_engine.new_deadline(budget)
+
+
+def _response_headers(session_id: str, profile_id: Optional[str], deadline=None) -> dict:
+    headers = {"X-Session-Id": session_id}
+    if profile_id:
+        headers["X-Profile-Id"] = profile_id
+    if deadline is not None and deadline.degraded:
+        headers["X-Degraded"] = ",".join(deadline.degraded)
+    return headers
+
+
+class _StreamJob:
+    """
+    Việc nền của một response NDJSON: chạy trên thread riêng, đẩy sự kiện vào queue.
+    Slot admission giữ tới khi thread làm việc xong (không phải tới khi client ngắt),
+    nên sức chứa đã cấp luôn chặn đúng lượng việc thật. Client ngắt -> `cancelled` báo job dừng sớm.
+    """
+
+    _END = object()
+
+    def __init__(self, ticket, name: str):
+        self.events: "queue.Queue" = queue.Queue()
+        self.cancelled = threading.Event()
+        self._ticket = ticket
+        self._name = name
+        self._loop = asyncio.get_running_loop()  # AdmissionController chỉ chạy trên event loop
+
+    def start(self, work):
+        def run():
+            try:
+                work(self)
+            except Exception as e:
+                self.events.put({"type": "error", "detail": str(e)})
+            finally:
+                self.events.put(self._END)
+                try:
+                    self._loop.call_soon_threadsafe(admission.release, self._ticket)
+                except RuntimeError:
+                    pass  # Event loop đã đóng (server tắt)
+
+        threading.Thread(target=run, name=self._name, daemon=True).start()
+
+    def ndjson(self):
+        try:
+            while True:
+                event = self.events.get()
+                if event is self._END:
+                    return
+                yield json.dumps(event, ensure_ascii=False) + "\n"
+        finally:
+            self.cancelled.set()
+
 # --- DATA MODELS ---
 class ChatRequest(BaseModel):
     query: str
     file_path: Optional[str] = None
     history: Optional[List[dict]] = []
+    session_id: Optional[str] = None
 
 # --- ENDPOINTS ---
 
@@ -60,18 +185,155 @@ async def read_index():
         return PlainTextResponse("Chưa tìm thấy file static/index.html. Vui lòng tạo thư mục 'static' và copy file index.html vào đó.")
 
 @app.post("/chat", response_class=PlainTextResponse)
-async def chat_endpoint(req: ChatRequest):
+async def chat_endpoint(req: ChatRequest, request: Request):
     """
     API nhận câu hỏi và trả về câu trả lời pháp lý (markdown thuần).
+    Session id trả về qua header X-Session-Id, client gửi lại ở lượt sau để hỏi tiếp.
     """
+    deadline = _deadline(request, req)
+    forced = _profile_forced(request)
+    async with admission.admit(_chat_class(req), _client_id(request)):
+        # Giữ chỗ profile sau admission: request đang xếp hàng không chiếm sampler
+        profile_id = ai_engine.profiler.new_id(forced)
+        try:
+            # SQLite -> threadpool, không chặn event loop
+            session = await run_in_threadpool(ai_engine.open_session, req.session_id, req.history)
+            # Chạy trong threadpool để nhiều request xử lý song song (và gom batch embedding/rerank)
+            response_text = await run_in_threadpool(
+                ai_engine.process, req.query, req.file_path, session, profile_id, deadline
+            )
+            # Trả về text/plain, KHÔNG JSON-encode nữa; bước đã degrade (nếu có) ở header X-Degraded
+            return PlainTextResponse(response_text, headers=_response_headers(session.id, profile_id, deadline))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        finally:
+            ai_engine.profiler.release(profile_id)  # run() chưa chạy tới (lỗi mở session / client huỷ)
+
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(req: ChatRequest, request: Request):
+    """
+    Như /chat nhưng trả NDJSON theo luồng để client hiển thị dần:
+    {"type": "delta", "text": ...} từng đoạn câu trả lời,
+    {"type": "reset"} khi LLM thử lại (xoá phần đã hiển thị),
+    {"type": "done", "answer": ..., "degraded": [...]} bản cuối cùng (client dùng bản này thay cho phần ghép từ delta),
+    {"type": "error", "detail": ...}.
+    """
+    deadline = _deadline(request, req)
+    forced = _profile_forced(request)
+    ticket = await admission.acquire(_chat_class(req), _client_id(request))
+    profile_id = ai_engine.profiler.new_id(forced)
     try:
-        response_text = ai_engine.process(req.query, req.file_path)
-        # Trả về text/plain, KHÔNG JSON-encode nữa
-        return response_text
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        session = await run_in_threadpool(ai_engine.open_session, req.session_id, req.history)
+    except BaseException:  # Kể cả client huỷ trong lúc chờ
+        ai_engine.profiler.release(profile_id)
+        admission.release(ticket)
+        raise
+
+    def run(job: _StreamJob):
+        def sink(piece):
+            job.events.put({"type": "reset"} if piece is None else {"type": "delta", "text": piece})
+
+        try:
+            with stream_answer(sink):
+                answer = ai_engine.process(req.query, req.file_path, session, profile_id, deadline)
+        finally:
+            ai_engine.profiler.release(profile_id)
+        degraded = deadline.degraded if deadline is not None else []
+        job.events.put({"type": "done", "answer": answer, "session_id": session.id, "degraded": degraded})
+
+    # Thread riêng: không chiếm thread pool của stage (process tự đợi các stage trong đó)
+    job = _StreamJob(ticket, "chat-stream")
+    job.start(run)
+    return StreamingResponse(
+        job.ndjson(), media_type="application/x-ndjson", headers=_response_headers(session.id, profile_id),
+    )
 
 
+@app.get("/metrics")
+async def metrics_endpoint():
+    """
+    Prometheus scrape endpoint: latency từng stage, số request theo mode,
+    lỗi/fallback LLM, kích thước prompt, cache hit/miss, micro-batching.
+    """
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def _check_admin(token: Optional[str]):
+    if ADMIN_TOKEN and token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Sai hoặc thiếu X-Admin-Token")
+
+
+@app.post("/admin/reload", status_code=202)
+async def reload_index(full: bool = False, x_admin_token: Optional[str] = Header(None)):
+    """
+    Build lại index (sync GCS + data_laws) ở nền rồi swap atomic.
+    Mặc định chỉ xử lý lại file thay đổi; ?full=true để build toàn bộ.
+    Request đang chạy dùng nốt index cũ; không cần restart server.
+    """
+    _check_admin(x_admin_token)
+    if not ai_engine.reload_index("admin", full=full):
+        raise HTTPException(status_code=409, detail="Đang reload index, thử lại sau")
+    return {"message": "Đã bắt đầu reload index", "version": ai_engine.store.version}
+
+
+@app.post("/admin/index/pull")
+async def pull_index(x_admin_token: Optional[str] = Header(None)):
+    """Kéo index bundle mới nhất (đã publish lên bucket) về node này và swap, không cần build local."""
+    _check_admin(x_admin_token)
+    result = await run_in_threadpool(ai_engine.pull_index)
+    if result is None:
+        raise HTTPException(status_code=409, detail="Đang reload index, thử lại sau")
+    return result
+
+
+@app.get("/admin/index")
+async def index_status(x_admin_token: Optional[str] = Header(None)):
+    """Version index đang phục vụ + trạng thái lần reload gần nhất (+ latency từng shard nếu bật)."""
+    _check_admin(x_admin_token)
+    status = {
+        "version": ai_engine.store.version,
+        "chunks": len(ai_engine.store.chunks),
+        **ai_engine.reloader.status(),
+    }
+    if ai_engine.store.shards is not None:
+        status["shards"] = ai_engine.store.shards.status()
+    return status
+
+
+@app.get("/admin/admission")
+async def admission_status(x_admin_token: Optional[str] = Header(None)):
+    """Sức chứa đang dùng, số request đang chạy / đang chờ theo loại."""
+    _check_admin(x_admin_token)
+    return admission.status()
+
+
+@app.get("/admin/profiles")
+async def list_profiles(x_admin_token: Optional[str] = Header(None)):
+    """Các profile đã lưu (mới nhất trước)."""
+    _check_admin(x_admin_token)
+    return {"profiles": await run_in_threadpool(ai_engine.profiler.store.list)}
+
+
+@app.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, x_admin_token: Optional[str] = Header(None)):
+    """Profile đầy đủ: span từng stage, dòng thời gian stage, kích thước prompt, folded stacks."""
+    _check_admin(x_admin_token)
+    data = await run_in_threadpool(ai_engine.profiler.store.get, profile_id)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Không có profile này")
+    return data
+
+
+@app.get("/admin/profiles/{profile_id}/folded", response_class=PlainTextResponse)
+async def get_profile_folded(profile_id: str, x_admin_token: Optional[str] = Header(None)):
+    """Folded stacks: kéo thả vào speedscope.app hoặc `flamegraph.pl profile.folded > flame.svg`."""
+    _check_admin(x_admin_token)
+    data = await run_in_threadpool(ai_engine.profiler.store.get, profile_id)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Không có profile này")
+    return PlainTextResponse(data["folded"] + "\n")
+
 
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...)):
@@ -86,11 +348,78 @@ async def upload_file(file: UploadFile = File(...)):
         
         with open(file_location, "wb") as buffer:
             shutil.copyfileobj(file.file, buffer)
-            
-        return {"file_path": file_location, "message": "Upload thành công"}
+
+        # Cập nhật kho hợp đồng (chỉ file này; nội dung không đổi thì bỏ qua)
+        contract = await run_in_threadpool(ai_engine.contracts.add_file, pathlib.Path(file_location))
+        return {"file_path": file_location, "message": "Upload thành công", "contract": contract}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+
+@app.get("/contracts")
+async def list_contracts():
+    """Danh sách hợp đồng trong kho (metadata: số điều khoản, hash, thời điểm index...)."""
+    return {"contracts": ai_engine.contracts.list()}
+
+
+@app.get("/contracts/search")
+async def search_contracts(
+    request: Request,
+    q: str,
+    k: int = 10,
+    files: Optional[List[str]] = Query(None),
+    absent: bool = False,
+    min_score: float = CONTRACT_ABSENT_MIN_SCORE,
+):
+    """
+    Tìm điều khoản trên toàn bộ kho hợp đồng (vector + keyword).
+    - ?q=điều khoản bảo mật thông tin&k=20          -> các điều khoản khớp nhất
+    - ?q=...&files=a.docx&files=b.docx               -> chỉ trong các hợp đồng này
+    - ?q=giới hạn mức phạt vi phạm&absent=true        -> hợp đồng KHÔNG có điều khoản như vậy
+    """
+    started = time.perf_counter()
+    async with admission.admit("chat", _client_id(request)):
+        if absent:
+            result = {"contracts": await run_in_threadpool(ai_engine.contracts.contracts_without, q, min_score)}
+        else:
+            result = {"hits": await run_in_threadpool(ai_engine.contracts.search, q, k, files)}
+    return {"query": q, **result, "took_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+@app.post("/contracts/batch-review")
+async def batch_review(request: Request, files: List[UploadFile] = File(...)):
+    """
+    Soát xét nhiều hợp đồng một lần (nhiều file .docx và/hoặc file .zip).
+    Trả về NDJSON theo luồng: {"type": "start"}, mỗi hợp đồng xong một dòng {"type": "result", ...},
+    cuối cùng {"type": "summary", "table": <bảng markdown điểm + mức rủi ro>}.
+    """
+    batch_id = uuid.uuid4().hex[:12]
+    # f.file là file tạm (spooled) của starlette: đọc theo khối trong threadpool, không nạp cả upload vào RAM
+    uploaded = [(f.filename or "", f.file) for f in files]
+    try:
+        paths = await run_in_threadpool(
+            save_batch_files, uploaded, BATCH_REVIEW_DIR / batch_id, BATCH_REVIEW_MAX_FILES,
+            BATCH_REVIEW_MAX_FILE_MB << 20, BATCH_REVIEW_MAX_TOTAL_MB << 20, BATCH_REVIEW_MAX_ZIP_RATIO,
+        )
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"File batch không hợp lệ: {e}")
+    if not paths:
+        raise HTTPException(status_code=400, detail="Không có file .docx nào trong batch")
+    ticket = await admission.acquire("batch", _client_id(request))
+
+    def run(job: _StreamJob):
+        events = ai_engine.batch_reviewer.review(paths, batch_id)
+        try:
+            for event in events:
+                if job.cancelled.is_set():
+                    break  # Client ngắt: review() huỷ hợp đồng chưa chạy, đợi hợp đồng đang chạy xong
+                job.events.put(event)
+        finally:
+            events.close()
+
+    job = _StreamJob(ticket, "batch-review")
+    job.start(run)
+    return StreamingResponse(job.ndjson(), media_type="application/x-ndjson")
+
 # Chạy server: uvicorn server:app --reload
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,475 @@
+"""
+Retrieval chia shard (scatter-gather) khi một process không còn đủ cho cả corpus.
+
+- Chunk id chia round-robin cho N shard; mỗi shard là một process riêng giữ FAISS + BM25 của phần mình,
+  kèm vị trí chunk của từng văn bản nguồn để search có filter (route) cũng chạy trên shard.
+- File của từng shard ghi sẵn lúc build bundle (write_shards -> bundles/<version>/shards-<N>/<shard>/):
+  vector, postings BM25 + id chunk, df/avgdl của cả corpus và vị trí chunk của từng văn bản. Process
+  shard chỉ đọc thư mục của mình; process chính không giữ FAISS/BM25 nào khi bật shard.
+- BM25 của shard dùng IDF/avgdl của cả corpus, kể cả khi có filter (chỉ tính score trên chunk của các
+  văn bản được chọn), nên top_k gộp lại trùng với search trong một process.
+- Vector search có filter chỉ tính inner product trên vector của các văn bản được chọn (chi phí theo
+  kích thước partition); IDSelector của faiss vẫn duyệt mọi vector của index.
+- Shard chạy như một service local riêng (`python shard_search.py ...`, nói chuyện qua socket 127.0.0.1
+  có authkey) chứ không qua multiprocessing spawn - spawn import lại module chính (sever.py) và dựng cả
+  orchestrator trong shard.
+- Coordinator (ShardPool) gửi query vector + tokens tới mọi shard song song, gộp top_k toàn cục
+  cho từng loại hit; fusion + cross-encoder vẫn chạy ở process chính như cũ.
+- Latency từng shard: metric legal_ai_shard_latency_seconds{shard} và ShardPool.status().
+- Một shard chậm quá timeout / lỗi -> gộp kết quả các shard còn lại và đánh dấu request degrade
+  `partial_shards`. Shard chết được dựng lại ở nền.
+"""
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import pathlib
+import secrets
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from deadline import mark, remaining
+from keyword_index import KeywordIndex, KeywordView
+from metrics import SHARD_ERRORS, SHARD_LATENCY
+
+logger = logging.getLogger("LegalAI")
+
+Hits = List[Tuple[int, float]]
+
+READY_MARKER = "SHARD_READY "
+AUTHKEY_ENV = "LEGAL_AI_SHARD_AUTHKEY"
+RESPAWN_INTERVAL_S = 30.0
+
+
+# ---------- artifact của shard (ghi lúc build bundle) ----------
+
+def subset_vector_search(
+    index, q_vec: np.ndarray, top_k: int, positions: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Top-k inner product chỉ trên các vector `positions` của index -> (vị trí, score) giảm dần.
+    IndexFlatIP: đọc thẳng bộ nhớ vector của index (không copy cả index), chi phí theo len(positions).
+    """
+    import faiss
+
+    k = min(top_k, len(positions))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    if not isinstance(index, faiss.IndexFlatIP):
+        selector = faiss.IDSelectorBatch(positions)  # giữ tham chiếu tới hết lần search
+        scores, idxs = index.search(q_vec, k, params=faiss.SearchParameters(sel=selector))
+        keep = idxs[0] >= 0
+        return idxs[0][keep].astype(np.int64), scores[0][keep]
+    xb = faiss.rev_swig_ptr(index.get_xb(), index.ntotal * index.d).reshape(index.ntotal, index.d)
+    scores = xb[positions] @ q_vec[0]
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind="stable")]
+    return np.asarray(positions, dtype=np.int64)[top], scores[top]
+
+
+def shard_dir(bundle: pathlib.Path, shard: int, num_shards: int) -> pathlib.Path:
+    return pathlib.Path(bundle) / f"shards-{num_shards}" / str(shard)
+
+
+def write_shards(bundle: pathlib.Path, index, corpus, sources: Dict[str, np.ndarray], num_shards: int):
+    """
+    Ghi file riêng cho từng shard (chunk id % num_shards == shard) vào bundle/shards-<N>/<shard>/:
+      vectors.faiss  vector của phần mình (thứ tự = keyword.ids)
+      keyword.npz    postings BM25 của phần mình, kèm id chunk toàn cục
+      stats.npz      n_docs/avgdl/df toàn corpus (theo term của shard) + vị trí chunk của từng văn bản
+    corpus: KeywordView cả corpus; sources: {văn bản: id chunk toàn cục của văn bản đó}.
+    """
+    import faiss
+
+    keyword = corpus.index
+    scopes = [(None, corpus)] + sorted(sources.items())
+    for shard in range(num_shards):
+        out = shard_dir(bundle, shard, num_shards)
+        out.mkdir(parents=True)
+        own = keyword.positions(np.arange(shard, len(keyword), num_shards, dtype=np.int64))
+        sub = keyword.subset(own)
+        vectors = faiss.IndexFlatIP(index.d)
+        vectors.add(np.ascontiguousarray(index.reconstruct_batch(sub.ids)))
+        faiss.write_index(vectors, str(out / "vectors.faiss"))
+        sub.save(out / "keyword.npz")
+
+        # Term của shard -> term id toàn cục, để lấy df của từng phạm vi
+        global_terms = np.array([keyword.term_ids[t] for t in sub.terms], dtype=np.int64)
+        names, n_docs, avgdl, floor = [], [], [], []
+        df_indptr, df_terms, df_vals = [0], [], []
+        pos_indptr, pos_vals = [0], []
+        for name, scope in scopes:
+            if name is None:
+                positions = np.empty(0, dtype=np.int64)  # Cả shard
+                df = scope.df_of(global_terms)
+            else:
+                # Văn bản chỉ cần vị trí chunk (score theo IDF cả corpus); dòng df để trống
+                positions = sub.positions(np.asarray(scope, dtype=np.int64))
+                if not len(positions):
+                    continue  # Văn bản không có chunk nào trên shard này
+                df = np.zeros(0, dtype=np.int64)
+            nz = np.flatnonzero(df)
+            names.append(name)
+            n_docs.append(scope.n_docs if name is None else len(positions))
+            avgdl.append(scope.avgdl if name is None else 0.0)
+            floor.append(scope.floor if name is None else 0.0)
+            df_terms.append(nz)
+            df_vals.append(df[nz])
+            df_indptr.append(df_indptr[-1] + len(nz))
+            pos_vals.append(positions)
+            pos_indptr.append(pos_indptr[-1] + len(positions))
+        np.savez(
+            str(out / "stats.npz"),
+            names=np.array([json.dumps(names, ensure_ascii=False)]),
+            n_docs=np.array(n_docs, dtype=np.int64),
+            avgdl=np.array(avgdl, dtype=np.float64),
+            floor=np.array(floor, dtype=np.float64),
+            df_indptr=np.array(df_indptr, dtype=np.int64),
+            df_terms=np.concatenate(df_terms).astype(np.int64),
+            df=np.concatenate(df_vals).astype(np.int64),
+            pos_indptr=np.array(pos_indptr, dtype=np.int64),
+            positions=np.concatenate(pos_vals).astype(np.int64),
+        )
+
+
+# ---------- phía process shard ----------
+
+def _top(hits: Hits, top_k: int) -> Hits:
+    return sorted(hits, key=lambda x: x[1], reverse=True)[:top_k]
+
+
+class _ShardIndex:
+    """
+    Phần của shard: FAISS + postings của chunk trên shard, view BM25 (`corpus`) dùng IDF/avgdl toàn
+    corpus đã ghi lúc build, và vị trí chunk trên shard của từng văn bản (`sources`).
+    """
+
+    def __init__(self, index, keyword: KeywordIndex, corpus: KeywordView, sources: Dict[str, np.ndarray]):
+        self.index = index
+        self.keyword = keyword
+        self.corpus = corpus
+        self.sources = sources
+
+    def __len__(self) -> int:
+        return len(self.keyword)
+
+    def vector_hits(self, q_vec: np.ndarray, top_k: int, positions: Optional[np.ndarray] = None) -> Hits:
+        if positions is None:
+            scores, idxs = self.index.search(q_vec, min(top_k, self.index.ntotal))
+            idxs, scores = idxs[0], scores[0]
+        else:
+            idxs, scores = subset_vector_search(self.index, q_vec, top_k, positions)
+        ids = self.keyword.ids
+        return [(int(ids[i]), float(s)) for i, s in zip(idxs, scores) if 0 <= i < self.index.ntotal]
+
+    def search(self, q_vec: np.ndarray, tokens: List[str], top_k: int, sources: Optional[List[str]]) -> Tuple[Hits, Hits]:
+        if sources is None:
+            # Toàn corpus: BM25 theo IDF toàn corpus
+            return self.vector_hits(q_vec, top_k), self.corpus.top_k(tokens, top_k)
+        parts = [self.sources[s] for s in sources if s in self.sources]
+        if not parts:
+            return [], []
+        # Một lần top_k với IDF cả corpus trên chunk của các văn bản được chọn (score so sánh được)
+        positions = np.concatenate(parts)
+        return self.vector_hits(q_vec, top_k, positions), self.corpus.top_k(tokens, top_k, positions)
+
+
+def _load_shard(bundle: pathlib.Path, shard: int, num_shards: int) -> _ShardIndex:
+    """Chỉ đọc file của shard này (không đọc FAISS / BM25 / bảng chunk của cả corpus)."""
+    import faiss
+
+    path = shard_dir(bundle, shard, num_shards)
+    if not path.exists():
+        raise RuntimeError(f"Bundle {pathlib.Path(bundle).name} không có artifact cho {num_shards} shard ({path})")
+    index = faiss.read_index(str(path / "vectors.faiss"))
+    keyword = KeywordIndex.load(path / "keyword.npz")
+    if index.ntotal != len(keyword):
+        raise RuntimeError(f"Shard {shard} hỏng: {index.ntotal} vector nhưng {len(keyword)} chunk.")
+
+    corpus = None
+    sources: Dict[str, np.ndarray] = {}
+    with np.load(str(path / "stats.npz"), allow_pickle=False) as data:
+        stats = {k: data[k] for k in data.files}  # NpzFile đọc lại file mỗi lần truy cập
+    names = json.loads(str(stats["names"][0]))
+    df_indptr, pos_indptr = stats["df_indptr"], stats["pos_indptr"]
+    for i, name in enumerate(names):
+        if name is not None:
+            sources[name] = stats["positions"][pos_indptr[i]:pos_indptr[i + 1]]
+            continue
+        df_lo, df_hi = df_indptr[i], df_indptr[i + 1]
+        corpus = KeywordView(
+            keyword,
+            positions=None,
+            n_docs=int(stats["n_docs"][i]),
+            avgdl=float(stats["avgdl"][i]),
+            df_terms=stats["df_terms"][df_lo:df_hi],
+            df=stats["df"][df_lo:df_hi],
+            floor=float(stats["floor"][i]),
+        )
+    return _ShardIndex(index, keyword, corpus, sources)
+
+
+def serve(bundle_dir: str, shard: int, num_shards: int, port: int, authkey: bytes):
+    """
+    Process shard: load phần của mình, báo READY (kèm port) ra stdout rồi trả lời
+    (seq, q_vec, tokens, top_k, sources) -> (seq, vector_hits, bm25_hits, giây tính toán)
+    cho tới khi coordinator đóng kết nối.
+    """
+    started = time.perf_counter()
+    part = _load_shard(pathlib.Path(bundle_dir), shard, num_shards)
+    listener = Listener(("127.0.0.1", port), authkey=authkey)
+    info = {
+        "port": listener.address[1],
+        "chunks": len(part),
+        "load_s": round(time.perf_counter() - started, 3),
+    }
+    print(READY_MARKER + json.dumps(info), flush=True)
+    with listener, listener.accept() as conn:
+        while True:
+            try:
+                msg = conn.recv()
+            except EOFError:
+                return
+            if msg is None:
+                return
+            seq, q_vec, tokens, top_k, sources = msg
+            t0 = time.perf_counter()
+            try:
+                vector_hits, bm25_hits = part.search(q_vec, tokens, top_k, sources)
+            except Exception as e:
+                # Lỗi một query không làm chết shard; coordinator gộp kết quả các shard còn lại
+                logger.exception(f"❌ Search lỗi: {e}")
+                vector_hits = bm25_hits = None
+            conn.send((seq, vector_hits, bm25_hits, time.perf_counter() - t0))
+
+
+# ---------- phía coordinator ----------
+
+class _Shard:
+    def __init__(self, shard: int, process, conn):
+        self.shard = shard
+        self.process = process
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.chunks = 0
+        self.load_s = 0.0
+        self.last_ms: Optional[float] = None
+        self.avg_ms: Optional[float] = None    # EWMA round-trip
+        self.compute_ms: Optional[float] = None
+
+
+class ShardPool:
+    def __init__(self, num_shards: int, timeout_s: float = 2.0, start_timeout_s: float = 600.0):
+        self.num_shards = num_shards
+        self.timeout_s = timeout_s
+        self.start_timeout_s = start_timeout_s
+        self.version: Optional[str] = None
+        self.bundle_dir: Optional[pathlib.Path] = None
+        self._shards: List[_Shard] = []
+        self._seq = itertools.count(1)
+        self._fanout = ThreadPoolExecutor(max_workers=max(4, num_shards * 4), thread_name_prefix="shard-rpc")
+        self._start_lock = threading.Lock()
+        self._next_respawn = 0.0  # Dựng lại shard chết tối đa mỗi RESPAWN_INTERVAL_S
+
+    # ---------- vòng đời ----------
+
+    def start(self, bundle_dir: pathlib.Path, version: str, background: bool = True, force: bool = False) -> bool:
+        """
+        Dựng bộ shard cho bundle mới; xong mới thay bộ cũ (bộ cũ vẫn phục vụ version cũ trong lúc đó).
+        background=False: chờ xong, False nếu không dựng được (giữ nguyên bộ cũ).
+        """
+        if version == self.version and not force:
+            return True
+        if background:
+            threading.Thread(
+                target=self._start, args=(bundle_dir, version, force), name="shard-start", daemon=True
+            ).start()
+            return True
+        return self._start(bundle_dir, version, force)
+
+    def _spawn(self, bundle_dir: pathlib.Path, shard: int) -> _Shard:
+        authkey = secrets.token_bytes(16)
+        env = {**os.environ, AUTHKEY_ENV: authkey.hex()}  # Không để authkey trên command line
+        proc = subprocess.Popen(
+            [sys.executable, str(pathlib.Path(__file__).resolve()), "--bundle", str(bundle_dir),
+             "--shard", str(shard), "--shards", str(self.num_shards)],
+            stdout=subprocess.PIPE, env=env, text=True,
+        )
+        # Load treo quá lâu -> kill, readline bên dưới sẽ trả về rỗng
+        watchdog = threading.Timer(self.start_timeout_s, proc.kill)
+        watchdog.start()
+        try:
+            for line in proc.stdout:
+                if line.startswith(READY_MARKER):
+                    info = json.loads(line[len(READY_MARKER):])
+                    break
+            else:
+                raise RuntimeError(f"shard {shard} thoát khi đang load (exit code {proc.wait()})")
+        finally:
+            watchdog.cancel()
+        s = _Shard(shard, proc, Client(("127.0.0.1", info["port"]), authkey=authkey))
+        s.chunks, s.load_s = info["chunks"], info["load_s"]
+        return s
+
+    def _start(self, bundle_dir: pathlib.Path, version: str, force: bool = False) -> bool:
+        if not self._start_lock.acquire(blocking=not force):
+            return False  # Đang dựng lại rồi
+        try:
+            if version == self.version and not (force and self._dead()):
+                return True
+            started = time.perf_counter()
+            shards: List[_Shard] = []
+            error: Optional[Exception] = None
+            # Các shard load song song
+            with ThreadPoolExecutor(max_workers=self.num_shards) as pool:
+                futures = [pool.submit(self._spawn, bundle_dir, i) for i in range(self.num_shards)]
+                for fut in futures:
+                    try:
+                        shards.append(fut.result())
+                    except Exception as e:
+                        error = error or e
+            if error is not None:
+                logger.error(f"❌ Không dựng được shard cho bundle {version}, giữ nguyên: {error}")
+                self._stop(shards)
+                return False
+            old, self._shards = self._shards, shards
+            self.version, self.bundle_dir = version, pathlib.Path(bundle_dir)
+            self._stop(old)
+            logger.info(
+                f"🧩 {self.num_shards} shard sẵn sàng cho bundle {version} "
+                f"({', '.join(str(s.chunks) for s in shards)} chunk, {time.perf_counter() - started:.1f}s)"
+            )
+            return True
+        finally:
+            self._start_lock.release()
+
+    def _dead(self) -> List[int]:
+        return [s.shard for s in self._shards if s.process.poll() is not None]
+
+    def _stop(self, shards: List[_Shard]):
+        for s in shards:
+            with s.lock:  # Chờ lời gọi đang chạy trên shard này xong
+                try:
+                    s.conn.send(None)
+                except (OSError, ValueError):
+                    pass
+                s.conn.close()
+            try:
+                s.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                s.process.kill()
+            s.process.stdout.close()
+
+    def close(self):
+        shards, self._shards, self.version = self._shards, [], None
+        self._stop(shards)
+        self._fanout.shutdown(wait=False)
+
+    # ---------- search ----------
+
+    def _ask(
+        self, s: _Shard, q_vec: np.ndarray, tokens: List[str], top_k: int, sources: Optional[List[str]],
+        timeout_s: float,
+    ) -> Optional[Tuple[Hits, Hits]]:
+        seq = next(self._seq)
+        t0 = time.perf_counter()
+        try:
+            with s.lock:
+                s.conn.send((seq, q_vec, tokens, top_k, sources))
+                while True:
+                    wait = timeout_s - (time.perf_counter() - t0)
+                    if wait <= 0 or not s.conn.poll(wait):
+                        SHARD_ERRORS.labels(str(s.shard), "timeout").inc()
+                        logger.warning(f"⚠️ Shard {s.shard} quá {timeout_s:.1f}s -> bỏ qua shard này lần này")
+                        return None
+                    reply_seq, vector_hits, bm25_hits, compute_s = s.conn.recv()
+                    if reply_seq == seq:
+                        break
+                    # Trả lời muộn của lần search trước đã timeout -> bỏ
+        except (OSError, EOFError, ValueError) as e:
+            SHARD_ERRORS.labels(str(s.shard), "error").inc()
+            logger.warning(f"⚠️ Shard {s.shard} mất kết nối: {e!r}")
+            return None
+        if vector_hits is None:
+            SHARD_ERRORS.labels(str(s.shard), "error").inc()
+            return None
+        elapsed = time.perf_counter() - t0
+        SHARD_LATENCY.labels(str(s.shard)).observe(elapsed)
+        s.last_ms = elapsed * 1000
+        s.avg_ms = s.last_ms if s.avg_ms is None else 0.9 * s.avg_ms + 0.1 * s.last_ms
+        s.compute_ms = compute_s * 1000
+        return vector_hits, bm25_hits
+
+    def search(
+        self, version: str, q_vec: np.ndarray, tokens: List[str], top_k: int, sources: Optional[List[str]] = None
+    ) -> Optional[Tuple[Hits, Hits]]:
+        """
+        Top_k vector + BM25 gộp từ mọi shard (id chunk toàn cục); sources=None -> toàn corpus,
+        có sources -> chỉ các văn bản đó (như partition). Shard lỗi / quá hạn bị bỏ qua (kết quả một phần,
+        request được đánh dấu partial_shards). None nếu bộ shard chưa có bundle `version` hoặc mọi shard đều lỗi.
+        """
+        shards = self._shards
+        if not shards or self.version != version:
+            return None
+        q_vec = np.ascontiguousarray(q_vec, dtype=np.float32)
+        # Không chờ shard quá deadline của request (thread fan-out không mang ContextVar -> tính ở đây)
+        timeout_s = max(remaining(self.timeout_s), 0.0)
+        futures = [self._fanout.submit(self._ask, s, q_vec, tokens, top_k, sources, timeout_s) for s in shards]
+        results = [f.result() for f in futures]
+        failed = [s.shard for s, r in zip(shards, results) if r is None]
+        if failed:
+            dead = self._dead()
+            if dead and time.monotonic() >= self._next_respawn and not self._start_lock.locked():
+                self._next_respawn = time.monotonic() + RESPAWN_INTERVAL_S
+                logger.warning(f"⚠️ Shard {dead} đã chết -> dựng lại bộ shard ở nền")
+                self.start(self.bundle_dir, version, force=True)
+            if len(failed) == len(shards):
+                return None
+            logger.warning(f"⚠️ Thiếu kết quả shard {failed} -> trả kết quả của {len(shards) - len(failed)} shard còn lại")
+            mark("partial_shards")
+        results = [r for r in results if r is not None]
+        return _top([h for v, _ in results for h in v], top_k), _top([h for _, b in results for h in b], top_k)
+
+    def status(self) -> Dict:
+        def ms(v):
+            return None if v is None else round(v, 2)
+
+        return {
+            "version": self.version,
+            "shards": [
+                {
+                    "shard": s.shard, "pid": s.process.pid, "alive": s.process.poll() is None, "chunks": s.chunks,
+                    "load_s": s.load_s, "last_ms": ms(s.last_ms), "avg_ms": ms(s.avg_ms),
+                    "compute_ms": ms(s.compute_ms),
+                }
+                for s in self._shards
+            ],
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Một shard retrieval (ShardPool tự chạy; authkey qua biến môi trường).")
+    parser.add_argument("--bundle", required=True, help="Thư mục bundle (index_laws/bundles/<version>)")
+    parser.add_argument("--shard", type=int, required=True)
+    parser.add_argument("--shards", type=int, required=True)
+    parser.add_argument("--port", type=int, default=0, help="0 = port ngẫu nhiên (báo qua dòng READY)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s [shard {args.shard}] %(message)s", stream=sys.stderr)
+    authkey = bytes.fromhex(os.environ.get(AUTHKEY_ENV, ""))
+    if not authkey:
+        parser.error(f"thiếu {AUTHKEY_ENV}")
+    serve(args.bundle, args.shard, args.shards, args.port, authkey)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,17 +5,48 @@ import json
 import logging
 import pathlib
 import re
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
 from dataclasses import dataclass
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Callable, Optional, Set, Tuple
 
 # --- 3rd Party Libraries ---
 from dotenv import load_dotenv
 from sentence_transformers import SentenceTransformer, CrossEncoder
 import faiss
 import numpy as np
-from rank_bm25 import BM25Okapi
 from docx import Document
-import google.generativeai as genai
+
+from batch_review import BatchReviewer
+from batching import InferenceScheduler
+from chunk_table import ChunkTable, ChunkTableBuilder, LawChunk
+from contract_index import ContractIndex, split_clauses
+from contract_versions import (
+    AnalysisRecord, ClauseChange, ContractAnalysisStore, align_clauses, change_counts, changed_ratio,
+    changes_table, contract_family, render_changes, same_contract,
+)
+from embed_build import encode_corpus
+from index_bundle import (
+    BUNDLE_FORMAT, IndexBundleError, bundles_root, check_manifest, current_bundle, file_sha256, prune_bundles, read_manifest,
+    source_hashes, write_bundle,
+)
+from law_chunker import TokenChunker
+from law_structure import ArticleIndex, doc_type, route_domains
+from llm_backends import LLMBackend, create_backend
+from llm_resilience import LLMGuard, LLMUnavailableError
+from pipeline import StageGraph, stage_cancelled
+from index_reload import IndexReloader
+from keyword_index import KeywordIndex, tokenize
+from law_sync import LawSync, SyncReport, make_source as make_law_source
+from bundle_remote import make_bundle_store, publish_bundle, pull_bundle
+from sessions import Session, SessionStore
+from shard_search import ShardPool, subset_vector_search, write_shards
+from metrics import LLM_ERRORS, LLM_FALLBACKS, PROMPT_CHARS, record_cache, record_request, stage_timer
+from profiling import Profiler, ProfileStore, note_prompt
+from deadline import Deadline, current as current_deadline, degrade, time_left, with_deadline
 
 # ===========================================================
 # 0. CẤU HÌNH HỆ THỐNG & LOGGING
@@ -46,8 +77,130 @@ EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
 RERANK_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2" # Model Re-ranking nhẹ
 GCS_BUCKET_NAME = os.getenv("GCS_BUCKET_NAME")
 GCS_LAWS_PREFIX = os.getenv("GCS_LAWS_PREFIX", "law/")
-
-if not GEMINI_API_KEY:
+GCS_SYNC_WORKERS = int(os.getenv("GCS_SYNC_WORKERS", "8"))
+GCS_SYNC_PRUNE = os.getenv("GCS_SYNC_PRUNE", "1") == "1"   # Xoá file local đã bị xoá khỏi bucket
+GCS_SYNC_PRUNE_MAX_FRACTION = float(os.getenv("GCS_SYNC_PRUNE_MAX_FRACTION", "0.5"))  # Xoá nhiều hơn -> bỏ qua
+GCS_BUNDLES_PREFIX = os.getenv("GCS_BUNDLES_PREFIX", "index_bundles/")   # Index bundle build sẵn (cùng bucket)
+
+# Micro-batching embedding/rerank giữa các request đồng thời
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "64"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "5"))
+
+# Rank fusion (FAISS + BM25) & rerank cascade
+FUSION_METHOD = os.getenv("FUSION_METHOD", "rrf")            # "rrf" | "weighted"
+FUSION_RRF_K = int(os.getenv("FUSION_RRF_K", "60"))
+FUSION_VECTOR_WEIGHT = float(os.getenv("FUSION_VECTOR_WEIGHT", "0.5"))
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "15"))           # Chỉ top-N sau fusion mới vào cross-encoder
+RERANK_SKIP_MARGIN = float(os.getenv("RERANK_SKIP_MARGIN", "0.35"))  # Khoảng cách (tương đối) đủ lớn -> bỏ qua rerank
+
+# Encode corpus khi build: batch theo độ dài token, multi-process (0 = encode trong process)
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+EMBED_BUILD_WORKERS = int(os.getenv("EMBED_BUILD_WORKERS", "0"))
+EMBED_BUCKET_SIZE = int(os.getenv("EMBED_BUCKET_SIZE", "1024"))   # Số chunk mỗi bucket ghi xuống đĩa
+INDEX_ADD_BLOCK = int(os.getenv("INDEX_ADD_BLOCK", "16384"))      # Số vector mỗi lần add vào FAISS lúc build
+
+# Chunking luật (ghi vào manifest bundle, server từ chối bundle build với tham số khác)
+CHUNK_STRATEGY = os.getenv("CHUNK_STRATEGY", "tokens")      # "tokens" (đo bằng tokenizer model) | "chars" (kiểu cũ)
+CHUNK_MIN_LEN = int(os.getenv("CHUNK_MIN_LEN", "20"))
+CHUNK_MAX_CHARS = int(os.getenv("CHUNK_MAX_CHARS", "4500"))     # Chỉ dùng với CHUNK_STRATEGY=chars
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "0"))      # 0 = max_seq_length của model embedding
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+
+# Hit là chunk con của một Điều -> đưa cả Điều vào context trả lời (cắt ở ARTICLE_EXPAND_MAX_CHARS)
+RAG_EXPAND_ARTICLES = os.getenv("RAG_EXPAND_ARTICLES", "1") == "1"
+ARTICLE_EXPAND_MAX_CHARS = int(os.getenv("ARTICLE_EXPAND_MAX_CHARS", "6000"))
+
+# Index bundle: server chỉ load bundle do build_index.py (hoặc /admin/reload) tạo ra
+INDEX_KEEP_BUNDLES = int(os.getenv("INDEX_KEEP_BUNDLES", "3"))
+INDEX_BUILD_ON_START = os.getenv("INDEX_BUILD_ON_START", "0") == "1"   # Dev: chưa có bundle thì build luôn
+INDEX_PULL_ON_START = os.getenv("INDEX_PULL_ON_START", "1") == "1"     # Kéo bundle mới nhất từ bucket khi start
+# index_laws/laws.faiss kiểu cũ (không manifest, chunk 4500 ký tự): chỉ load khi bật rõ, và phải CHUNK_STRATEGY=chars
+INDEX_ALLOW_LEGACY = os.getenv("INDEX_ALLOW_LEGACY", "0") == "1"
+
+# Retrieval chia shard: N process giữ FAISS + BM25 của 1/N corpus, search song song rồi gộp top_k (0/1 = tắt).
+# File của từng shard nằm trong bundle -> build_index.py phải chạy với cùng SEARCH_SHARDS
+SEARCH_SHARDS = int(os.getenv("SEARCH_SHARDS", "0"))
+SEARCH_SHARD_TIMEOUT_S = float(os.getenv("SEARCH_SHARD_TIMEOUT_S", "2"))   # Shard trả lời chậm hơn -> bỏ qua lần đó
+
+# Bảng chunk dạng cột: nén text theo block (zstd cần package `zstandard`, thiếu thì tự lưu không nén)
+CHUNK_COMPRESSION = os.getenv("CHUNK_COMPRESSION", "none")      # "none" | "zstd"
+CHUNK_BLOCK_BYTES = int(os.getenv("CHUNK_BLOCK_BYTES", "65536"))
+
+# Số thread chạy các stage song song (intent, search, status...) cho mọi request
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "16"))
+
+# Hot reload index: poll data_laws mỗi N giây (0 = tắt, chỉ reload qua /admin/reload)
+INDEX_WATCH_INTERVAL_S = float(os.getenv("INDEX_WATCH_INTERVAL_S", "0"))
+INDEX_RELOAD_MAX_BACKOFF_S = float(os.getenv("INDEX_RELOAD_MAX_BACKOFF_S", "3600"))  # Build lỗi lặp lại: chờ tối đa
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # Bắt buộc header X-Admin-Token cho /admin/* nếu có cấu hình
+
+# Profiling từng request: header X-Profile (kèm X-Admin-Token) hoặc lấy mẫu ngẫu nhiên một phần traffic
+PROFILE_DIR = BASE_DIR / "profiles"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))     # 0.01 = profile 1% request
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))     # Chu kỳ lấy mẫu stack
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))                    # Số profile giữ lại trên đĩa
+PROFILE_MAX_CONCURRENT = int(os.getenv("PROFILE_MAX_CONCURRENT", "2"))
+
+# Session hội thoại (SQLite local)
+SESSION_DB_PATH = BASE_DIR / "sessions.db"
+SESSION_TTL_S = float(os.getenv("SESSION_TTL_S", "86400"))
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "6"))      # Số lượt giữ nguyên văn, cũ hơn -> summary
+SESSION_MAX_CHUNKS = int(os.getenv("SESSION_MAX_CHUNKS", "12"))   # Số chunk luật giữ lại để tái sử dụng
+# Chỉ dùng lại chunk của session khi câu hỏi mới gần câu hỏi lúc retrieve (cosine embedding >= ngưỡng)
+SESSION_FOLLOWUP_MIN_SIM = float(os.getenv("SESSION_FOLLOWUP_MIN_SIM", "0.6"))
+
+# Kho hợp đồng: index điều khoản của mọi hợp đồng đã upload để tìm xuyên hợp đồng
+CONTRACT_INDEX_PATH = BASE_DIR / "contracts_index.db"
+CONTRACT_CLAUSE_MAX_CHARS = int(os.getenv("CONTRACT_CLAUSE_MAX_CHARS", "1500"))
+CONTRACT_ABSENT_MIN_SCORE = float(os.getenv("CONTRACT_ABSENT_MIN_SCORE", "0.5"))  # Cosine coi như "có điều khoản"
+
+# Phân tích lại bản mới của hợp đồng: chỉ gửi điều khoản thay đổi so với bản đã phân tích trước
+CONTRACT_INCREMENTAL = os.getenv("CONTRACT_INCREMENTAL", "1") == "1"
+CONTRACT_INCREMENTAL_MAX_CHANGED = float(os.getenv("CONTRACT_INCREMENTAL_MAX_CHANGED", "0.5"))  # Đổi nhiều hơn -> phân tích lại toàn bộ
+
+# Soát xét hàng loạt (/contracts/batch-review)
+BATCH_REVIEW_DIR = CONTRACT_DIR / "batches"
+BATCH_REVIEW_WORKERS = int(os.getenv("BATCH_REVIEW_WORKERS", "8"))
+BATCH_REVIEW_LLM_CONCURRENCY = int(os.getenv("BATCH_REVIEW_LLM_CONCURRENCY", "4"))  # Chừa quota cho chat tương tác
+BATCH_REVIEW_MAX_FILES = int(os.getenv("BATCH_REVIEW_MAX_FILES", "200"))
+BATCH_REVIEW_MAX_FILE_MB = int(os.getenv("BATCH_REVIEW_MAX_FILE_MB", "20"))  # Mỗi DOCX (sau giải nén)
+BATCH_REVIEW_MAX_TOTAL_MB = int(os.getenv("BATCH_REVIEW_MAX_TOTAL_MB", "500"))  # Cả batch (sau giải nén)
+BATCH_REVIEW_MAX_ZIP_RATIO = float(os.getenv("BATCH_REVIEW_MAX_ZIP_RATIO", "100"))  # Tỷ lệ nén tối đa / entry
+
+# Bảo vệ lời gọi LLM: concurrency, quota, retry, circuit breaker
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_CALL_CONCURRENCY = int(os.getenv("LLM_CALL_CONCURRENCY", "4"))   # Mỗi call site (intent, cot, answer...)
+LLM_RATE_RPM = float(os.getenv("LLM_RATE_RPM", "60"))                 # Khớp quota Gemini của project
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", "5"))
+LLM_CIRCUIT_RECOVERY_S = float(os.getenv("LLM_CIRCUIT_RECOVERY_S", "30"))
+
+# Deadline mỗi request (giây, 0 = không giới hạn); client có thể gửi header X-Deadline-Ms ngắn hơn
+REQUEST_DEADLINE_S = float(os.getenv("REQUEST_DEADLINE_S", "30"))
+CONTRACT_DEADLINE_S = float(os.getenv("CONTRACT_DEADLINE_S", "120"))   # Phân tích hợp đồng: prompt dài hơn nhiều
+# Còn ít hơn N giây thì áp dụng bước degrade tương ứng (ngưỡng giảm dần = thứ tự áp dụng)
+DEGRADE_THRESHOLDS = {
+    "skip_cot": float(os.getenv("DEGRADE_SKIP_COT_BELOW_S", "20")),
+    "skip_rerank": float(os.getenv("DEGRADE_SKIP_RERANK_BELOW_S", "15")),
+    "shrink_context": float(os.getenv("DEGRADE_SHRINK_CONTEXT_BELOW_S", "12")),
+    "cap_generation": float(os.getenv("DEGRADE_CAP_GENERATION_BELOW_S", "10")),
+}
+DEGRADE_CONTEXT_MAX_CHARS = int(os.getenv("DEGRADE_CONTEXT_MAX_CHARS", "6000"))
+DEGRADE_MAX_OUTPUT_TOKENS = int(os.getenv("DEGRADE_MAX_OUTPUT_TOKENS", "600"))
+
+# Admission control của API: sức chứa tính theo đơn vị, mỗi loại request (trọng số, số đang chạy tối đa)
+ADMISSION_CAPACITY = int(os.getenv("ADMISSION_CAPACITY", "32"))
+ADMISSION_CLASSES = {
+    "chat": (1, int(os.getenv("ADMISSION_CHAT_MAX", "32"))),
+    "contract": (int(os.getenv("ADMISSION_CONTRACT_WEIGHT", "4")), int(os.getenv("ADMISSION_CONTRACT_MAX", "4"))),
+    "batch": (int(os.getenv("ADMISSION_BATCH_WEIGHT", "8")), int(os.getenv("ADMISSION_BATCH_MAX", "1"))),
+}
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_QUEUE_TIMEOUT_S = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_S", "2"))   # Chờ lâu hơn -> 503
+ADMISSION_CLIENT_RPM = float(os.getenv("ADMISSION_CLIENT_RPM", "30"))           # Token bucket mỗi client
+ADMISSION_CLIENT_BURST = float(os.getenv("ADMISSION_CLIENT_BURST", "10"))
+
+if not GEMINI_API_KEY and os.getenv("LLM_BACKEND", "gemini").lower() != "fake":
     logger.warning("⚠️ CẢNH BÁO: GEMINI_API_KEY chưa được cấu hình.")
 
 # ===========================================================
@@ -370,37 +523,113 @@ Tuyệt đối **không được bịa luật, không được suy đoán quá p
 # 2. UTILS & GEMINI CLIENT
 # ===========================================================
 
+LLM_DEGRADED_TEXT = (
+    "⚠️ **Hệ thống AI đang tạm thời quá tải hoặc mất kết nối tới mô hình ngôn ngữ.**\n"
+    "Vui lòng thử lại sau ít phút. Câu trả lời này chưa được tạo bởi AI."
+)
+
+# Các lời gọi sinh câu trả lời cuối cùng cho user -> stream được ra client (/chat/stream)
+STREAMED_CALLS = {"answer", "contract_analysis", "contract_reanalysis", "suggest", "chatchit"}
+_answer_sink: ContextVar[Optional[Callable[[Optional[str]], None]]] = ContextVar("answer_sink", default=None)
+
+
+@contextmanager
+def stream_answer(sink: Callable[[Optional[str]], None]):
+    """
+    Trong block này, text của các lời gọi STREAMED_CALLS được đẩy từng đoạn vào sink(piece).
+    sink(None) = bắt đầu lại từ đầu (lần thử mới sau retry) -> client xoá phần đã hiển thị.
+    Stage chạy trên thread pool vẫn thấy sink vì StageGraph copy context của request.
+    """
+    token = _answer_sink.set(sink)
+    try:
+        yield
+    finally:
+        _answer_sink.reset(token)
+
+
 class GeminiClient:
-    _model: Optional[genai.GenerativeModel] = None
+    """
+    Lớp gọi LLM dùng chung cho mọi agent.
+    Backend thật sự (Gemini / Fake offline) được chọn qua LLM_BACKEND hoặc set_backend().
+    """
+    _backend: Optional[LLMBackend] = None
+    _guard: Optional[LLMGuard] = None
+
+    @classmethod
+    def get_backend(cls) -> LLMBackend:
+        if cls._backend is None:
+            cls._backend = create_backend()
+        return cls._backend
+
+    @classmethod
+    def set_backend(cls, backend: LLMBackend):
+        cls._backend = backend
 
     @classmethod
-    def get_model(cls) -> genai.GenerativeModel:
-        if cls._model is None:
-            if not GEMINI_API_KEY:
-                raise RuntimeError("Thiếu GEMINI_API_KEY")
-            genai.configure(api_key=GEMINI_API_KEY)
-            cls._model = genai.GenerativeModel("gemini-2.5-flash")
-        return cls._model
+    def get_guard(cls) -> LLMGuard:
+        if cls._guard is None:
+            cls._guard = LLMGuard(
+                max_concurrency=LLM_MAX_CONCURRENCY,
+                per_call_concurrency=LLM_CALL_CONCURRENCY,
+                rate_per_minute=LLM_RATE_RPM,
+                max_retries=LLM_MAX_RETRIES,
+                failure_threshold=LLM_CIRCUIT_FAILURES,
+                recovery_timeout=LLM_CIRCUIT_RECOVERY_S,
+            )
+        return cls._guard
 
     @classmethod
-    def generate_text(cls, prompt: str) -> str:
+    def generate_text(cls, prompt: str, call: str = "text") -> str:
+        """Sinh text. Khi LLM lỗi/không khả dụng -> trả LLM_DEGRADED_TEXT thay vì chuỗi rỗng."""
+        PROMPT_CHARS.labels(call).observe(len(prompt))
+        note_prompt(call, len(prompt))
+        sink = _answer_sink.get() if call in STREAMED_CALLS else None
+
+        # Sắp hết deadline -> giới hạn độ dài câu trả lời; mỗi lần thử bị chặn bởi thời gian còn lại
+        max_tokens = DEGRADE_MAX_OUTPUT_TOKENS if degrade("cap_generation") else None
+
+        def streamed() -> str:
+            sink(None)
+            parts = []
+            for piece in cls.get_backend().stream(prompt, max_tokens=max_tokens, timeout=time_left()):
+                parts.append(piece)
+                sink(piece)
+            return "".join(parts)
+
         try:
-            return cls.get_model().generate_content(prompt).text.strip()
+            with stage_timer("gemini_generate"):
+                if sink is None:
+                    text = cls.get_guard().run(
+                        call, lambda: cls.get_backend().generate(prompt, max_tokens=max_tokens, timeout=time_left())
+                    )
+                else:
+                    text = cls.get_guard().run(call, streamed)
+            return text.strip()
+        except LLMUnavailableError as e:
+            logger.warning(f"[{call}] {e} -> degraded response")
         except Exception as e:
             logger.error(f"Gemini Error: {e}")
-            return ""
+            LLM_ERRORS.labels(call).inc()
+        LLM_FALLBACKS.labels(call).inc()
+        return LLM_DEGRADED_TEXT
 
     @classmethod
-    def generate_json(cls, prompt: str, fallback: Any) -> Any:
+    def generate_json(cls, prompt: str, fallback: Any, call: str = "json") -> Any:
+        PROMPT_CHARS.labels(call).observe(len(prompt))
+        note_prompt(call, len(prompt))
         try:
-            resp = cls.get_model().generate_content(
-                prompt,
-                generation_config=genai.GenerationConfig(response_mime_type="application/json")
-            )
-            return json.loads(resp.text)
+            with stage_timer("gemini_json"):
+                raw = cls.get_guard().run(
+                    call, lambda: cls.get_backend().generate(prompt, json_mode=True, timeout=time_left())
+                )
+            return json.loads(raw)
+        except LLMUnavailableError as e:
+            logger.warning(f"[{call}] {e} -> fallback")
         except Exception as e:
             logger.error(f"JSON Error: {e}")
-            return fallback
+            LLM_ERRORS.labels(call).inc()
+        LLM_FALLBACKS.labels(call).inc()
+        return fallback
 
 
 def detect_contract_status(text: str) -> Dict:
@@ -462,7 +691,7 @@ def detect_contract_status(text: str) -> Dict:
     result = GeminiClient.generate_json(prompt, fallback={
         "status": "UNKNOWN",
         "reason": "Không phân loại được"
-    })
+    }, call="contract_status")
     return result
 
 
@@ -471,16 +700,17 @@ def read_docx(path: pathlib.Path) -> str:
     try:
         if not path.exists():
             return ""
-        doc = Document(str(path))
-        full_text = []
-        for para in doc.paragraphs:
-            if para.text.strip():
-                full_text.append(para.text.strip())
-        for table in doc.tables:
-            for row in table.rows:
-                cells = [c.text.strip() for c in row.cells if c.text.strip()]
-                if cells:
-                    full_text.append(" | ".join(cells))
+        with stage_timer("docx_parse"):
+            doc = Document(str(path))
+            full_text = []
+            for para in doc.paragraphs:
+                if para.text.strip():
+                    full_text.append(para.text.strip())
+            for table in doc.tables:
+                for row in table.rows:
+                    cells = [c.text.strip() for c in row.cells if c.text.strip()]
+                    if cells:
+                        full_text.append(" | ".join(cells))
         return "\n".join(full_text)
     except Exception as e:
         logger.error(f"read_docx error: {e}")
@@ -529,79 +759,270 @@ def chunk_law_text(text: str, source_name: str, min_len=20, max_chunk_size=4500)
     return chunks
 
 
-def download_law_docs_from_gcs():
-    """Tải file từ GCS với log chi tiết (nếu có cấu hình)."""
+def download_law_docs_from_gcs() -> Optional[SyncReport]:
+    """Đồng bộ data_laws với GCS (song song, so generation/MD5 qua manifest). None nếu chưa cấu hình."""
     bucket_name = os.getenv("GCS_BUCKET_NAME")
     prefix = os.getenv("GCS_LAWS_PREFIX")
 
     if not bucket_name:
         logger.info("ℹ️ GCS_BUCKET_NAME chưa cấu hình -> Bỏ qua tải từ Cloud.")
-        return
+        return None
 
     try:
-        from google.cloud import storage
-        from google.oauth2 import service_account
-
-        KEY_PATH = BASE_DIR / "gcs_key.json"
-
-        if KEY_PATH.exists():
-            logger.info(f"🔑 Tìm thấy key GCS tại: {KEY_PATH}")
-            credentials = service_account.Credentials.from_service_account_file(str(KEY_PATH))
-            client = storage.Client(credentials=credentials)
+        logger.info(f"📡 Đang đồng bộ GCS Bucket: {bucket_name}...")
+        source = make_law_source(bucket_name, prefix or "", BASE_DIR / "gcs_key.json")
+        report = LawSync(
+            source, DATA_LAWS_DIR, max_workers=GCS_SYNC_WORKERS, prune=GCS_SYNC_PRUNE,
+            prune_max_fraction=GCS_SYNC_PRUNE_MAX_FRACTION,
+        ).run()
+        if report.changed:
+            logger.info(f"✅ Đồng bộ xong: {report.summary()}")
         else:
-            logger.warning("⚠️ Không thấy file gcs_key.json. Thử dùng credentials mặc định...")
-            client = storage.Client()
+            logger.info(f"⚡ Dữ liệu local đã đồng bộ. ({report.summary()})")
+        return report
 
-        bucket = client.bucket(bucket_name)
-        blobs = bucket.list_blobs(prefix=prefix)
+    except Exception as e:
+        logger.error(f"❌ GCS Error: {e}")
+        logger.error("👉 Gợi ý: Kiểm tra Service Account hoặc cấu hình GCS.")
+        return None
 
-        count = 0
-        logger.info(f"📡 Đang kết nối GCS Bucket: {bucket_name}...")
 
-        for blob in blobs:
-            if blob.name.lower().endswith(".docx"):
-                filename = blob.name.split("/")[-1]
-                if not filename:
-                    continue
-                local_path = DATA_LAWS_DIR / filename
-                if not local_path.exists() or local_path.stat().st_size == 0:
-                    logger.info(f"⬇️ Đang tải: {filename}")
-                    blob.download_to_filename(str(local_path))
-                    count += 1
-
-        if count > 0:
-            logger.info(f"✅ Đã tải {count} file mới từ Cloud.")
-        else:
-            logger.info("⚡ Dữ liệu local đã đồng bộ.")
+def _bundle_store():
+    bucket_name = os.getenv("GCS_BUCKET_NAME")
+    if not bucket_name:
+        return None
+    return make_bundle_store(bucket_name, GCS_BUNDLES_PREFIX, BASE_DIR / "gcs_key.json")
+
 
+def pull_index_bundle(store: "LawVectorStore") -> Optional[str]:
+    """
+    Kéo bundle mới nhất khớp cấu hình của `store` từ bucket và trỏ CURRENT vào (chưa load).
+    None nếu chưa cấu hình bucket, bucket chưa có bundle khớp, hoặc lỗi (-> dùng bundle local / build local).
+    """
+    bundles = _bundle_store()
+    if bundles is None:
+        return None
+    try:
+        version = pull_bundle(bundles, store.index_dir, store.bundle_params())
     except Exception as e:
-        logger.error(f"❌ GCS Error: {e}")
-        logger.error("👉 Gợi ý: Kiểm tra Service Account hoặc cấu hình GCS.")
+        logger.error(f"❌ Kéo index bundle từ bucket lỗi: {e}")
+        return None
+    if version is None:
+        logger.info("ℹ️ Bucket chưa có index bundle khớp cấu hình.")
+        return None
+    prune_bundles(store.index_dir, INDEX_KEEP_BUNDLES)
+    return version
+
+
+def publish_index_bundle(bundle_dir: pathlib.Path) -> Dict:
+    """Đẩy bundle lên bucket cho các node khác kéo về (build_index.py --publish)."""
+    bundles = _bundle_store()
+    if bundles is None:
+        raise RuntimeError("GCS_BUCKET_NAME chưa cấu hình -> không publish được bundle.")
+    return publish_bundle(bundles, bundle_dir)
 
 
 # ===========================================================
 # 3. ADVANCED VECTOR STORE (HYBRID + VALIDITY FILTER)
 # ===========================================================
 
+def fuse_rankings(
+    vector_hits: List[Tuple[int, float]],
+    bm25_hits: List[Tuple[int, float]],
+    method: str = None,
+) -> List[Tuple[int, float]]:
+    """
+    Gộp kết quả FAISS + BM25 theo chunk id.
+    - "rrf": Reciprocal Rank Fusion (chỉ dùng thứ hạng).
+    - "weighted": min-max normalize từng nguồn rồi cộng có trọng số.
+    Trả về [(chunk_id, fused_score)] giảm dần.
+    """
+    method = method or FUSION_METHOD
+    fused: Dict[int, float] = {}
+
+    if method == "weighted":
+        w_vec, w_bm25 = FUSION_VECTOR_WEIGHT, 1.0 - FUSION_VECTOR_WEIGHT
+        for hits, weight in ((vector_hits, w_vec), (bm25_hits, w_bm25)):
+            if not hits:
+                continue
+            lo = min(s for _, s in hits)
+            hi = max(s for _, s in hits)
+            span = (hi - lo) or 1.0
+            for idx, score in hits:
+                fused[idx] = fused.get(idx, 0.0) + weight * (score - lo) / span
+    else:
+        for hits in (vector_hits, bm25_hits):
+            for rank, (idx, _) in enumerate(hits):
+                fused[idx] = fused.get(idx, 0.0) + 1.0 / (FUSION_RRF_K + rank + 1)
+
+    return sorted(fused.items(), key=lambda x: x[1], reverse=True)
+
+
+def _fusion_is_decisive(scores: List[float], final_k: int) -> bool:
+    """Top final_k tách biệt rõ với phần còn lại -> không cần cross-encoder."""
+    if len(scores) <= 1:
+        return True
+    top = scores[0]
+    if top <= 0:
+        return False
+    if len(scores) <= final_k:
+        # Lấy hết ứng viên, chỉ còn thứ tự: bỏ rerank khi từng cặp liền kề cách biệt rõ (điểm hoà -> rerank)
+        return all((a - b) / top >= RERANK_SKIP_MARGIN for a, b in zip(scores, scores[1:]))
+    return (scores[final_k - 1] - scores[final_k]) / top >= RERANK_SKIP_MARGIN
+
+
+def fit_chunks(chunks: List[LawChunk], max_chars: int) -> List[LawChunk]:
+    """Giữ các chunk đầu (đã xếp theo độ liên quan) trong tổng max_chars, luôn giữ ít nhất một chunk."""
+    kept, used = [], 0
+    for c in chunks:
+        if kept and used + len(c.text) > max_chars:
+            break
+        kept.append(c)
+        used += len(c.text)
+    return kept
+
+
 @dataclass
-class LawChunk:
-    text: str
+class SearchFilter:
+    """Giới hạn search theo văn bản nguồn và/hoặc loại văn bản (law | decree | amendment)."""
+    source_files: Optional[List[str]] = None
+    doc_types: Optional[List[str]] = None
+
+    def matches(self, source_file: str, kind: str) -> bool:
+        if self.source_files is not None and source_file not in self.source_files:
+            return False
+        if self.doc_types is not None and kind not in self.doc_types:
+            return False
+        return True
+
+
+@dataclass
+class IndexGeneration:
+    """
+    Một thế hệ index bất biến. Store chỉ giữ con trỏ tới thế hệ hiện tại;
+    request đang chạy giữ tham chiếu riêng nên reload không làm hỏng giữa chừng.
+    """
+    version: str = ""
+    chunks: ChunkTable = None
+    index: Any = None  # None khi bật shard: vector + BM25 chỉ nằm trong process shard
+    bm25: Any = None  # KeywordView trên cả corpus (postings trong bm25.index)
+    articles: Any = None
+    partitions: Dict[str, "LawPartition"] = None
+    manifest: Dict = None  # source_hashes, thống kê build... (ghi vào manifest.json của bundle)
+
+    def __post_init__(self):
+        self.chunks = self.chunks if self.chunks is not None else ChunkTable()
+        self.articles = self.articles or ArticleIndex()
+        self.partitions = self.partitions or {}
+        self.manifest = self.manifest or {}
+
+
+def _index_version(chunks: ChunkTable, params: Optional[Dict] = None) -> str:
+    """Version theo nội dung + tham số build + format bundle: cùng dữ liệu -> cùng version (cache không bị xoá oan)."""
+    h = hashlib.sha1(json.dumps({**(params or {}), "format": BUNDLE_FORMAT}, sort_keys=True).encode("utf-8"))
+    for text, source_file in chunks.rows():
+        h.update(source_file.encode("utf-8"))
+        h.update(text.encode("utf-8"))
+    return h.hexdigest()[:12]
+
+
+@dataclass
+class LawPartition:
+    """
+    Chunk của một văn bản: `ids` là id chunk toàn cục. Không giữ FAISS/BM25 riêng - search có filter
+    chỉ tính score trên `ids` của index chung (vector: đọc thẳng vector của các id đó; BM25: IDF của
+    cả corpus để score so sánh được giữa các văn bản).
+    """
     source_file: str
+    doc_type: str
+    ids: np.ndarray
 
 
 class LawVectorStore:
     """
     Store tích hợp:
     1. Validity Filter: Loại bỏ luật năm cũ.
-    2. Hybrid Search: Vector (FAISS) + Keyword (BM25).
-    3. Re-ranking: Cross-Encoder.
+    2. Hybrid Search: Vector (FAISS) + Keyword (BM25), gộp bằng rank fusion.
+    3. Re-ranking: Cross-Encoder (chỉ top-N sau fusion, bỏ qua khi đã rõ ràng).
     """
-    def __init__(self):
+    def __init__(self, index_dir: pathlib.Path = INDEX_DIR, data_dir: pathlib.Path = DATA_LAWS_DIR):
+        self.index_dir = pathlib.Path(index_dir)
+        self.data_dir = pathlib.Path(data_dir)
         self.embedder = SentenceTransformer(EMBED_MODEL_NAME)
         self.cross_encoder = CrossEncoder(RERANK_MODEL_NAME)
-        self.index = None
-        self.chunks: List[LawChunk] = []
-        self.bm25 = None  # Keyword search engine
+        # Query embedding + rerank đi qua scheduler để gom batch giữa các request
+        self.scheduler = InferenceScheduler(
+            self.embedder, self.cross_encoder,
+            max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS,
+        )
+        self.chunker = self._make_chunker()
+        # Chunk + FAISS + BM25 + article index + partition của thế hệ hiện tại
+        self._gen = IndexGeneration()
+        self._swap_lock = threading.Lock()
+        self.build_stats: Dict = {}  # throughput encode của lần build gần nhất
+        self.shards: Optional[ShardPool] = None  # Có -> mọi search đi qua các shard
+
+    def use_shards(self, pool: ShardPool):
+        """
+        Bật search qua shard (gọi trước load/build): thế hệ index chỉ giữ bảng chunk + partition,
+        FAISS/BM25 nằm trong các process shard, dựng xong mới swap thế hệ.
+        """
+        self.shards = pool
+
+    # Đọc con trỏ `_gen` là atomic; hàm nào dùng nhiều field thì snapshot `_gen` một lần
+    @property
+    def version(self) -> str:
+        return self._gen.version
+
+    @property
+    def chunks(self) -> ChunkTable:
+        return self._gen.chunks
+
+    @property
+    def index(self):
+        return self._gen.index
+
+    @property
+    def bm25(self):
+        return self._gen.bm25
+
+    @property
+    def articles(self) -> ArticleIndex:
+        return self._gen.articles
+
+    @property
+    def partitions(self) -> Dict[str, LawPartition]:
+        return self._gen.partitions
+
+    def swap(self, gen: IndexGeneration):
+        """Thay thế hệ index. Thế hệ cũ được giải phóng khi request cuối cùng dùng nó kết thúc."""
+        with self._swap_lock:
+            old, self._gen = self._gen, gen
+        if old.version and old.version != gen.version:
+            logger.info(f"🔄 Index {old.version} -> {gen.version} ({len(gen.chunks)} chunks)")
+
+    def _make_chunker(self) -> Optional[TokenChunker]:
+        """Chunk vừa đúng giới hạn token của model: không encode phần text sẽ bị cắt bỏ."""
+        if CHUNK_STRATEGY != "tokens":
+            return None
+        tokenizer = self.embedder.tokenizer
+        # max_seq_length đã gồm [CLS] + [SEP]
+        max_tokens = CHUNK_MAX_TOKENS or (self.embedder.max_seq_length - 2)
+        return TokenChunker(
+            count_tokens=lambda t: len(tokenizer.tokenize(t)),
+            max_tokens=max_tokens,
+            overlap_tokens=CHUNK_OVERLAP_TOKENS,
+            min_len=CHUNK_MIN_LEN,
+        )
+
+    def chunk_text(self, text: str, source_name: str) -> List[str]:
+        if self.chunker is not None:
+            return self.chunker.chunk(text, source_name)
+        return chunk_law_text(text, source_name, min_len=CHUNK_MIN_LEN, max_chunk_size=CHUNK_MAX_CHARS)
+
+    @staticmethod
+    def _new_table_builder() -> ChunkTableBuilder:
+        return ChunkTableBuilder(compression=CHUNK_COMPRESSION, block_bytes=CHUNK_BLOCK_BYTES)
 
     def _filter_valid_laws(self, dir_path: pathlib.Path) -> List[pathlib.Path]:
         files = list(dir_path.glob("*.docx"))
@@ -629,106 +1050,414 @@ class LawVectorStore:
         logger.info(f"🧹 Lọc luật cũ: {len(files)} -> {len(valid_files)} file hiệu lực.")
         return valid_files
 
-    def build(self):
-        valid_files = self._filter_valid_laws(DATA_LAWS_DIR)
+    def bundle_params(self) -> Dict:
+        """Cấu hình phải khớp giữa lúc build bundle và lúc server load."""
+        return {
+            "embed_model": EMBED_MODEL_NAME,
+            "embedding_dim": self.embedder.get_sentence_embedding_dimension(),
+            "chunking": self.chunker.params() if self.chunker is not None else {
+                "strategy": "chars", "min_len": CHUNK_MIN_LEN, "max_chunk_size": CHUNK_MAX_CHARS,
+            },
+            "search_shards": SEARCH_SHARDS if SEARCH_SHARDS > 1 else 0,  # Bundle có sẵn file cho từng shard
+        }
+
+    def build(self, changed: Optional[Set[str]] = None, activate: bool = True):
+        """
+        changed=None: build lại toàn bộ.
+        changed={tên file}: chỉ đọc/encode lại các file đó (và file có hash khác bundle hiện tại),
+        file khác dùng lại chunk + vector của thế hệ hiện tại.
+        """
+        gen = self._build_generation(changed)
+        if gen is None:
+            return
+        if self.shards is None:
+            self.swap(gen)
+            self.save(activate=activate)
+            return
+        # Bật shard: ghi bundle (kèm file từng shard), dựng shard, rồi mới swap thế hệ không giữ FAISS/BM25
+        path = self.save(activate=activate, gen=gen)
+        self._start_shards(path, gen.version)
+        self.swap(self._lean(gen))
+
+    @staticmethod
+    def _add_vectors(
+        index, total: int, reused: List[Tuple[int, np.ndarray]], encoded, old_index
+    ):
+        """
+        Add vector vào FAISS theo đúng thứ tự chunk, từng khối INDEX_ADD_BLOCK dòng: đoạn dùng lại đọc
+        từ index cũ, đoạn mới đọc từ memmap. Không dựng mảng embedding cả corpus (FAISS đã giữ một bản).
+        """
+        segments = sorted(reused, key=lambda r: r[0])
+        pos, reused_i, new_i = 0, 0, 0
+        while pos < total:
+            if reused_i < len(segments) and segments[reused_i][0] == pos:
+                old_ids = segments[reused_i][1]
+                for lo in range(0, len(old_ids), INDEX_ADD_BLOCK):
+                    index.add(old_index.reconstruct_batch(old_ids[lo:lo + INDEX_ADD_BLOCK]))
+                pos += len(old_ids)
+                reused_i += 1
+                continue
+            # Đoạn chunk mới liên tiếp tới đoạn dùng lại kế tiếp (new_ids tăng dần, khớp thứ tự memmap)
+            end = segments[reused_i][0] if reused_i < len(segments) else total
+            for lo in range(new_i, new_i + (end - pos), INDEX_ADD_BLOCK):
+                hi = min(lo + INDEX_ADD_BLOCK, new_i + (end - pos))
+                index.add(np.ascontiguousarray(encoded[lo:hi], dtype=np.float32))
+            new_i += end - pos
+            pos = end
+
+    def rebuild(self, changed: Optional[Set[str]] = None) -> str:
+        """Build thế hệ mới trong khi thế hệ cũ vẫn phục vụ, rồi swap. Trả về version đang dùng."""
+        self.build(changed)
+        return self.version
+
+    def _build_generation(self, changed: Optional[Set[str]] = None) -> Optional[IndexGeneration]:
+        valid_files = self._filter_valid_laws(self.data_dir)
         if not valid_files:
             logger.warning("⚠️ Không có file dữ liệu.")
-            return
-
-        all_chunks = []
+            return None
+
+        params = self.bundle_params()
+        hashes = source_hashes(valid_files)
+        old = self._gen if changed is not None else IndexGeneration()
+        old_hashes = old.manifest.get("source_hashes")
+        old_index = old.index
+        if old_index is None and old.version:
+            # Bật shard: vector của thế hệ cũ chỉ còn trong bundle
+            old_index = faiss.read_index(str(bundles_root(self.index_dir) / old.version / "laws.faiss"))
+        table = self._new_table_builder()
+        reused: List[Tuple[int, np.ndarray]] = []  # (vị trí bắt đầu, id chunk cũ) của file không đổi
+        articles = ArticleIndex()
+        reused_files = 0
         for f in valid_files:
+            part = old.partitions.get(f.name) if f.name not in (changed or ()) else None
+            if part is not None and old_hashes is not None and old_hashes.get(f.name) != hashes[f.name]:
+                part = None  # nội dung file khác lúc build bundle cũ
+            if part is not None:
+                reused_files += 1
+                reused.append((len(table), part.ids))
+                for i in part.ids:
+                    table.append(old.chunks.text(i), old.chunks.source(i))
+                articles.add_law_parsed(f.name, old.articles.laws.get(f.name, {}))
+                continue
             text = read_docx(f)
-            chunks = chunk_law_text(text, f.name)
-            for c in chunks:
-                all_chunks.append(LawChunk(text=c, source_file=f.name))
+            articles.add_law(f.name, text)
+            for c in self.chunk_text(text, f.name):
+                table.append(c, f.name)
 
-        if not all_chunks:
-            return
+        all_chunks = table.build()
+        if not len(all_chunks):
+            return None
 
-        self.chunks = all_chunks
+        if changed is not None:
+            logger.info(f"♻️ Build incremental: dùng lại {reused_files} file, xử lý lại {len(valid_files) - reused_files} file.")
+        logger.info(f"📑 Article index: {len(articles)} điều / {len(articles.laws)} văn bản.")
 
         # Build FAISS
         logger.info("⚡ Building FAISS Index...")
-        embeddings = self.embedder.encode([c.text for c in all_chunks], convert_to_numpy=True)
-        self.index = faiss.IndexFlatIP(embeddings.shape[1])
-        self.index.add(embeddings)
+        is_new = np.ones(len(all_chunks), dtype=bool)
+        for start, old_ids in reused:
+            is_new[start:start + len(old_ids)] = False
+        new_ids = np.flatnonzero(is_new)
+        self.build_stats = {}
+        staging = self.index_dir / "embeddings.build.npy"
+        encoded = None
+        if len(new_ids):
+            # Vector mới nằm trong memmap trên đĩa (thứ tự = new_ids), không giữ bản copy trong RAM
+            encoded, self.build_stats = encode_corpus(
+                self.embedder, [all_chunks.text(int(i)) for i in new_ids],
+                batch_size=EMBED_BATCH_SIZE, workers=EMBED_BUILD_WORKERS,
+                bucket_size=EMBED_BUCKET_SIZE, out_path=staging,
+            )
+        index = faiss.IndexFlatIP(self.embedder.get_sentence_embedding_dimension())
+        try:
+            self._add_vectors(index, len(all_chunks), reused, encoded, old_index)
+        finally:
+            del encoded
+            staging.unlink(missing_ok=True)
 
         # Build BM25
         logger.info("🔑 Building BM25 Index...")
-        tokenized_corpus = [c.text.lower().split() for c in all_chunks]
-        self.bm25 = BM25Okapi(tokenized_corpus)
-
-        logger.info(f"✅ Index xong {len(all_chunks)} chunks.")
-        self.save()
-
-    def hybrid_search(self, query: str, top_k=50, final_k=5) -> List[LawChunk]:
-        if not self.chunks or self.index is None or self.bm25 is None:
-            return []
-
-        # Semantic search
-        q_vec = self.embedder.encode([query], convert_to_numpy=True)
-        _, v_idxs = self.index.search(q_vec, top_k)
-        vector_results = {idx for idx in v_idxs[0] if 0 <= idx < len(self.chunks)}
+        keyword = KeywordIndex.build(tokenize(text) for text, _ in all_chunks.rows())
 
-        # BM25
-        tokenized_query = query.lower().split()
-        bm25_top = self.bm25.get_top_n(tokenized_query, self.chunks, n=top_k)
+        logger.info(
+            f"✅ Index xong {len(all_chunks)} chunks ({len(new_ids)} chunk encode mới, "
+            f"bảng chunk {all_chunks.nbytes / 1e6:.1f}MB, nén: {all_chunks.compression})."
+        )
+        return IndexGeneration(
+            version=_index_version(all_chunks, params),
+            chunks=all_chunks,
+            index=index,
+            bm25=keyword.view(),
+            articles=articles,
+            partitions=self._build_partitions(all_chunks),
+            manifest={
+                "source_hashes": hashes,
+                "chunks": len(all_chunks),
+                "chunk_compression": all_chunks.compression,
+                "embed_stats": self.build_stats,
+            },
+        )
 
-        candidate_chunks: List[LawChunk] = []
-        for idx in vector_results:
-            candidate_chunks.append(self.chunks[idx])
-        for c in bm25_top:
-            if c not in candidate_chunks:
-                candidate_chunks.append(c)
+    def lookup_articles(self, query: str) -> List[LawChunk]:
+        """Câu hỏi trích dẫn rõ "Điều N [khoản M] Luật X" -> lấy thẳng từ article index."""
+        with stage_timer("article_lookup"):
+            hits = self.articles.lookup(query)
+        record_cache("article_index", bool(hits))
+        return [LawChunk(text=f"[NGUỒN: {src}]\n{text}", source_file=src) for src, text in hits]
 
-        if not candidate_chunks:
+    def expand_to_articles(self, chunks: List[LawChunk], max_chars: int = ARTICLE_EXPAND_MAX_CHARS) -> List[LawChunk]:
+        """
+        Chunk con (một phần của Điều) -> cả Điều từ article index; nhiều hit cùng Điều chỉ giữ một.
+        Chunk không thuộc Điều nào, hoặc Điều trùng số trong luật sửa đổi, giữ nguyên.
+        """
+        articles = self.articles
+        expanded: List[LawChunk] = []
+        seen = set()
+        for c in chunks:
+            if c.article >= 0:
+                key = (c.source_file, c.article)
+                if key in seen:
+                    continue
+                full = articles.get(c.source_file, str(c.article))
+                # Header của chunk phải khớp Điều trong index (article index chỉ giữ lần xuất hiện đầu)
+                header = c.text.split("\n", 2)[1].removesuffix(" (tiếp)") if "\n" in c.text else ""
+                if full and full.split("\n", 1)[0] == header:
+                    seen.add(key)
+                    if len(full) > max_chars:
+                        full = full[:max_chars] + "..."
+                    expanded.append(LawChunk(f"[NGUỒN: {c.source_file}]\n{full}", c.source_file, c.article))
+                    continue
+            expanded.append(c)
+        return expanded
+
+    @staticmethod
+    def _build_partitions(chunks: ChunkTable) -> Dict[str, LawPartition]:
+        """Chia chunk theo văn bản nguồn: chỉ giữ id, vector + BM25 vẫn nằm trong index chung (hoặc shard)."""
+        partitions = {}
+        for source_file, ids_arr in chunks.ids_by_source().items():
+            partitions[source_file] = LawPartition(
+                source_file=source_file,
+                doc_type=doc_type(source_file),
+                ids=ids_arr,
+            )
+        logger.info(f"🗂️ {len(partitions)} partition theo văn bản nguồn.")
+        return partitions
+
+    def route(self, query: str) -> Optional[SearchFilter]:
+        """Chọn partition từ câu hỏi: tên/số hiệu văn bản được nhắc + từ khoá lĩnh vực."""
+        gen = self._gen
+        sources = route_domains(query, list(gen.partitions))
+        named = gen.articles.resolve_law(query)
+        if named in gen.partitions:
+            sources.add(named)
+        if not sources:
+            return None
+        return SearchFilter(source_files=sorted(sources))
+
+    @staticmethod
+    def _vector_hits(index, q_vec: np.ndarray, top_k: int, ids: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """ids=None -> cả index; có ids -> chỉ tính trên vector của các id đó (chi phí theo len(ids))."""
+        if ids is None:
+            v_scores, v_idxs = index.search(q_vec, min(top_k, index.ntotal))
+            v_idxs, v_scores = v_idxs[0], v_scores[0]
+        else:
+            v_idxs, v_scores = subset_vector_search(index, q_vec, top_k, ids)
+        return [
+            (int(idx), float(score))
+            for idx, score in zip(v_idxs, v_scores)
+            if 0 <= idx < index.ntotal
+        ]
+
+    def hybrid_search(
+        self, query: str, top_k=50, final_k=5, filters: Optional[SearchFilter] = None
+    ) -> List[LawChunk]:
+        """
+        filters=None -> search toàn bộ corpus.
+        Có filters -> chỉ search trong các partition khớp (chi phí theo kích thước partition).
+        """
+        gen = self._gen  # cả request dùng một thế hệ index, kể cả khi đang reload
+        if not len(gen.chunks) or (gen.index is None and self.shards is None):
             return []
 
-        pairs = [[query, c.text] for c in candidate_chunks]
-        scores = self.cross_encoder.predict(pairs)
-        sorted_indices = np.argsort(scores)[::-1]
+        parts = None
+        if filters is not None:
+            parts = [p for p in gen.partitions.values() if filters.matches(p.source_file, p.doc_type)]
+            if not parts:
+                return []
 
-        final_results = []
-        for i in range(min(final_k, len(candidate_chunks))):
-            idx = sorted_indices[i]
-            final_results.append(candidate_chunks[idx])
-
-        return final_results
+        # Semantic search (giữ lại cả score)
+        with stage_timer("embed_query"):
+            q_vec = self.scheduler.encode([query])
+        if stage_cancelled():  # Stage speculative bị huỷ trong lúc chờ encode
+            return []
+        tokens = tokenize(query)
+
+        if gen.index is None:
+            # Bật shard: scatter-gather (shard lỗi -> kết quả của các shard còn lại)
+            sources = None if parts is None else [p.source_file for p in parts]
+            with stage_timer("shard_search"):
+                shard_hits = self.shards.search(gen.version, q_vec, tokens, top_k, sources)
+            if shard_hits is None:
+                logger.error(f"❌ Không shard nào trả lời cho index {gen.version}")
+                return []
+            vector_hits, bm25_hits = shard_hits
+        else:
+            with stage_timer("faiss_search"):
+                if parts is None:
+                    vector_hits = self._vector_hits(gen.index, q_vec, top_k)
+                else:
+                    ids = np.concatenate([p.ids for p in parts]).astype(np.int64)
+                    vector_hits = self._vector_hits(gen.index, q_vec, top_k, ids)
 
-    def save(self):
-        if self.index is None:
-            return
+            with stage_timer("bm25_search"):
+                if parts is None:
+                    bm25_hits = gen.bm25.top_k(tokens, top_k)
+                else:
+                    # IDF/avgdl của cả corpus trên chunk của các partition: một lần top_k, score so sánh được
+                    bm25_hits = gen.bm25.top_k(tokens, top_k, gen.bm25.index.positions(ids))
 
-        INDEX_DIR.mkdir(exist_ok=True, parents=True)
+        fused = fuse_rankings(vector_hits, bm25_hits)
+        if not fused:
+            return []
 
-        faiss.write_index(self.index, str(INDEX_DIR / "laws.faiss"))
+        # Cascade: chỉ top-N vào cross-encoder, bỏ qua hẳn nếu fusion đã phân định rõ
+        candidates = fused[:max(RERANK_TOP_N, final_k)]
+        if _fusion_is_decisive([s for _, s in candidates], final_k) or degrade("skip_rerank"):
+            return [gen.chunks[idx] for idx, _ in candidates[:final_k]]
+        if stage_cancelled():
+            return []
 
-        with (INDEX_DIR / "laws_meta.jsonl").open("w", encoding="utf-8") as f:
-            for c in self.chunks:
-                data = {"text": c.text, "source_file": c.source_file}
-                f.write(json.dumps(data, ensure_ascii=False) + "\n")
+        pairs = [[query, gen.chunks.text(idx)] for idx, _ in candidates]
+        with stage_timer("rerank"):
+            scores = self.scheduler.rerank(pairs)
+        sorted_indices = np.argsort(scores)[::-1]
 
-        logger.info("💾 Đã lưu Index xuống ổ cứng.")
+        return [gen.chunks[candidates[i][0]] for i in sorted_indices[:final_k]]
+
+    def save(self, activate: bool = True, gen: Optional[IndexGeneration] = None) -> Optional[pathlib.Path]:
+        """Ghi thế hệ hiện tại thành bundle index_dir/bundles/<version>/ và trỏ CURRENT vào nó."""
+        gen = gen or self._gen
+        if gen.index is None:
+            return None  # Thế hệ đang phục vụ qua shard: bundle của nó đã có sẵn
+
+        def write_files(bundle_dir: pathlib.Path):
+            faiss.write_index(gen.index, str(bundle_dir / "laws.faiss"))
+            gen.chunks.save(bundle_dir / "chunks.npz")
+            gen.bm25.index.save(bundle_dir / "keyword.npz")  # Partition là view, không lưu riêng
+            gen.articles.save(bundle_dir)
+            if SEARCH_SHARDS > 1:
+                write_shards(
+                    bundle_dir, gen.index, gen.bm25,
+                    {name: p.ids for name, p in gen.partitions.items()}, SEARCH_SHARDS,
+                )
+
+        path = write_bundle(
+            self.index_dir, gen.version, {**self.bundle_params(), **gen.manifest}, write_files, activate=activate
+        )
+        removed = prune_bundles(self.index_dir, INDEX_KEEP_BUNDLES)
+        logger.info(f"💾 Đã lưu index bundle {path.name}" + (f" (dọn {len(removed)} bundle cũ)" if removed else "."))
+        return path
+
+    def _start_shards(self, bundle: pathlib.Path, version: str):
+        """Dựng bộ shard cho bundle (chờ xong); lỗi -> IndexBundleError, thế hệ đang phục vụ giữ nguyên."""
+        if not self.shards.start(bundle, version, background=False):
+            raise IndexBundleError(f"Không dựng được {self.shards.num_shards} shard cho bundle {bundle.name}.")
+
+    def _lean(self, gen: IndexGeneration) -> IndexGeneration:
+        """Thế hệ khi bật shard: bỏ FAISS + BM25 (đã nằm trong process shard), partition chỉ còn id."""
+        return IndexGeneration(
+            version=gen.version,
+            chunks=gen.chunks,
+            articles=gen.articles,
+            partitions=self._build_partitions(gen.chunks, None),
+            manifest=gen.manifest,
+        )
 
     def load(self) -> bool:
-        if not (INDEX_DIR / "laws.faiss").exists():
-            return False
+        """
+        Load bundle CURRENT. Bundle build bằng model/tham số khác cấu hình -> IndexBundleError.
+        Thư mục index kiểu cũ (chưa có bundle) chỉ load khi INDEX_ALLOW_LEGACY=1, nếu không coi như chưa có index.
+        """
+        bundle = current_bundle(self.index_dir)
+        if bundle is None:
+            if not (self.index_dir / "laws.faiss").exists():
+                return False
+            if not INDEX_ALLOW_LEGACY:
+                logger.warning(
+                    f"⚠️ Bỏ qua index kiểu cũ trong {self.index_dir}: không có manifest để kiểm model/cách chunk. "
+                    "Chạy `python build_index.py` để tạo bundle (hoặc đặt INDEX_ALLOW_LEGACY=1 nếu chắc chắn dùng được)."
+                )
+                return False
+            return self._load_legacy()
+
+        manifest = read_manifest(bundle)
+        check_manifest(manifest, self.bundle_params())
+        logger.info(f"📂 Đang load index bundle {bundle.name}...")
+
+        chunks = ChunkTable.load(bundle / "chunks.npz")
+        index = keyword = None
+        if self.shards is None:
+            index = faiss.read_index(str(bundle / "laws.faiss"))
+            if index.ntotal != len(chunks):
+                raise IndexBundleError(f"Bundle {bundle.name} hỏng: {index.ntotal} vector nhưng {len(chunks)} chunk.")
+            keyword = KeywordIndex.load(bundle / "keyword.npz")  # Mảng thuần, không unpickle dữ liệu từ bucket
+            if len(keyword) != len(chunks):
+                raise IndexBundleError(f"Bundle {bundle.name} hỏng: BM25 có {len(keyword)} chunk, bảng chunk {len(chunks)}.")
+
+        gen = IndexGeneration(
+            version=manifest["version"],
+            chunks=chunks,
+            index=index,
+            bm25=keyword.view() if keyword is not None else None,
+            articles=ArticleIndex.load(bundle) or ArticleIndex(),
+            partitions=self._build_partitions(chunks),
+            manifest={k: manifest[k] for k in ("source_hashes", "chunks", "chunk_compression") if k in manifest},
+        )
+        if self.shards is not None:
+            # FAISS/BM25 chỉ nằm trong shard: shard phải sẵn sàng trước khi thế hệ này phục vụ
+            self._start_shards(bundle, gen.version)
+        self.swap(gen)
+        logger.info(f"✅ Đã load {len(chunks)} chunks (bundle {gen.version}).")
+        return True
 
-        logger.info("📂 Đang load Index từ ổ cứng...")
+    def _load_legacy(self) -> bool:
+        """
+        index_laws/laws.faiss + laws_meta.jsonl (trước khi có bundle): không có manifest, chỉ kiểm được
+        số chiều vector. Index cũ chunk theo ký tự -> cấu hình phải là CHUNK_STRATEGY=chars.
+        """
+        if CHUNK_STRATEGY != "chars":
+            raise IndexBundleError(
+                f"Index kiểu cũ trong {self.index_dir} chunk theo ký tự, cấu hình đang là CHUNK_STRATEGY={CHUNK_STRATEGY}. "
+                "Chạy `python build_index.py` để tạo bundle (hoặc đặt CHUNK_STRATEGY=chars)."
+            )
+        logger.warning(
+            f"⚠️ {self.index_dir} là index kiểu cũ (INDEX_ALLOW_LEGACY=1), không có manifest -> không kiểm được model. "
+            "Nên chạy `python build_index.py` để tạo bundle."
+        )
 
-        self.index = faiss.read_index(str(INDEX_DIR / "laws.faiss"))
+        index = faiss.read_index(str(self.index_dir / "laws.faiss"))
+        dim = self.embedder.get_sentence_embedding_dimension()
+        if index.d != dim:
+            raise IndexBundleError(f"Index cũ có {index.d} chiều, model {EMBED_MODEL_NAME} cho {dim} chiều.")
 
-        self.chunks = []
-        with (INDEX_DIR / "laws_meta.jsonl").open("r", encoding="utf-8") as f:
+        table = self._new_table_builder()
+        with (self.index_dir / "laws_meta.jsonl").open("r", encoding="utf-8") as f:
             for line in f:
                 data = json.loads(line)
-                self.chunks.append(LawChunk(text=data["text"], source_file=data["source_file"]))
+                table.append(data["text"], data["source_file"])
+        chunks = table.build()
+
+        gen = IndexGeneration(version=_index_version(chunks), chunks=chunks, index=index)
+        if len(chunks):
+            keyword = KeywordIndex.build(tokenize(text) for text, _ in chunks.rows())
+            gen.bm25 = keyword.view()
+            gen.partitions = self._build_partitions(chunks)
 
-        if self.chunks:
-            tokenized = [c.text.lower().split() for c in self.chunks]
-            self.bm25 = BM25Okapi(tokenized)
+        # Index cũ chưa có articles.json -> dựng lại từ chunk
+        gen.articles = ArticleIndex.load(self.index_dir) or ArticleIndex.from_chunks(list(chunks.rows()))
 
-        logger.info(f"✅ Đã load {len(self.chunks)} chunks.")
+        self.swap(gen)
+        logger.info(f"✅ Đã load {len(chunks)} chunks.")
         return True
 
 
@@ -751,7 +1480,8 @@ class IntentNormalizationAgent:
     def run(self, text: str) -> Dict:
         res = GeminiClient.generate_json(
             self.PROMPT.format(input=text),
-            fallback={"clean_text": text, "mode": "tra_cuu_luat"}
+            fallback={"clean_text": text, "mode": "tra_cuu_luat"},
+            call="intent",
         )
         keys = ["thủ tục", "đăng ký", "luật", "hồ sơ", "thuế", "cần gì", "như thế nào"]
         if res.get("mode") == "chatchit" and any(k in res.get("clean_text", "").lower() for k in keys):
@@ -767,32 +1497,42 @@ class RAGRetrievalAgent:
     def __init__(self, store: LawVectorStore):
         self.store = store
 
-    def run(self, complex_query: str) -> List[LawChunk]:
+    def decompose(self, complex_query: str) -> List[str]:
         prompt = f"""
         Phân tích câu hỏi: "{complex_query}"
         Hãy tách thành 3 search queries ngắn gọn để tìm kiếm trong luật.
         Output JSON list: ["query1", "query2", "query3"]
         """
-        queries = GeminiClient.generate_json(prompt, fallback=[complex_query])
+        with stage_timer("cot_decompose"):
+            queries = GeminiClient.generate_json(prompt, fallback=[complex_query], call="cot")
         if not isinstance(queries, list):
             queries = [complex_query]
 
         logger.info(f"🧠 CoT Queries: {queries}")
+        return queries
 
-        all_results: List[LawChunk] = []
-        for q in queries:
-            results = self.store.hybrid_search(q, top_k=30, final_k=3)
-            all_results.extend(results)
+    def search(self, query: str, route_hint: str = "") -> List[LawChunk]:
+        """Search trong partition được route từ query (+ câu hỏi gốc làm gợi ý), không route được -> toàn bộ."""
+        filters = self.store.route(f"{route_hint} {query}")
+        if filters is not None:
+            logger.info(f"🗂️ Route '{query[:40]}' -> {len(filters.source_files)} văn bản")
+        return self.store.hybrid_search(query, top_k=30, final_k=3, filters=filters)
 
+    @staticmethod
+    def merge(result_lists: List[List[LawChunk]]) -> List[LawChunk]:
         seen = set()
         unique_results: List[LawChunk] = []
-        for r in all_results:
-            if r.text not in seen:
-                unique_results.append(r)
-                seen.add(r.text)
-
+        for results in result_lists:
+            for r in results:
+                if r.text not in seen:
+                    unique_results.append(r)
+                    seen.add(r.text)
         return unique_results
 
+    def run(self, complex_query: str) -> List[LawChunk]:
+        queries = self.decompose(complex_query)
+        return self.merge([self.search(q, route_hint=complex_query) for q in queries])
+
 
 class ContractAnalyzerAgent:
     """
@@ -827,6 +1567,19 @@ class ContractAnalyzerAgent:
             return "❌ Lỗi: Không đọc được nội dung hợp đồng."
 
         status_info = detect_contract_status(contract_text)
+        law_block = self.retrieve_laws(contract_text, store)
+        return self.generate(contract_text, status_info, law_block)
+
+    @staticmethod
+    def retrieve_laws(contract_text: str, store: Optional[LawVectorStore] = None) -> str:
+        """RAG luật tham chiếu cho hợp đồng (độc lập với bước phân loại TEMPLATE/FINAL)."""
+        if not store:
+            return "Không sử dụng RAG."
+        query = contract_text[:1500].replace("\n", " ")
+        law_chunks = store.hybrid_search(query, top_k=40, final_k=8)
+        return "\n".join([f"- [Nguồn: {c.source_file}] {c.text[:500]}" for c in law_chunks])
+
+    def generate(self, contract_text: str, status_info: Dict, law_block: str) -> str:
         doc_type = status_info.get("status", "FINAL")
         reason = status_info.get("reason", "")
         logger.info(f"[ContractAnalyzer] Phát hiện loại hợp đồng: {doc_type} | Lý do: {reason}")
@@ -852,13 +1605,6 @@ class ContractAnalyzerAgent:
             4. Đưa ra các vấn đề trọng yếu cần đàm phán lại.
             """
 
-        if store:
-            query = contract_text[:1500].replace("\n", " ")
-            law_chunks = store.hybrid_search(query, top_k=40, final_k=8)
-            law_block = "\n".join([f"- [Nguồn: {c.source_file}] {c.text[:500]}" for c in law_chunks])
-        else:
-            law_block = "Không sử dụng RAG."
-
         prompt = f"""
         {CORE_SYSTEM_PROMPT}
 
@@ -922,10 +1668,84 @@ class ContractAnalyzerAgent:
         Lời khuyên: (Nếu dưới 70 điểm, yêu cầu người dùng xem xét kỹ lưỡng và chỉnh sửa lại hợp đồng trước khi ký kết).
         """
 
-        return GeminiClient.generate_text(prompt)
+        return GeminiClient.generate_text(prompt, call="contract_analysis")
+
+    @classmethod
+    def retrieve_changed_laws(
+        cls, changes: List[ClauseChange], previous: AnalysisRecord, contract_text: str,
+        store: Optional[LawVectorStore] = None,
+    ) -> str:
+        """
+        Luật tham chiếu cho bản mới: giữ của bản trước + RAG trên điều khoản thay đổi.
+        Index đã đổi (hoặc bản trước không lưu được luật tham chiếu) -> RAG lại cho cả hợp đồng.
+        """
+        if not store:
+            return previous.law_block
+        if previous.index_version == store.version and previous.law_block.strip():
+            lines = previous.law_block.split("\n")
+        else:
+            lines = cls.retrieve_laws(contract_text, store).split("\n")
+        changed_text = " ".join(c.new[2] for c in changes if c.new is not None and c.kind != "unchanged")
+        if changed_text:
+            law_chunks = store.hybrid_search(changed_text[:1500], top_k=40, final_k=4)
+            lines += [f"- [Nguồn: {c.source_file}] {c.text[:500]}" for c in law_chunks]
+        return "\n".join(dict.fromkeys(line for line in lines if line.strip()))
+
+    def reanalyze(self, previous: AnalysisRecord, changes: List[ClauseChange], law_block: str) -> str:
+        """
+        Cập nhật báo cáo của bản trước chỉ dựa trên các điều khoản thêm/sửa/xoá
+        (không gửi lại toàn văn hợp đồng), rồi gắn bảng thay đổi lên đầu.
+        """
+        doc_type = previous.status.get("status", "FINAL")
+        selected_checklist = self.checklist_template if doc_type == "TEMPLATE" else self.checklist_final
+        counts = change_counts(changes)
+        logger.info(
+            f"[ContractAnalyzer] Phân tích lại so với {previous.filename}: "
+            f"{counts['modified']} sửa, {counts['added']} thêm, {counts['removed']} xoá, {counts['unchanged']} giữ nguyên"
+        )
+
+        prompt = f"""
+        {CORE_SYSTEM_PROMPT}
+
+        🔁 PHÁT HIỆN: BẢN MỚI CỦA HỢP ĐỒNG ĐÃ PHÂN TÍCH ({doc_type}).
+        NHIỆM VỤ:
+        1. Chỉ đánh giá lại các điều khoản THÊM / SỬA / XOÁ bên dưới; các điều khoản khác giữ nguyên như bản trước.
+        2. Đối chiếu các điều khoản thay đổi với checklist và luật tham chiếu.
+        3. Cập nhật báo cáo cũ: bỏ rủi ro đã được khắc phục, thêm rủi ro mới, chấm lại điểm.
+
+        === BÁO CÁO PHÂN TÍCH BẢN TRƯỚC ===
+        {previous.report[:15000]}
+
+        === CÁC ĐIỀU KHOẢN THAY ĐỔI ===
+        {render_changes(changes)}
+
+        === DỮ LIỆU HỖ TRỢ ===
+        • CHECKLIST ÁP DỤNG:
+        {selected_checklist}
+
+        • LUẬT THAM CHIẾU (RAG):
+        {law_block}
+
+        =====================================================
+        🎯 YÊU CẦU OUTPUT (THEO ĐÚNG CẤU TRÚC MARKDOWN)
+        =====================================================
+        # 0. THAY ĐỔI SO VỚI BẢN TRƯỚC
+        Với mỗi điều khoản thay đổi: nội dung thay đổi, tác động (có lợi / bất lợi / trung tính), bên hưởng lợi.
+
+        Sau đó viết lại ĐẦY ĐỦ các mục 1–5 theo đúng cấu trúc của báo cáo bản trước
+        (giữ nguyên nhận định của các điều khoản không đổi, cập nhật phần bị ảnh hưởng),
+        bảng điểm mục 5 thay toàn bộ `<...>` bằng giá trị thực và ghi điểm bản trước bên cạnh điểm mới.
+        """
+
+        report = GeminiClient.generate_text(prompt, call="contract_reanalysis")
+        if report == LLM_DEGRADED_TEXT:
+            return report
+        return f"## 🔁 Phân tích lại so với bản trước (`{previous.filename}`)\n\n{changes_table(changes)}\n\n{report}"
 
     def suggest(self, req: str) -> str:
-        return GeminiClient.generate_text(f"Soạn điều khoản phù hợp cho hợp đồng doanh nghiệp: {req}")
+        return GeminiClient.generate_text(
+            f"Soạn điều khoản phù hợp cho hợp đồng doanh nghiệp: {req}", call="suggest"
+        )
 
 
 class LegalAnswerAgent:
@@ -936,7 +1756,7 @@ class LegalAnswerAgent:
     (và có thể mở rộng sau)
     """
 
-    def run(self, query: str, context: str, mode: str) -> str:
+    def run(self, query: str, context: str, mode: str, history: str = "") -> str:
         if mode == "tra_cuu_luat":
             mode_instruction = """
             Bạn đang ở MODE: TRA CỨU LUẬT (SEMANTIC LEGAL LOOKUP).
@@ -983,12 +1803,17 @@ class LegalAnswerAgent:
             4) Cảnh báo và gợi ý hành động
             """
 
+        history_block = (
+            f"\n================= LỊCH SỬ HỘI THOẠI (RÚT GỌN) =================\n{history}\n"
+            if history else ""
+        )
+
         prompt = f"""
 {CORE_SYSTEM_PROMPT}
 
 ================= NGỮ CẢNH (CONTEXT_LUAT / RAG) =================
 {context}
-
+{history_block}
 ================= CÂU HỎI CỦA NGƯỜI DÙNG =================
 {query}
 
@@ -1000,7 +1825,7 @@ LƯU Ý:
 - Nếu context trống hoặc yếu, phải nói rõ: "Dữ liệu không đủ để đưa ra kết luận chính xác."
 - Luôn trả lời bằng tiếng Việt, rõ ràng, có cấu trúc.
 """
-        return GeminiClient.generate_text(prompt)
+        return GeminiClient.generate_text(prompt, call="answer")
 
 
 # ===========================================================
@@ -1010,38 +1835,244 @@ LƯU Ý:
 class LegalOrchestrator:
     def __init__(self):
         logger.info("🚀 System Init...")
-        download_law_docs_from_gcs()
         self.store = LawVectorStore()
-        self.store.build()
+        if SEARCH_SHARDS > 1:
+            # Trước load/build: process chính không giữ FAISS/BM25, shard dựng xong mới phục vụ
+            self.store.use_shards(ShardPool(SEARCH_SHARDS, timeout_s=SEARCH_SHARD_TIMEOUT_S))
+        # Node phục vụ: bundle build sẵn trên bucket (vài giây) thay vì tải DOCX + encode (vài phút)
+        if INDEX_PULL_ON_START:
+            pull_index_bundle(self.store)
+        if not self.store.load():
+            if not INDEX_BUILD_ON_START:
+                raise IndexBundleError(
+                    f"Chưa có index bundle trong {INDEX_DIR}. "
+                    "Chạy `python build_index.py` trước khi start server (hoặc đặt INDEX_BUILD_ON_START=1)."
+                )
+            download_law_docs_from_gcs()
+            self.store.build()
 
         self.intent_agent = IntentNormalizationAgent()
         self.rag_agent = RAGRetrievalAgent(self.store)
         self.contract_agent = ContractAnalyzerAgent()
         self.answer_agent = LegalAnswerAgent()
+        self.sessions = SessionStore(
+            SESSION_DB_PATH, ttl_seconds=SESSION_TTL_S,
+            max_turns=SESSION_MAX_TURNS, max_chunks=SESSION_MAX_CHUNKS,
+        )
+        # Thread pool dùng chung cho các stage song song của mọi request
+        self.executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="stage")
+        self.reloader = IndexReloader(
+            self.store.rebuild, DATA_LAWS_DIR,
+            interval_s=INDEX_WATCH_INTERVAL_S, sync=download_law_docs_from_gcs,
+            max_backoff_s=INDEX_RELOAD_MAX_BACKOFF_S,
+        )
+        self.reloader.start_watcher()
+        self.contracts = ContractIndex(
+            CONTRACT_INDEX_PATH,
+            encode=lambda texts: self.store.embedder.encode(texts, batch_size=EMBED_BATCH_SIZE, convert_to_numpy=True),
+            encode_query=self.store.scheduler.encode,
+            dim=self.store.embedder.get_sentence_embedding_dimension(),
+            read_text=read_docx,
+            fuse=fuse_rankings,
+            max_clause_chars=CONTRACT_CLAUSE_MAX_CHARS,
+        )
+        # Hợp đồng đã có sẵn trong contracts/ được index ở nền, trên thread riêng: encode cả thư mục
+        # lúc khởi động không được chiếm thread pool của stage request
+        threading.Thread(target=self._sync_contracts, name="contract-sync", daemon=True).start()
+        self.batch_reviewer = BatchReviewer(
+            read_text=read_docx,
+            detect_status=detect_contract_status,
+            retrieve_laws=lambda text: self.contract_agent.retrieve_laws(text, self.store),
+            generate=self.contract_agent.generate,
+            workers=BATCH_REVIEW_WORKERS,
+            llm_concurrency=BATCH_REVIEW_LLM_CONCURRENCY,
+        )
+        self.analyses = ContractAnalysisStore(CONTRACT_INDEX_PATH)
+        self.profiler = Profiler(
+            ProfileStore(PROFILE_DIR, keep=PROFILE_KEEP),
+            sample_rate=PROFILE_SAMPLE_RATE,
+            interval_ms=PROFILE_INTERVAL_MS,
+            max_concurrent=PROFILE_MAX_CONCURRENT,
+        )
 
-    def process(self, user_input: str, file_path: str = None) -> str:
+    def pull_index(self) -> Optional[Dict]:
+        """
+        Kéo bundle mới nhất từ bucket; version khác bản đang phục vụ -> load + swap.
+        Chạy dưới khoá single-flight của reloader (không đua với build trên CURRENT); None nếu đang reload.
+        """
+        def pull() -> Dict:
+            before = self.store.version
+            version = pull_index_bundle(self.store)
+            if version is None:
+                return {"version": before, "changed": False, "pulled": False}
+            if version != before:
+                self.store.load()
+            return {"version": self.store.version, "changed": version != before, "pulled": True}
+
+        ran, result = self.reloader.exclusive(pull)
+        return result if ran else None
+
+    def reload_index(self, reason: str = "manual", full: bool = False) -> bool:
+        """Sync GCS + build index mới ở nền (chỉ file thay đổi, trừ khi full) rồi swap."""
+        return self.reloader.trigger(reason, full=full)
+
+    def _sync_contracts(self):
+        try:
+            self.contracts.sync_dir(CONTRACT_DIR)
+        except Exception as e:
+            logger.error(f"❌ Index hợp đồng trong {CONTRACT_DIR} lỗi: {e}")
+
+    def _classify(self, user_input: str) -> Dict:
+        with stage_timer("intent"):
+            return self.intent_agent.run(user_input)
+
+    def _speculative_search(self, user_input: str) -> List[LawChunk]:
+        # Retrieval trên câu hỏi gốc trong lúc chờ intent; lỗi ở đây không được làm hỏng request
         try:
-            intent = self.intent_agent.run(user_input)
+            return self.rag_agent.search(user_input)
+        except Exception as e:
+            logger.warning(f"Speculative search lỗi: {e}")
+            return []
+
+    @staticmethod
+    def _read_contract(file_path: str) -> str:
+        return read_docx(pathlib.Path(file_path))
+
+    def open_session(self, session_id: Optional[str] = None, history: Optional[List[dict]] = None) -> Session:
+        """Lấy session cũ theo id, hoặc tạo mới (khởi tạo từ history client gửi lên)."""
+        session = self.sessions.get(session_id) if session_id else None
+        return session or self.sessions.create(history)
+
+    @staticmethod
+    def new_deadline(budget_s: float) -> Optional[Deadline]:
+        return Deadline(budget_s, DEGRADE_THRESHOLDS) if budget_s > 0 else None
+
+    def process(
+        self, user_input: str, file_path: str = None, session: Optional[Session] = None,
+        profile_id: Optional[str] = None, deadline: Optional[Deadline] = None,
+    ) -> str:
+        """
+        profile_id (từ profiler.new_id): chạy dưới sampling profiler, xem lại qua /admin/profiles/{id}.
+        deadline (từ new_deadline): các stage tự degrade khi sắp hết giờ, xem deadline.degraded sau khi xong.
+        """
+        with with_deadline(deadline), self.profiler.run(profile_id, user_input, file_path):
+            answer = self._process(user_input, file_path, session)
+        if session is not None:
+            self.sessions.record_turn(session, user_input, answer)
+        return answer
+
+    def _is_follow_up(self, session: Session, query: str) -> bool:
+        """Câu hỏi mới cùng chủ đề với câu hỏi đã retrieve ra context đang lưu trong session."""
+        if not session.topic:
+            return False
+        vecs = np.asarray(self.store.scheduler.encode([query, session.topic]), dtype=np.float32)
+        norms = np.linalg.norm(vecs, axis=1)
+        if not norms.all():
+            return False
+        sim = float(vecs[0] @ vecs[1]) / float(norms[0] * norms[1])
+        if sim < SESSION_FOLLOWUP_MIN_SIM:
+            logger.info(f"🆕 Câu hỏi khác chủ đề lượt trước (sim={sim:.2f}) -> không dùng lại context của session")
+            return False
+        return True
+
+    def _process(self, user_input: str, file_path: str = None, session: Optional[Session] = None) -> str:
+        """
+        Pipeline dạng đồ thị stage (StageGraph):
+        - intent || retrieval speculative trên câu hỏi gốc || đọc file hợp đồng (nếu có)
+        - tra cứu: cot -> các sub-query search song song -> answer
+          (câu hỏi tiếp theo trong session: bỏ cot, dùng lại chunk cũ + search bổ sung)
+        - câu tra cứu trích dẫn rõ "Điều N ... Luật X": tra article index, bỏ qua cot/search
+        - hợp đồng: parse -> (phân loại TEMPLATE/FINAL || RAG luật) -> analyze
+        Stage speculative không cần tới sẽ bị huỷ.
+        """
+        graph = StageGraph(self.executor)
+        try:
+            # Tra dict O(1): có trích dẫn rõ thì không cần speculative search (nếu đúng là câu tra cứu)
+            direct_chunks = [] if file_path else self.store.lookup_articles(user_input)
+            graph.add("intent", lambda: self._classify(user_input))
+            if not direct_chunks:
+                graph.add("speculative_search", lambda: self._speculative_search(user_input))
+            if file_path and pathlib.Path(file_path).exists():
+                graph.add("parse_contract", lambda: self._read_contract(file_path))
+            intent = graph.result("intent")
+
             mode = intent["mode"]
             query = intent["clean_text"]
+            record_request(mode)
+
+            # Soạn thảo / phân tích / chat có nhắc "Điều N Luật X" vẫn đi đúng nhánh của mode đó
+            if direct_chunks and mode not in ["tra_cuu_luat", "luat_su_online"]:
+                direct_chunks = []
+            if direct_chunks:
+                logger.info(f"📑 Tra trực tiếp {len(direct_chunks)} điều luật từ article index")
+                graph.add("article_lookup", lambda: direct_chunks)
 
             logger.info(f"🔍 Process | Mode: {mode} | Query: {query}")
 
+            if mode not in ["tra_cuu_luat", "luat_su_online"]:
+                graph.cancel("speculative_search")
+            if mode != "phan_tich_hop_dong" and graph.has("parse_contract"):
+                graph.cancel("parse_contract")
+
             # A: TRA CỨU LUẬT / LUẬT SƯ ONLINE
             if mode in ["tra_cuu_luat", "luat_su_online"]:
-                chunks = self.rag_agent.run(query)
-
-                print(f"\n[DEBUG] RAG tìm thấy: {len(chunks)} đoạn văn bản.")
-                for i, c in enumerate(chunks[:3]):
-                    print(f"  -> [{c.source_file}] {c.text[:50]}...")
-
-                if chunks:
-                    ctx = "\n\n".join([c.text for c in chunks])
+                index_version = self.store.version
+                prior_chunks = [LawChunk(**c) for c in session.chunks_for(index_version)] if session else []
+                if session is not None and session.chunks and not prior_chunks:
+                    logger.info(f"🗑️ Index đã reload -> bỏ context cũ của session {session.id[:8]}")
+                if prior_chunks and not direct_chunks and not self._is_follow_up(session, query):
+                    prior_chunks = []
+                search_stages = ["speculative_search"]
+                if direct_chunks:
+                    search_stages = ["article_lookup"]
+                elif prior_chunks:
+                    # Follow-up: dùng lại context đã retrieve, chỉ mở rộng bằng search trên câu hỏi mới
+                    record_cache("session_context", True)
+                    logger.info(f"♻️ Follow-up: dùng lại {len(prior_chunks)} chunk của session {session.id[:8]}")
                 else:
-                    logger.warning("⚠️ RAG trả về rỗng. AI sẽ trả lời dựa trên kiến thức nền kèm cảnh báo.")
-                    ctx = "KHÔNG TÌM THẤY DỮ LIỆU TRONG CƠ SỞ DỮ LIỆU NỘI BỘ."
-
-                return self.answer_agent.run(query, ctx, mode)
+                    if session is not None:
+                        record_cache("session_context", False)
+                    # Sắp hết deadline -> bỏ CoT, search thẳng câu hỏi đã chuẩn hoá
+                    graph.add(
+                        "cot", lambda _: [query] if degrade("skip_cot") else self.rag_agent.decompose(query),
+                        deps=("intent",),
+                    )
+                    queries = graph.result("cot")
+                    for i, q in enumerate(queries):
+                        name = f"search_{i}"
+                        graph.add(name, lambda _, q=q: self.rag_agent.search(q, route_hint=query), deps=("cot",))
+                        search_stages.append(name)
+
+                def merge_context(*result_lists):
+                    merged = self.rag_agent.merge(list(result_lists) + [prior_chunks])
+                    if degrade("shrink_context"):
+                        return fit_chunks(merged, DEGRADE_CONTEXT_MAX_CHARS)
+                    return self.store.expand_to_articles(merged) if RAG_EXPAND_ARTICLES else merged
+
+                def answer(chunks):
+                    print(f"\n[DEBUG] RAG tìm thấy: {len(chunks)} đoạn văn bản.")
+                    for i, c in enumerate(chunks[:3]):
+                        print(f"  -> [{c.source_file}] {c.text[:50]}...")
+
+                    if chunks:
+                        ctx = "\n\n".join([c.text for c in chunks])
+                    else:
+                        logger.warning("⚠️ RAG trả về rỗng. AI sẽ trả lời dựa trên kiến thức nền kèm cảnh báo.")
+                        ctx = "KHÔNG TÌM THẤY DỮ LIỆU TRONG CƠ SỞ DỮ LIỆU NỘI BỘ."
+                    history = session.history_block() if session else ""
+                    return self.answer_agent.run(query, ctx, mode, history=history)
+
+                graph.add("merge_context", merge_context, deps=search_stages)
+                graph.add("answer", answer, deps=("merge_context",))
+                result = graph.result("answer")
+                graph.log_critical_path("answer")
+                if session is not None:
+                    chunks = graph.result("merge_context")
+                    self.sessions.add_chunks(
+                        session, [{"text": c.text, "source_file": c.source_file} for c in chunks], index_version,
+                        topic=query,
+                    )
+                return result
 
             # B: PHÂN TÍCH HỢP ĐỒNG
             elif mode == "phan_tich_hop_dong":
@@ -1053,16 +2084,76 @@ class LegalOrchestrator:
                     )
 
                 path_obj = pathlib.Path(file_path)
-                if not path_obj.exists():
+                if not graph.has("parse_contract"):
                     return f"❌ Lỗi: Không tìm thấy file tại đường dẫn: `{file_path}`"
 
-                contract_text = read_docx(path_obj)
+                contract_text = graph.result("parse_contract")
                 if not contract_text:
                     return "❌ Lỗi: File rỗng hoặc không đọc được nội dung."
 
                 logger.info(f"📄 Đang phân tích hợp đồng: {path_obj.name}")
-                # Nếu muốn dùng RAG cho phân tích hợp đồng: truyền self.store
-                return self.contract_agent.analyze(contract_text, store=self.store)
+                index_version = self.store.version
+                clauses = split_clauses(contract_text, CONTRACT_CLAUSE_MAX_CHARS)
+                file_hash = file_sha256(path_obj)
+                previous = self.analyses.latest(path_obj.name) if CONTRACT_INCREMENTAL else None
+                if previous is not None and not same_contract(previous, path_obj.name, file_hash, clauses):
+                    logger.info(f"🆕 {path_obj.name} cùng họ tên với {previous.filename} nhưng khác hợp đồng -> phân tích mới")
+                    previous = None
+                changes = align_clauses(previous.clauses, clauses) if previous else None
+                incremental = changes is not None and changed_ratio(changes) <= CONTRACT_INCREMENTAL_MAX_CHANGED
+                if previous is not None:
+                    record_cache("contract_version", incremental)
+
+                if incremental and previous.index_version == index_version and not any(
+                    c.kind != "unchanged" for c in changes
+                ):
+                    logger.info(f"♻️ {path_obj.name} không đổi so với {previous.filename} -> dùng lại báo cáo")
+                    return previous.report
+
+                if incremental:
+                    # Bản mới của hợp đồng đã phân tích: giữ phân loại, chỉ phân tích điều khoản thay đổi
+                    graph.add("contract_status", lambda: previous.status)
+                    graph.add(
+                        "contract_rag",
+                        lambda: self.contract_agent.retrieve_changed_laws(changes, previous, contract_text, self.store),
+                    )
+                    graph.add(
+                        "contract_analysis",
+                        lambda law_block: self.contract_agent.reanalyze(previous, changes, law_block),
+                        deps=("contract_rag",),
+                    )
+                else:
+                    graph.add("contract_status", detect_contract_status, deps=("parse_contract",))
+                    graph.add(
+                        "contract_rag",
+                        lambda text: self.contract_agent.retrieve_laws(text, self.store),
+                        deps=("parse_contract",),
+                    )
+                    graph.add(
+                        "contract_analysis",
+                        self.contract_agent.generate,
+                        deps=("parse_contract", "contract_status", "contract_rag"),
+                    )
+                result = graph.result("contract_analysis")
+                graph.log_critical_path("contract_analysis")
+                if result != LLM_DEGRADED_TEXT:
+                    law_block = graph.result("contract_rag")
+                    # RAG rỗng / bị degrade -> không gắn version index: bản sau sẽ RAG lại thay vì dùng lại
+                    deadline = current_deadline()
+                    law_ok = bool(law_block.strip()) and not (
+                        deadline is not None and {"skip_rerank", "partial_shards"} & set(deadline.degraded)
+                    )
+                    self.analyses.save(AnalysisRecord(
+                        filename=path_obj.name,
+                        family=contract_family(path_obj.name),
+                        file_hash=file_hash,
+                        status=graph.result("contract_status"),
+                        law_block=law_block,
+                        report=result,
+                        clauses=clauses,
+                        index_version=index_version if law_ok else "",
+                    ))
+                return result
 
             # C: GỢI Ý / SOẠN THẢO ĐIỀU KHOẢN
             elif mode == "goi_y_dieu_khoan":
@@ -1083,7 +2174,7 @@ class LegalOrchestrator:
                 3. Luôn giữ vai là **AI Legal Assistant** chuyên về Pháp lý Doanh nghiệp.
                 4. Nếu user hỏi "Bạn là ai?", hãy giới thiệu ngắn gọn về khả năng: Tra cứu luật, Soát xét hợp đồng, Tư vấn rủi ro.
                 """
-                return GeminiClient.generate_text(chat_prompt)
+                return GeminiClient.generate_text(chat_prompt, call="chatchit")
 
             # E: FALLBACK
             return (
@@ -0,0 +1,9 @@
+"""
+Test chạy offline trên các bản giả local: FakeLLMBackend (thay Gemini), LocalDirSource /
+LocalBundleStore (thư mục đóng vai bucket). Chạy: `cd main/BE && python -m pytest -q tests`.
+"""
+import pathlib
+import sys
+
+# Module backend nằm phẳng trong main/BE (import như khi chạy sever.py)
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
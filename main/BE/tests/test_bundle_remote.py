@@ -0,0 +1,87 @@
+import json
+import pathlib
+
+import pytest
+
+from bundle_remote import CHECKSUMS_NAME, LATEST_NAME, LocalBundleStore, publish_bundle, pull_bundle
+from index_bundle import CURRENT_NAME, IndexBundleError, bundles_root, current_bundle, write_bundle
+
+PARAMS = {"embed_model": "test-model", "embedding_dim": 4}
+
+
+def build_bundle(index_dir: pathlib.Path, version: str, params=PARAMS) -> pathlib.Path:
+    def write_files(bundle_dir: pathlib.Path):
+        (bundle_dir / "laws.faiss").write_bytes(b"vectors-" + version.encode())
+        (bundle_dir / "chunks.npz").write_bytes(b"chunks")
+        shard = bundle_dir / "shards-2" / "0"
+        shard.mkdir(parents=True)
+        (shard / "stats.npz").write_bytes(b"stats")
+
+    return write_bundle(index_dir, version, dict(params), write_files)
+
+
+@pytest.fixture
+def store(tmp_path: pathlib.Path) -> LocalBundleStore:
+    return LocalBundleStore(tmp_path / "bucket" / "bundles")
+
+
+def test_publish_then_pull_roundtrip(tmp_path, store):
+    built = build_bundle(tmp_path / "builder", "v1")
+    result = publish_bundle(store, built)
+    assert result["files"] == 4  # manifest + 3 file, kể cả file trong thư mục shard
+    assert store.read_text(LATEST_NAME) == "v1"
+    assert store.read_text(f"v1/{CHECKSUMS_NAME}") is not None
+
+    node = tmp_path / "node"
+    assert pull_bundle(store, node, PARAMS) == "v1"
+    assert current_bundle(node) == bundles_root(node) / "v1"
+    for path in built.rglob("*"):
+        if path.is_file():
+            assert (bundles_root(node) / "v1" / path.relative_to(built)).read_bytes() == path.read_bytes()
+
+
+def test_pull_rejects_checksum_mismatch(tmp_path, store):
+    publish_bundle(store, build_bundle(tmp_path / "builder", "v1"))
+    (store.root / "v1" / "laws.faiss").write_bytes(b"bi sua tren bucket")
+
+    node = tmp_path / "node"
+    with pytest.raises(IndexBundleError, match="checksum"):
+        pull_bundle(store, node, PARAMS)
+    assert not (node / CURRENT_NAME).exists()
+    assert [p.name for p in bundles_root(node).iterdir()] == []  # Không để lại thư mục tạm
+
+
+def test_pull_rejects_path_outside_bundle(tmp_path, store):
+    publish_bundle(store, build_bundle(tmp_path / "builder", "v1"))
+    checksums = json.loads(store.read_text(f"v1/{CHECKSUMS_NAME}"))
+    checksums["../../evil"] = {"sha256": "0", "size": 0}
+    store.put_text(f"v1/{CHECKSUMS_NAME}", json.dumps(checksums))
+
+    with pytest.raises(IndexBundleError):
+        pull_bundle(store, tmp_path / "node", PARAMS)
+    assert not (tmp_path / "evil").exists()
+
+
+def test_incomplete_upload_is_ignored(tmp_path, store):
+    publish_bundle(store, build_bundle(tmp_path / "builder", "v1"))
+    newer = build_bundle(tmp_path / "builder", "v2")
+    for path in newer.rglob("*"):  # Upload dở: chưa có CHECKSUMS.json
+        if path.is_file():
+            store.put(f"v2/{path.relative_to(newer).as_posix()}", path)
+    store.put_text(LATEST_NAME, "v2")
+
+    assert pull_bundle(store, tmp_path / "node", PARAMS) == "v1"
+
+
+def test_pull_skips_bundles_built_with_other_config(tmp_path, store):
+    publish_bundle(store, build_bundle(tmp_path / "builder", "v1"))
+    assert pull_bundle(store, tmp_path / "node", {**PARAMS, "embed_model": "other-model"}) is None
+    assert not (tmp_path / "node" / CURRENT_NAME).exists()
+
+
+def test_republish_only_moves_latest(tmp_path, store):
+    built = build_bundle(tmp_path / "builder", "v1")
+    publish_bundle(store, built)
+    publish_bundle(store, build_bundle(tmp_path / "builder", "v2"))
+    assert publish_bundle(store, built)["files"] == 0
+    assert store.read_text(LATEST_NAME) == "v1"
@@ -0,0 +1,115 @@
+import json
+import os
+import pathlib
+
+import pytest
+
+from law_sync import MANIFEST_NAME, LawSync, LocalDirSource
+
+
+@pytest.fixture
+def bucket(tmp_path: pathlib.Path) -> pathlib.Path:
+    root = tmp_path / "bucket"
+    root.mkdir()
+    for i in range(4):
+        (root / f"luat_{i}.docx").write_bytes(f"noi dung {i}".encode())
+    return root
+
+
+@pytest.fixture
+def dest(tmp_path: pathlib.Path) -> pathlib.Path:
+    return tmp_path / "data_laws"
+
+
+def docx_files(path: pathlib.Path):
+    return sorted(p.name for p in path.glob("*.docx"))
+
+
+def test_first_sync_downloads_then_skips_unchanged(bucket, dest):
+    report = LawSync(LocalDirSource(bucket), dest).run()
+    assert sorted(report.added) == docx_files(bucket)
+    assert docx_files(dest) == docx_files(bucket)
+    assert (dest / "luat_0.docx").read_bytes() == b"noi dung 0"
+
+    report = LawSync(LocalDirSource(bucket), dest).run()
+    assert not report.changed
+    assert sorted(report.unchanged) == docx_files(bucket)
+
+
+def test_changed_file_is_updated(bucket, dest):
+    LawSync(LocalDirSource(bucket), dest).run()
+    (bucket / "luat_1.docx").write_bytes(b"ban sua doi dai hon")
+    report = LawSync(LocalDirSource(bucket), dest).run()
+    assert report.updated == ["luat_1.docx"]
+    assert (dest / "luat_1.docx").read_bytes() == b"ban sua doi dai hon"
+
+
+def test_md5_mismatch_is_rejected_without_partial_file(bucket, dest):
+    class CorruptSource(LocalDirSource):
+        def download(self, obj, dest_path):
+            super().download(obj, dest_path)
+            with open(dest_path, "ab") as f:
+                f.write(b"!")  # Hỏng trên đường truyền
+
+    report = LawSync(CorruptSource(bucket), dest).run()
+    assert sorted(report.failed) == docx_files(bucket)
+    assert all("MD5" in err for err in report.failed.values())
+    assert docx_files(dest) == []
+    assert not [p for p in dest.iterdir() if p.name.endswith(".part")]
+    assert json.loads((dest / MANIFEST_NAME).read_text(encoding="utf-8")) == {}
+
+
+def test_prune_removes_files_deleted_from_bucket(bucket, dest):
+    LawSync(LocalDirSource(bucket), dest).run()
+    (dest / "ghi_chu_local.docx").write_bytes(b"khong do sync tai")
+    (bucket / "luat_3.docx").unlink()
+
+    report = LawSync(LocalDirSource(bucket), dest).run()
+    assert report.deleted == ["luat_3.docx"]
+    assert not (dest / "luat_3.docx").exists()
+    assert (dest / "ghi_chu_local.docx").exists()  # Không có trong manifest -> không đụng tới
+
+
+def test_prune_skipped_when_listing_is_empty(bucket, dest):
+    LawSync(LocalDirSource(bucket), dest).run()
+    for f in bucket.iterdir():
+        f.unlink()
+
+    report = LawSync(LocalDirSource(bucket), dest).run()
+    assert report.deleted == []
+    assert len(docx_files(dest)) == 4
+
+
+def test_prune_skipped_above_max_fraction(bucket, dest):
+    LawSync(LocalDirSource(bucket), dest).run()
+    for i in range(3):
+        (bucket / f"luat_{i}.docx").unlink()
+
+    report = LawSync(LocalDirSource(bucket), dest, prune_max_fraction=0.5).run()
+    assert report.deleted == []
+    assert len(docx_files(dest)) == 4
+
+    report = LawSync(LocalDirSource(bucket), dest, prune_max_fraction=1.0).run()
+    assert sorted(report.deleted) == ["luat_0.docx", "luat_1.docx", "luat_2.docx"]
+
+
+def test_same_name_in_subfolders_does_not_collide(tmp_path, dest):
+    bucket = tmp_path / "bucket"
+    (bucket / "2020").mkdir(parents=True)
+    (bucket / "2024").mkdir()
+    (bucket / "2020" / "luat.docx").write_bytes(b"ban 2020")
+    (bucket / "2024" / "luat.docx").write_bytes(b"ban 2024")
+
+    report = LawSync(LocalDirSource(bucket), dest).run()
+    assert sorted(report.added) == ["2020__luat.docx", "2024__luat.docx"]
+    assert (dest / "2020__luat.docx").read_bytes() == b"ban 2020"
+    assert (dest / "2024__luat.docx").read_bytes() == b"ban 2024"
+    assert not LawSync(LocalDirSource(bucket), dest).run().changed
+
+
+def test_local_file_missing_is_downloaded_again(bucket, dest):
+    LawSync(LocalDirSource(bucket), dest).run()
+    os.remove(dest / "luat_2.docx")
+    report = LawSync(LocalDirSource(bucket), dest).run()
+    assert report.updated == ["luat_2.docx"]
+    assert (dest / "luat_2.docx").exists()
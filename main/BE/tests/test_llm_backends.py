@@ -0,0 +1,30 @@
+import json
+
+import pytest
+
+from llm_backends import FakeLLMBackend, LLMBackendError
+
+
+def test_fake_backend_answers_intent_json():
+    backend = FakeLLMBackend(latency_ms=0, latency_sigma=0)
+    prompt = 'Phân loại ý định user vào: ...\n    Input: "xin chào"\n    Output JSON: {}'
+    assert json.loads(backend.generate(prompt, json_mode=True))["mode"] == "chatchit"
+
+
+def test_fake_backend_errors_are_retryable():
+    backend = FakeLLMBackend(latency_ms=0, latency_sigma=0, error_rate=1.0, seed=1)
+    with pytest.raises(LLMBackendError) as exc:
+        backend.generate("hỏi gì đó")
+    assert exc.value.retryable
+
+
+def test_fake_backend_times_out_past_timeout():
+    backend = FakeLLMBackend(latency_ms=50, latency_sigma=0)
+    with pytest.raises(LLMBackendError, match="504") as exc:
+        backend.generate("hỏi gì đó", timeout=0.01)
+    assert exc.value.retryable
+
+
+def test_fake_backend_truncates_to_max_tokens():
+    backend = FakeLLMBackend(latency_ms=0, latency_sigma=0)
+    assert len(backend.generate("hỏi gì đó", max_tokens=5).split(" ")) <= 5
@@ -0,0 +1,116 @@
+import threading
+import time
+
+import pytest
+
+from llm_backends import FakeLLMBackend, LLMBackendError
+from llm_resilience import CircuitBreaker, LLMGuard, LLMUnavailableError
+
+
+def make_guard(**kwargs) -> LLMGuard:
+    params = dict(rate_per_minute=60000, max_retries=0, failure_threshold=2, recovery_timeout=0.05)
+    params.update(kwargs)
+    return LLMGuard(**params)
+
+
+def failing() -> FakeLLMBackend:
+    return FakeLLMBackend(latency_ms=0, latency_sigma=0, error_rate=1.0)
+
+
+def healthy() -> FakeLLMBackend:
+    return FakeLLMBackend(latency_ms=0, latency_sigma=0)
+
+
+def fail_n(guard: LLMGuard, n: int):
+    backend = failing()
+    for _ in range(n):
+        with pytest.raises(LLMBackendError):
+            guard.run("test", lambda: backend.generate("q"))
+
+
+def test_opens_after_threshold_and_fails_fast():
+    guard = make_guard(recovery_timeout=60)
+    fail_n(guard, 1)
+    assert guard.breaker.state == CircuitBreaker.CLOSED
+    fail_n(guard, 1)
+    assert guard.breaker.state == CircuitBreaker.OPEN
+
+    calls = []
+    with pytest.raises(LLMUnavailableError):
+        guard.run("test", lambda: calls.append(1))
+    assert calls == []  # Circuit mở: không gọi upstream
+
+
+def test_half_open_probe_success_closes():
+    guard = make_guard()
+    fail_n(guard, 2)
+    time.sleep(0.06)
+    backend = healthy()
+    assert guard.run("test", lambda: backend.generate("q"))
+    assert guard.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_probe_failure_reopens():
+    guard = make_guard()
+    fail_n(guard, 2)
+    time.sleep(0.06)
+    fail_n(guard, 1)  # Một lỗi khi thăm dò là đủ mở lại
+    assert guard.breaker.state == CircuitBreaker.OPEN
+
+
+def test_non_retryable_error_keeps_half_open_and_returns_probe():
+    guard = make_guard()
+    fail_n(guard, 2)
+    time.sleep(0.06)
+
+    def bad_request():
+        raise LLMBackendError("400 invalid argument", retryable=False)
+
+    with pytest.raises(LLMBackendError):
+        guard.run("test", bad_request)
+    assert guard.breaker.state == CircuitBreaker.HALF_OPEN
+    # Lượt thăm dò đã được trả: lời gọi kế tiếp được thăm dò và đóng circuit
+    backend = healthy()
+    assert guard.run("test", lambda: backend.generate("q"))
+    assert guard.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_non_retryable_error_does_not_reset_failures():
+    guard = make_guard(failure_threshold=2, recovery_timeout=60)
+    fail_n(guard, 1)
+    with pytest.raises(ValueError):
+        guard.run("test", lambda: (_ for _ in ()).throw(ValueError("parse")))
+    fail_n(guard, 1)
+    assert guard.breaker.state == CircuitBreaker.OPEN
+
+
+def test_only_one_probe_in_half_open():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=0.0)
+    breaker.record_failure()
+    assert breaker.allow()  # Thread này giữ lượt thăm dò
+
+    other = []
+    t = threading.Thread(target=lambda: other.append(breaker.allow()))
+    t.start()
+    t.join()
+    assert other == [False]
+
+    breaker.release_probe()
+    t = threading.Thread(target=lambda: other.append(breaker.allow()))
+    t.start()
+    t.join()
+    assert other == [False, True]
+
+
+def test_retries_transient_errors_then_succeeds():
+    guard = make_guard(max_retries=2, backoff_base=0.001, backoff_max=0.001, failure_threshold=5)
+    outcomes = iter([LLMBackendError("503 unavailable", retryable=True), "ok"])
+
+    def flaky():
+        out = next(outcomes)
+        if isinstance(out, Exception):
+            raise out
+        return out
+
+    assert guard.run("test", flaky) == "ok"
+    assert guard.breaker.state == CircuitBreaker.CLOSED